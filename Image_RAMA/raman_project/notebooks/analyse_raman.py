@@ -1,30 +1,95 @@
 # filepath: c:\Users\marwa\OneDrive\Desktop\Analyse_Raman\Image_RAMA\raman_project\notebooks\analyse_raman.py
 import argparse
+import cProfile
+import hashlib
+import heapq
 import json
+import os
+import pstats
+import signal
+import sys
 import time
+import tracemalloc
 import warnings
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
+from urllib.parse import quote
 
 import cv2
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-from mpl_toolkits.mplot3d import Axes3D  # noqa: F401
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
-from scipy.stats import entropy, wasserstein_distance
-from scipy.ndimage import gaussian_filter
+
+# matplotlib, sklearn et scipy sont importés dans les étapes qui s'en servent :
+# un worker batch ou un run --no-plots ne paie pas leur temps d'import (~1,2 s).
+
+
+# Paramètres du pipeline (ils entrent aussi dans la clé du cache de résultats)
+SEGMENTATION_THRESH1 = 85
+SEGMENTATION_THRESH2 = 170
+CLAHE_CLIP_LIMIT = 2.5
+CLAHE_TILE_GRID_SIZE = (8, 8)
+MORPH_KERNEL_SIZE = (2, 2)
+MIN_PARTICLE_AREA = 5
+CLUSTER_FEATURE_COLS = ["Size_Score", "Circularity", "AspectRatio", "Solidity", "Intensity_Score"]
+CLUSTER_FEATURE_WEIGHTS = [1.3, 1.0, 0.9, 1.0, 1.4]
+CLUSTER_K_MIN = 6
+CLUSTER_K_MAX = 10
+CLUSTER_SILHOUETTE_SAMPLE = 5000
+CLUSTER_MINIBATCH_THRESHOLD = 50000
+CLUSTER_MINIBATCH_N_INIT = 10
+CLUSTER_MINIBATCH_BATCH_SIZE = 4096
+# Mode "shared" : un modèle ajusté une fois sur un échantillon stratifié du batch
+CLUSTER_MODES = ("fast", "exhaustive", "shared")
+CLUSTER_MODEL_NAME = "cluster_model.json"
+SHARED_MODEL_SAMPLE = 50000
+SHARED_MODEL_MAX_IMAGES = 32
+# Statistiques spatiales : rayons de Ripley K/L et rayon de la densité locale (px)
+SPATIAL_STATS_RADII = (25, 50, 100, 200)
+LOCAL_DENSITY_RADIUS = 50
+
+CLASSIFICATION_RULES_PATH = Path(__file__).with_name("classification_rules.json")
+
+# À incrémenter quand une modification du code change les résultats du batch
+PIPELINE_VERSION = 4
+CACHE_MANIFEST_NAME = "cache_manifest.json"
+SUMMARY_NAME = "batch_summary.csv"
+SUMMARY_COLUMNS = ["image", "status", "particles", "clusters", "time_s", "cached"]
+# Mode surveillance : intervalle entre deux scans du dossier (s)
+WATCH_INTERVAL = 1.0
+# Batch séquentiel : images décodées d'avance et écritures en attente (0 = tout dans le thread principal)
+PIPELINE_DEPTH = 2
 
 
 def setup_warnings():
     warnings.filterwarnings("ignore")
 
 
-def get_image_files(raw_folder: Path):
-    image_files = sorted([f for f in raw_folder.glob("*.jpg") if f.is_file()])
+def use_headless_backend():
+    # Backend non interactif (Agg), hérité par les processus workers via l'environnement
+    os.environ["MPLBACKEND"] = "Agg"
+    if "matplotlib" in sys.modules:
+        sys.modules["matplotlib"].use("Agg")
+
+
+@lru_cache(maxsize=None)
+def get_pyplot():
+    # Import différé de pyplot, au premier graphique seulement
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401
+
+    return plt
+
+
+def get_image_files(raw_folder: Path, include_npy=False):
+    # include_npy : mosaïques en niveaux de gris .npy, lues en memmap par le mode tuilé seulement
+    patterns = ("*.jpg", "*.npy") if include_npy else ("*.jpg",)
+    image_files = sorted(f for pattern in patterns for f in raw_folder.glob(pattern) if f.is_file())
     print(f"📷 {len(image_files)} images trouvées dans {raw_folder}:")
     for i, img_file in enumerate(image_files, 1):
         print(f"   {i}. {img_file.name}")
@@ -48,6 +113,8 @@ def process_single_image(image_path: Path):
 
 
 def compute_quality_metrics(gray: np.ndarray):
+    from scipy.stats import entropy
+
     print("\n📊 QUALITÉ DE L'IMAGE (avant prétraitement):")
     print("=" * 70)
 
@@ -77,26 +144,187 @@ def compute_quality_metrics(gray: np.ndarray):
     print("\n✓ Qualité image évaluée")
 
 
-def preprocess_and_segment(gray: np.ndarray, thresh1=85, thresh2=170):
-    clahe = cv2.createCLAHE(clipLimit=2.5, tileGridSize=(8, 8))
-    gray_eq = clahe.apply(gray)
+PARTICLE_TYPE_NAMES = ("Type_1_Blanc", "Type_2_Gris", "Type_3_Noir")
+# Carte de classes uint8 : une valeur par type (dans l'ordre de PARTICLE_TYPE_NAMES),
+# qui sert aussi de niveau de gris pour l'affichage de la segmentation
+SEGMENTATION_CLASS_VALUES = (240, 150, 60)
+
+
+def segmentation_lut(thresh1=SEGMENTATION_THRESH1, thresh2=SEGMENTATION_THRESH2):
+    levels = np.arange(256)
+    blanc, gris, noir = SEGMENTATION_CLASS_VALUES
+    return np.select([levels < thresh1, levels < thresh2], [noir, gris], blanc).astype(np.uint8)
+
+
+def segment_class_map(gray_eq: np.ndarray, thresh1=SEGMENTATION_THRESH1, thresh2=SEGMENTATION_THRESH2):
+    # Un seul passage sur l'image (LUT 256 entrées), 1 octet par pixel pour les trois types
+    return cv2.LUT(gray_eq, segmentation_lut(thresh1, thresh2))
+
+
+def class_mask(class_map: np.ndarray, type_index):
+    # Masque 0/255 d'un type, construit à la demande et directement utilisable par OpenCV
+    return cv2.compare(class_map, SEGMENTATION_CLASS_VALUES[type_index], cv2.CMP_EQ)
+
+
+def class_pixel_counts(class_map: np.ndarray):
+    counts = np.bincount(class_map.ravel(), minlength=256)
+    return {type_name: int(counts[value]) for type_name, value in zip(PARTICLE_TYPE_NAMES, SEGMENTATION_CLASS_VALUES)}
+
 
-    mask_type3 = gray_eq < thresh1
-    mask_type2 = (gray_eq >= thresh1) & (gray_eq < thresh2)
-    mask_type1 = gray_eq >= thresh2
+def apply_clahe(gray: np.ndarray, clip_limit=CLAHE_CLIP_LIMIT):
+    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=CLAHE_TILE_GRID_SIZE)
+    return clahe.apply(gray)
 
-    segmentation_img = np.zeros_like(gray_eq)
-    segmentation_img[mask_type1] = 240
-    segmentation_img[mask_type2] = 150
-    segmentation_img[mask_type3] = 60
 
-    return gray_eq, mask_type1, mask_type2, mask_type3, segmentation_img, thresh1, thresh2
+def preprocess_and_segment(
+    gray: np.ndarray, thresh1=SEGMENTATION_THRESH1, thresh2=SEGMENTATION_THRESH2, clip_limit=CLAHE_CLIP_LIMIT
+):
+    gray_eq = apply_clahe(gray, clip_limit)
+    class_map = segment_class_map(gray_eq, thresh1, thresh2)
+    return gray_eq, class_map, thresh1, thresh2
+
+
+def clean_particle_mask(mask, kernel_size=MORPH_KERNEL_SIZE):
+    # Masque uint8 (0/255, class_mask) ; un masque booléen est relu en uint8 sans copie
+    if mask.dtype == np.bool_:
+        mask = mask.view(np.uint8)
+    kernel = np.ones(kernel_size, np.uint8)
+    return cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=1)
+
+
+def contour_polygon_metrics(contours):
+    # Aire (formule du lacet) et périmètre de tous les contours en un seul passage,
+    # identiques à cv2.contourArea et cv2.arcLength(cnt, True).
+    lengths = np.array([len(cnt) for cnt in contours], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    points = np.concatenate([cnt.reshape(-1, 2) for cnt in contours]).astype(np.float64)
+
+    next_idx = np.arange(len(points)) + 1
+    next_idx[starts + lengths - 1] = starts
+    x, y = points[:, 0], points[:, 1]
+    x_next, y_next = x[next_idx], y[next_idx]
+
+    cross = x * y_next - x_next * y
+    areas = np.abs(np.add.reduceat(cross, starts)) / 2.0
+    perimeters = np.add.reduceat(np.hypot(x_next - x, y_next - y), starts)
+    return areas, perimeters
+
+
+LABEL_CHUNK_ROWS = 512
+
+
+def label_mask_components(mask_clean):
+    # Composantes connexes (8-connexité, comme cv2.findContours) : image de labels et bbox
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(mask_clean, connectivity=8)
+    return labels, stats
+
+
+def contour_component_labels(contours, labels):
+    # Chaque contour externe démarre sur un pixel de sa composante connexe
+    first_points = np.array([cnt[0, 0] for cnt in contours])
+    return labels[first_points[:, 1], first_points[:, 0]]
+
+
+def filled_contour_intensities(contours, gray_image):
+    # Intensité moyenne dans chaque contour rempli (trous et inclusions compris), comme le
+    # masque plein du mode "contours" : une seule image de labels, un bincount pondéré
+    filled = np.zeros(gray_image.shape[:2], dtype=np.int32)
+    for i, cnt in enumerate(contours):
+        cv2.drawContours(filled, [cnt], 0, i + 1, thickness=cv2.FILLED)
+    n_labels = len(contours) + 1
+    # bincount par bandes de lignes : les copies int64/float64 restent bornées (sommes entières exactes)
+    intensity_sums = np.zeros(n_labels)
+    pixel_counts = np.zeros(n_labels)
+    for y in range(0, filled.shape[0], LABEL_CHUNK_ROWS):
+        rows = filled[y:y + LABEL_CHUNK_ROWS].ravel()
+        intensity_sums += np.bincount(rows, weights=gray_image[y:y + LABEL_CHUNK_ROWS].ravel(), minlength=n_labels)
+        pixel_counts += np.bincount(rows, minlength=n_labels)
+    return intensity_sums[1:] / np.maximum(pixel_counts[1:], 1)
+
+
+def label_particle_features(contours, gray_image, type_name, min_area=MIN_PARTICLE_AREA, offset=(0, 0)):
+    # Mêmes valeurs que le mode "contours" : bbox, moments et intensité du contour rempli
+    areas, perimeters = contour_polygon_metrics(contours)
+    keep = np.flatnonzero(areas >= min_area)
+    if len(keep) == 0:
+        return [], []
+
+    kept_contours = [contours[i] for i in keep]
+    areas = areas[keep]
+    perimeters = perimeters[keep]
+    circularities = (4 * np.pi * areas) / (perimeters**2 + 1e-6)
+
+    boxes = np.array([cv2.boundingRect(cnt) for cnt in kept_contours]).reshape(-1, 4)
+    widths, heights = boxes[:, 2], boxes[:, 3]
+    aspect_ratios = np.where(heights > 0, widths / np.maximum(heights, 1), 0.0)
+
+    hull_areas = np.array([cv2.contourArea(cv2.convexHull(cnt)) for cnt in kept_contours])
+    solidities = np.where(hull_areas > 0, areas / np.where(hull_areas > 0, hull_areas, 1), 0.0)
+
+    mean_intensities = filled_contour_intensities(kept_contours, gray_image)
+
+    # Centroïde du polygone (moments), tronqué comme int() ; offset : origine (x, y) de la
+    # fenêtre analysée dans l'image complète (mode tuilé)
+    offset_x, offset_y = offset
+    centers_x = np.empty(len(keep), dtype=np.int64)
+    centers_y = np.empty(len(keep), dtype=np.int64)
+    for j, (cnt, (x, y, w, h)) in enumerate(zip(kept_contours, boxes)):
+        moments = cv2.moments(cnt)
+        if moments["m00"] > 0:
+            centers_x[j] = int(moments["m10"] / moments["m00"])
+            centers_y[j] = int(moments["m01"] / moments["m00"])
+        else:
+            centers_x[j], centers_y[j] = x + w // 2, y + h // 2
+    centers_x += offset_x
+    centers_y += offset_y
+
+    features = [
+        {
+            "Type": type_name,
+            "Area_px2": float(area),
+            "Perimeter_px": float(perimeter),
+            "Circularity": float(circularity),
+            "AspectRatio": float(aspect_ratio),
+            "Solidity": float(solidity),
+            "MeanIntensity": float(mean_intensity),
+            "Center_X": int(center_x),
+            "Center_Y": int(center_y),
+        }
+        for area, perimeter, circularity, aspect_ratio, solidity, mean_intensity, center_x, center_y in zip(
+            areas,
+            perimeters,
+            circularities,
+            aspect_ratios,
+            solidities,
+            mean_intensities,
+            centers_x,
+            centers_y,
+        )
+    ]
+    if offset_x or offset_y:
+        shift = np.array([offset_x, offset_y], dtype=np.int32)
+        valid_contours = [cnt + shift for cnt in kept_contours]
+    else:
+        valid_contours = kept_contours
+
+    return features, valid_contours
+
+
+def detect_particles_in_mask_labels(
+    mask, gray_image, type_name, min_area=MIN_PARTICLE_AREA, kernel_size=MORPH_KERNEL_SIZE
+):
+    mask_clean = clean_particle_mask(mask, kernel_size)
+    contours, _ = cv2.findContours(mask_clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return [], []
+
+    return label_particle_features(contours, gray_image, type_name, min_area=min_area)
 
 
-def detect_particles_in_mask(mask, gray_image, type_name, min_area=5):
-    mask_uint8 = (mask * 255).astype(np.uint8)
-    kernel = np.ones((2, 2), np.uint8)
-    mask_clean = cv2.morphologyEx(mask_uint8, cv2.MORPH_OPEN, kernel, iterations=1)
+def detect_particles_in_mask_contours(
+    mask, gray_image, type_name, min_area=MIN_PARTICLE_AREA, kernel_size=MORPH_KERNEL_SIZE
+):
+    mask_clean = clean_particle_mask(mask, kernel_size)
     contours, _ = cv2.findContours(mask_clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     features = []
@@ -145,17 +373,655 @@ def detect_particles_in_mask(mask, gray_image, type_name, min_area=5):
     return features, valid_contours
 
 
-def extract_particles(gray_eq, mask_type1, mask_type2, mask_type3):
-    features_type1, contours_type1 = detect_particles_in_mask(mask_type1, gray_eq, "Type_1_Blanc")
-    features_type2, contours_type2 = detect_particles_in_mask(mask_type2, gray_eq, "Type_2_Gris")
-    features_type3, contours_type3 = detect_particles_in_mask(mask_type3, gray_eq, "Type_3_Noir")
+DETECTION_METHODS = {
+    "labels": detect_particles_in_mask_labels,
+    "contours": detect_particles_in_mask_contours,
+}
+
+
+def detect_particles_in_mask(
+    mask, gray_image, type_name, min_area=MIN_PARTICLE_AREA, method="labels", kernel_size=MORPH_KERNEL_SIZE
+):
+    # "labels" : moteur vectorisé (image de labels + bincount)
+    # "contours" : mode de référence, un masque plein cadre par contour
+    if method not in DETECTION_METHODS:
+        raise ValueError(f"Méthode de détection inconnue: {method} (choix: {', '.join(DETECTION_METHODS)})")
+    return DETECTION_METHODS[method](mask, gray_image, type_name, min_area=min_area, kernel_size=kernel_size)
+
+
+def extract_particles(gray_eq, class_map, method="labels", min_area=MIN_PARTICLE_AREA, kernel_size=MORPH_KERNEL_SIZE):
+    # Un seul masque de type vit à la fois, dérivé de la carte de classes
+    all_features = []
+    contours_by_type = []
+    for type_index, type_name in enumerate(PARTICLE_TYPE_NAMES):
+        features, contours = detect_particles_in_mask(
+            class_mask(class_map, type_index), gray_eq, type_name, min_area=min_area, method=method, kernel_size=kernel_size
+        )
+        all_features += features
+        contours_by_type.append(contours)
 
-    all_features = features_type1 + features_type2 + features_type3
     df_particles = pd.DataFrame(all_features)
+    contours_type1, contours_type2, contours_type3 = contours_by_type
 
     return df_particles, contours_type1, contours_type2, contours_type3
 
 
+TILE_SIZE = 2048
+TILE_HALO = 32
+TILE_EDGE_MARGIN = 2
+TILE_RESCUE_FACTOR = 2
+
+
+def check_tiled_options(detection_method="labels", clip_limit=CLAHE_CLIP_LIMIT, kernel_size=MORPH_KERNEL_SIZE):
+    # Le mode tuilé n'a que le moteur "labels" et les réglages CLAHE/morphologie par défaut
+    if detection_method != "labels":
+        raise ValueError(f"Le mode tuilé (--tile-size) n'accepte que la détection 'labels' (reçu: {detection_method})")
+    if clip_limit != CLAHE_CLIP_LIMIT or tuple(kernel_size) != MORPH_KERNEL_SIZE:
+        raise ValueError(
+            f"Le mode tuilé (--tile-size) utilise clip_limit={CLAHE_CLIP_LIMIT} et kernel_size={MORPH_KERNEL_SIZE} "
+            f"(reçu: {clip_limit}, {tuple(kernel_size)})"
+        )
+
+
+def load_gray_image(image_path: Path):
+    # .npy : ouverture en memmap, seules les tuiles lues sont chargées en mémoire
+    if image_path.suffix.lower() == ".npy":
+        return np.load(image_path, mmap_mode="r")
+    return cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+
+
+def clahe_tile_luts(gray: np.ndarray, clip_limit=CLAHE_CLIP_LIMIT, tile_grid_size=CLAHE_TILE_GRID_SIZE):
+    # LUTs CLAHE globales, calculées tuile par tuile de la grille, identiques à cv2.createCLAHE
+    height, width = gray.shape[:2]
+    grid_x, grid_y = tile_grid_size
+    if width % grid_x == 0 and height % grid_y == 0:
+        padded_width, padded_height = width, height
+    else:
+        # OpenCV complète l'image par réflexion (BORDER_REFLECT_101) jusqu'à un multiple de la grille
+        padded_width = width + grid_x - width % grid_x
+        padded_height = height + grid_y - height % grid_y
+    tile_width, tile_height = padded_width // grid_x, padded_height // grid_y
+    tile_area = tile_width * tile_height
+    clip = max(int(clip_limit * tile_area / 256), 1) if clip_limit > 0 else 0
+
+    rows = np.arange(padded_height)
+    rows = np.where(rows < height, rows, 2 * (height - 1) - rows)
+    cols = np.arange(padded_width)
+    cols = np.where(cols < width, cols, 2 * (width - 1) - cols)
+
+    lut_scale = np.float32(255) / np.float32(tile_area)
+    luts = np.zeros((grid_y, grid_x, 256), dtype=np.uint8)
+    for ty in range(grid_y):
+        for tx in range(grid_x):
+            if (ty + 1) * tile_height <= height and (tx + 1) * tile_width <= width:
+                tile = gray[ty * tile_height:(ty + 1) * tile_height, tx * tile_width:(tx + 1) * tile_width]
+            else:
+                tile_rows = rows[ty * tile_height:(ty + 1) * tile_height]
+                tile_cols = cols[tx * tile_width:(tx + 1) * tile_width]
+                tile = gray[np.ix_(tile_rows, tile_cols)]
+            hist = np.bincount(np.asarray(tile).ravel(), minlength=256).astype(np.int64)
+
+            if clip > 0:
+                clipped = int(np.maximum(hist - clip, 0).sum())
+                hist = np.minimum(hist, clip)
+                redist_batch = clipped // 256
+                residual = clipped - redist_batch * 256
+                hist += redist_batch
+                if residual:
+                    residual_step = max(256 // residual, 1)
+                    hist[np.arange(0, 256, residual_step)[:residual]] += 1
+
+            lut = np.rint(np.cumsum(hist).astype(np.float32) * lut_scale)
+            luts[ty, tx] = np.clip(lut, 0, 255).astype(np.uint8)
+
+    return luts, (tile_width, tile_height)
+
+
+def apply_clahe_luts(gray_region: np.ndarray, luts, clahe_tile_size, y0, x0):
+    # Interpolation bilinéaire des LUTs (float32, comme OpenCV) pour une fenêtre d'origine (y0, x0)
+    tile_width, tile_height = clahe_tile_size
+    grid_y, grid_x = luts.shape[:2]
+    height, width = gray_region.shape[:2]
+
+    xs = np.arange(x0, x0 + width).astype(np.float32) * (np.float32(1) / np.float32(tile_width)) - np.float32(0.5)
+    ys = np.arange(y0, y0 + height).astype(np.float32) * (np.float32(1) / np.float32(tile_height)) - np.float32(0.5)
+    tx1 = np.floor(xs).astype(int)
+    ty1 = np.floor(ys).astype(int)
+    xa = xs - tx1.astype(np.float32)
+    ya = (ys - ty1.astype(np.float32))[:, None]
+    tx2 = np.minimum(tx1 + 1, grid_x - 1)[None, :]
+    ty2 = np.minimum(ty1 + 1, grid_y - 1)[:, None]
+    tx1 = np.maximum(tx1, 0)[None, :]
+    ty1 = np.maximum(ty1, 0)[:, None]
+
+    # Opérations en place : trois images float32 au plus en mémoire
+    values = gray_region
+    top = luts[ty1, tx1, values].astype(np.float32)
+    top *= np.float32(1) - xa
+    top += luts[ty1, tx2, values] * xa
+    bottom = luts[ty2, tx1, values].astype(np.float32)
+    bottom *= np.float32(1) - xa
+    bottom += luts[ty2, tx2, values] * xa
+    top *= np.float32(1) - ya
+    bottom *= ya
+    top += bottom
+    return np.clip(np.rint(top, out=top), 0, 255).astype(np.uint8)
+
+
+def iter_image_tiles(height, width, tile_size=TILE_SIZE, halo=TILE_HALO):
+    # (cœur, fenêtre étendue du halo), bornes (y0, y1, x0, x1) dans l'image complète
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1 = min(y0 + tile_size, height)
+            x1 = min(x0 + tile_size, width)
+            window = (max(y0 - halo, 0), min(y1 + halo, height), max(x0 - halo, 0), min(x1 + halo, width))
+            yield (y0, y1, x0, x1), window
+
+
+def window_edge_contact(bboxes, window, height, width, margin=TILE_EDGE_MARGIN):
+    # Vrai si la composante approche un bord intérieur de la fenêtre : l'ouverture
+    # morphologique n'y est plus exacte et la particule peut continuer au-delà.
+    bboxes = np.asarray(bboxes).reshape(-1, 4)
+    x, y, w, h = bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3]
+    y0, y1, x0, x1 = window
+    return (
+        ((x0 > 0) & (x <= margin))
+        | ((y0 > 0) & (y <= margin))
+        | ((x1 < width) & (x + w >= x1 - x0 - margin))
+        | ((y1 < height) & (y + h >= y1 - y0 - margin))
+    )
+
+
+def contour_contains_seed(contour_boxes, seed):
+    seed_x, seed_y = seed
+    for (x, y, w, h), contour in contour_boxes:
+        if x <= seed_x < x + w and y <= seed_y < y + h:
+            if cv2.pointPolygonTest(contour, (float(seed_x), float(seed_y)), False) >= 0:
+                return True
+    return False
+
+
+def iter_type_core_masks(
+    gray: np.ndarray,
+    luts,
+    clahe_tile_size,
+    type_index,
+    tile_size=TILE_SIZE,
+    halo=TILE_HALO,
+    thresh1=SEGMENTATION_THRESH1,
+    thresh2=SEGMENTATION_THRESH2,
+):
+    # Masque nettoyé d'un type et image CLAHE, sur le cœur de chaque tuile (exact : le halo couvre
+    # la bande où l'ouverture dépend de pixels extérieurs)
+    height, width = gray.shape[:2]
+    for core, window in iter_image_tiles(height, width, tile_size, halo):
+        cy0, cy1, cx0, cx1 = core
+        y0, y1, x0, x1 = window
+        gray_eq = apply_clahe_luts(np.asarray(gray[y0:y1, x0:x1]), luts, clahe_tile_size, y0, x0)
+        mask_clean = clean_particle_mask(class_mask(segment_class_map(gray_eq, thresh1, thresh2), type_index))
+        inner = (slice(cy0 - y0, cy1 - y0), slice(cx0 - x0, cx1 - x0))
+        yield core, mask_clean[inner], gray_eq[inner]
+
+
+def new_stitch_state(width):
+    # Bords déjà vus : dernière colonne de la tuile précédente, dernière ligne de la rangée précédente
+    return {
+        "width": width,
+        "pairs": [],
+        "right": None,
+        "bottom": np.zeros(width, dtype=np.int32),
+        "next_bottom": np.zeros(width, dtype=np.int32),
+    }
+
+
+def border_label_pairs(line, neighbours, start, diagonal=True):
+    # Paires de labels (> 0) qui se touchent entre un bord de tuile (positions start...) et la
+    # ligne voisine déjà vue ; diagonal : 8-connexité, sinon 4-connexité
+    positions = np.arange(start, start + len(line))
+    pairs = []
+    for shift in (-1, 0, 1) if diagonal else (0,):
+        inside = (positions + shift >= 0) & (positions + shift < len(neighbours))
+        a = line[inside]
+        b = neighbours[positions[inside] + shift]
+        touching = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[touching], b[touching]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def remember_tile_edges(state, values, core):
+    # Bords droit et bas de la tuile, pour les tuiles suivantes (ordre raster)
+    y0, y1, x0, x1 = core
+    state["right"] = values[:, -1].copy()
+    state["next_bottom"][x0:x1] = values[-1]
+    if x1 == state["width"]:
+        state["bottom"], state["next_bottom"] = state["next_bottom"], state["bottom"]
+
+
+def stitch_tile_labels(state, global_labels, core, diagonal=True):
+    # Raccord aux bords gauche et haut, déjà vus
+    y0, y1, x0, x1 = core
+    if x0 > 0:
+        state["pairs"].append(border_label_pairs(global_labels[:, 0], state["right"], 0, diagonal))
+    if y0 > 0:
+        state["pairs"].append(border_label_pairs(global_labels[0], state["bottom"], x0, diagonal))
+    remember_tile_edges(state, global_labels, core)
+
+
+def stitched_components(state, n_labels):
+    # Union-find des morceaux de tuiles : label global → identifiant de composante
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    pairs = np.concatenate(state["pairs"]) if state["pairs"] else np.empty((0, 2), dtype=np.int64)
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n_labels, n_labels))
+    return connected_components(graph, directed=False)[1]
+
+
+def global_tile_labels(labels, n_labels):
+    # Labels locaux (0 = fond) → labels globaux (int32), décalés du nombre de labels déjà attribués
+    return np.where(labels > 0, labels + np.int32(n_labels - 1), np.int32(0))
+
+
+def filled_cell_moments(cells, x0, y0):
+    # Contour externe d'un masque rempli, lu sur les cellules 2×2 de centres de pixels : 4 pixels
+    # = carré, 3 = triangle, 2 = arête (ou diagonale) parcourue deux fois. Renvoie aire ×2, moments
+    # ×6 (entiers, comme cv2.moments), pas axiaux et diagonaux (cv2.arcLength). cells : masque de
+    # la tuile précédé de la ligne et de la colonne voisines ; (x0, y0) : coin bas-droit de la 1re cellule
+    a, b, c, d = cells[:-1, :-1], cells[:-1, 1:], cells[1:, :-1], cells[1:, 1:]
+    n = a + b + c + d
+    full, tri, pair = n == 4, n == 3, n == 2
+    xs = x0 + np.arange(n.shape[1], dtype=np.int64)
+    ys = y0 + np.arange(n.shape[0], dtype=np.int64)
+    n_tri = int(tri.sum())
+    return np.array([
+        2 * int(full.sum()) + n_tri,
+        full.sum(axis=0) @ (6 * xs - 3) + tri.sum(axis=0) @ (3 * xs) - int((a + c)[tri].sum(dtype=np.int64)),
+        full.sum(axis=1) @ (6 * ys - 3) + tri.sum(axis=1) @ (3 * ys) - int((a + b)[tri].sum(dtype=np.int64)),
+        int((pair & (a != d)).sum()),
+        n_tri + 2 * int((pair & (a == d)).sum()),
+    ], dtype=np.int64)
+
+
+def stitch_oversized_particles(
+    gray: np.ndarray,
+    luts,
+    clahe_tile_size,
+    type_index,
+    seeds,
+    keys,
+    tile_size=TILE_SIZE,
+    halo=TILE_HALO,
+    thresh1=SEGMENTATION_THRESH1,
+    thresh2=SEGMENTATION_THRESH2,
+    min_area=MIN_PARTICLE_AREA,
+):
+    # Composantes trop grandes pour une fenêtre de reconstruction (fond connexe...), recollées
+    # tuile par tuile sans masque plein cadre : mêmes valeurs que leur contour externe en image
+    # entière. Renvoie ces particules et les clés de `keys` incluses dans l'une d'elles (invisibles
+    # en RETR_EXTERNAL). Mémoire : quelques images de tuile + O(morceaux de composantes).
+    height, width = gray.shape[:2]
+    sweep_args = (gray, luts, clahe_tile_size, type_index, tile_size, halo, thresh1, thresh2)
+    keys = np.array(keys, dtype=np.int64).reshape(-1, 2)
+    type_name = PARTICLE_TYPE_NAMES[type_index]
+
+    # Passe 1 : morceaux 8-connexes recollés d'une tuile à l'autre, composantes des graines
+    state = new_stitch_state(width)
+    n_labels = 1
+    seed_labels = []
+    for core, mask, _ in iter_type_core_masks(*sweep_args):
+        y0, y1, x0, x1 = core
+        n, labels = cv2.connectedComponents(mask, connectivity=8, ltype=cv2.CV_32S)
+        global_labels = global_tile_labels(labels, n_labels)
+        stitch_tile_labels(state, global_labels, core)
+        seed_labels += [global_labels[sy - y0, sx - x0] for sx, sy in seeds if y0 <= sy < y1 and x0 <= sx < x1]
+        n_labels += n - 1
+    components = stitched_components(state, n_labels)
+    parts = [
+        {
+            "component": component,
+            "stitch": new_stitch_state(width),
+            "n_regions": 1,
+            "region_sums": [np.zeros(1)],
+            "region_counts": [np.zeros(1)],
+            "frame": [],
+            "key_regions": np.zeros(len(keys), dtype=np.int64),
+            "sum": 0.0,
+            "count": 0,
+            "box": [width, height, -1, -1],
+            "hull": np.empty((0, 1, 2), dtype=np.int32),
+            "first": None,
+        }
+        for component in np.unique(components[seed_labels])
+    ]
+
+    def iter_part_regions():
+        # Par tuile : pixels de chaque composante et régions 4-connexes de son complément
+        # (trous ou extérieur), numérotées globalement dans le même ordre à chaque passe
+        n_labels = 1
+        for part in parts:
+            part["n_regions"] = 1
+        for core, mask, gray_eq in iter_type_core_masks(*sweep_args):
+            n, labels = cv2.connectedComponents(mask, connectivity=8, ltype=cv2.CV_32S)
+            tile_components = components[n_labels:n_labels + n - 1]
+            n_labels += n - 1
+            tile_parts = []
+            for part in parts:
+                inside = np.concatenate(([False], tile_components == part["component"]))[labels]
+                n_regions, regions = cv2.connectedComponents(
+                    (~inside).view(np.uint8), connectivity=4, ltype=cv2.CV_32S
+                )
+                tile_parts.append((inside, regions, global_tile_labels(regions, part["n_regions"])))
+                part["n_regions"] += n_regions - 1
+            yield core, gray_eq, tile_parts
+
+    # Passe 2 : statistiques des composantes, régions de leur complément et clés qui y tombent
+    firsts = []
+    for (y0, y1, x0, x1), gray_eq, tile_parts in iter_part_regions():
+        tile_keys = np.flatnonzero((keys[:, 0] >= x0) & (keys[:, 0] < x1) & (keys[:, 1] >= y0) & (keys[:, 1] < y1))
+        for part, (inside, regions, global_regions) in zip(parts, tile_parts):
+            stitch_tile_labels(part["stitch"], global_regions, (y0, y1, x0, x1), diagonal=False)
+            part["region_sums"].append(np.bincount(regions.ravel(), weights=gray_eq.ravel())[1:])
+            part["region_counts"].append(np.bincount(regions.ravel())[1:])
+            # Régions au bord de l'image : reliées à l'extérieur du contour
+            image_edges = [
+                global_regions[0] if y0 == 0 else None,
+                global_regions[-1] if y1 == height else None,
+                global_regions[:, 0] if x0 == 0 else None,
+                global_regions[:, -1] if x1 == width else None,
+            ]
+            part["frame"] += [np.unique(edge[edge > 0]) for edge in image_edges if edge is not None]
+            part["key_regions"][tile_keys] = global_regions[keys[tile_keys, 1] - y0, keys[tile_keys, 0] - x0]
+            if not inside.any():
+                continue
+            part["sum"] += float(gray_eq[inside].sum(dtype=np.int64))
+            part["count"] += int(inside.sum())
+            rows, cols = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+            box = part["box"]
+            box[0], box[1] = min(box[0], cols[0] + x0), min(box[1], rows[0] + y0)
+            box[2], box[3] = max(box[2], cols[-1] + x0), max(box[3], rows[-1] + y0)
+            # Enveloppe convexe cumulée : celle des contours des morceaux suffit
+            contours, _ = cv2.findContours(inside.view(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            shift = np.array([x0, y0], dtype=np.int32)
+            part["hull"] = cv2.convexHull(np.concatenate([part["hull"]] + [cnt + shift for cnt in contours]))
+            # Premier pixel (ordre raster) : point de départ du contour externe, et régions des
+            # autres composantes qui le contiennent
+            first_y, first_x = np.unravel_index(np.argmax(inside), inside.shape)
+            other_regions = [regions_of[first_y, first_x] for _, _, regions_of in tile_parts]
+            firsts.append((part["component"], (first_y + y0, first_x + x0), other_regions))
+
+    # Trous : régions du complément qui ne rejoignent pas le bord de l'image
+    for part in parts:
+        region_components = stitched_components(part["stitch"], part["n_regions"])
+        frame = np.concatenate(part["frame"]) if part["frame"] else np.empty(0, dtype=np.int64)
+        part["holes"] = ~np.isin(region_components, region_components[frame])
+        part["holes"][0] = False
+        region_sums = np.concatenate(part.pop("region_sums"))
+        region_counts = np.concatenate(part.pop("region_counts"))
+        part["sum"] += float(region_sums[part["holes"]].sum())
+        part["count"] += int(region_counts[part["holes"]].sum())
+    for component, (first_y, first_x), other_regions in sorted(firsts, key=lambda f: f[1]):
+        part = next(p for p in parts if p["component"] == component)
+        if part["first"] is None:
+            part["first"] = (first_x, first_y)
+            part["nested"] = any(
+                other["holes"][region] for other, region in zip(parts, other_regions) if other is not part
+            )
+
+    # Passe 3 : aire, moments et périmètre du contour externe (composante + trous)
+    for part in parts:
+        part["stitch"] = new_stitch_state(width)
+        part["moments"] = np.zeros(5, dtype=np.int64)
+    for (y0, y1, x0, x1), _, tile_parts in iter_part_regions():
+        for part, (inside, _, global_regions) in zip(parts, tile_parts):
+            filled = (inside | part["holes"][global_regions]).view(np.uint8)
+            edges = part["stitch"]
+            cells = np.zeros((y1 - y0 + 1 + (y1 == height), x1 - x0 + 1 + (x1 == width)), dtype=np.uint8)
+            cells[0, 1:x1 - x0 + 1] = edges["bottom"][x0:x1]
+            if x0 > 0:
+                cells[0, 0] = edges["bottom"][x0 - 1]
+                cells[1:y1 - y0 + 1, 0] = edges["right"]
+            cells[1:y1 - y0 + 1, 1:x1 - x0 + 1] = filled
+            part["moments"] += filled_cell_moments(cells, x0, y0)
+            remember_tile_edges(edges, filled, (y0, y1, x0, x1))
+
+    particles = {}
+    for part in parts:
+        area2, m10_6, m01_6, axis_steps, diagonal_steps = (int(v) for v in part["moments"])
+        area = area2 / 2
+        if part["first"] is None or part["nested"] or area < min_area:
+            continue
+        perimeter = axis_steps + diagonal_steps * np.sqrt(2)
+        x_min, y_min, x_max, y_max = part["box"]
+        w, h = x_max - x_min + 1, y_max - y_min + 1
+        hull_area = cv2.contourArea(part["hull"])
+        if area2 > 0:
+            # Même arithmétique flottante que cv2.moments
+            m00 = area2 * 0.5
+            center_x, center_y = int(m10_6 * (1 / 6) / m00), int(m01_6 * (1 / 6) / m00)
+        else:
+            center_x, center_y = x_min + w // 2, y_min + h // 2
+        feature = {
+            "Type": type_name,
+            "Area_px2": float(area),
+            "Perimeter_px": float(perimeter),
+            "Circularity": float((4 * np.pi * area) / (perimeter**2 + 1e-6)),
+            "AspectRatio": float(w / h),
+            "Solidity": float(area / hull_area if hull_area > 0 else 0.0),
+            "MeanIntensity": float(part["sum"] / max(part["count"], 1)),
+            "Center_X": center_x,
+            "Center_Y": center_y,
+        }
+        # Contour non matérialisé (il serait à l'échelle de l'image) : enveloppe convexe à la place
+        particles[part["first"]] = (feature, part["hull"])
+
+    nested = {
+        tuple(keys[i])
+        for part in parts
+        for i in np.flatnonzero(part["holes"][part["key_regions"]])
+    }
+    return particles, nested
+
+
+def rescue_border_particle(
+    gray: np.ndarray,
+    luts,
+    clahe_tile_size,
+    type_index,
+    seed,
+    bbox,
+    thresh1=SEGMENTATION_THRESH1,
+    thresh2=SEGMENTATION_THRESH2,
+    min_area=MIN_PARTICLE_AREA,
+    halo=TILE_HALO,
+    max_side=None,
+):
+    # Particule coupée par une tuile : fenêtre agrandie autour d'elle jusqu'à ce qu'elle soit entière
+    height, width = gray.shape[:2]
+    seed_x, seed_y = seed
+    x, y, w, h = bbox
+    margin = halo
+    contour = None
+
+    while True:
+        window = (max(y - margin, 0), min(y + h + margin, height), max(x - margin, 0), min(x + w + margin, width))
+        y0, y1, x0, x1 = window
+        if contour is not None and max_side is not None and max(y1 - y0, x1 - x0) > max_side:
+            return contour, None
+
+        gray_eq = apply_clahe_luts(np.asarray(gray[y0:y1, x0:x1]), luts, clahe_tile_size, y0, x0)
+        mask_clean = clean_particle_mask(class_mask(segment_class_map(gray_eq, thresh1, thresh2), type_index))
+        labels, stats = label_mask_components(mask_clean)
+        label = labels[seed_y - y0, seed_x - x0]
+
+        contours, _ = cv2.findContours((labels == label).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contour = contours[0] + np.array([x0, y0], dtype=np.int32)
+        if not window_edge_contact(stats[label, :4], window, height, width)[0]:
+            break
+
+        x, y = stats[label, cv2.CC_STAT_LEFT] + x0, stats[label, cv2.CC_STAT_TOP] + y0
+        w, h = stats[label, cv2.CC_STAT_WIDTH], stats[label, cv2.CC_STAT_HEIGHT]
+        margin *= 2
+
+    features, _ = label_particle_features(
+        contours[:1], gray_eq, PARTICLE_TYPE_NAMES[type_index], min_area=min_area, offset=(x0, y0)
+    )
+    return contour, features
+
+
+def extract_particles_tiled(
+    gray: np.ndarray,
+    tile_size=TILE_SIZE,
+    halo=TILE_HALO,
+    thresh1=SEGMENTATION_THRESH1,
+    thresh2=SEGMENTATION_THRESH2,
+    min_area=MIN_PARTICLE_AREA,
+    rescue_factor=TILE_RESCUE_FACTOR,
+):
+    # Mode tuilé : CLAHE, segmentation et détection tuile par tuile (moteur "labels").
+    # Chaque particule entière appartient à la tuile dont le cœur contient son premier
+    # point de contour ; les particules coupées sont reconstruites après le balayage.
+    height, width = gray.shape[:2]
+    luts, clahe_tile_size = clahe_tile_luts(gray)
+    max_side = tile_size * rescue_factor if rescue_factor else None
+
+    particles = {type_name: {} for type_name in PARTICLE_TYPE_NAMES}
+    pixel_counts = dict.fromkeys(PARTICLE_TYPE_NAMES, 0)
+    border_seeds = []
+
+    for (cy0, cy1, cx0, cx1), window in iter_image_tiles(height, width, tile_size, halo):
+        y0, y1, x0, x1 = window
+        gray_eq = apply_clahe_luts(np.asarray(gray[y0:y1, x0:x1]), luts, clahe_tile_size, y0, x0)
+
+        # Zone exacte de la fenêtre : hors de la bande où l'ouverture dépend de pixels extérieurs
+        exact_x0 = TILE_EDGE_MARGIN if x0 > 0 else 0
+        exact_y0 = TILE_EDGE_MARGIN if y0 > 0 else 0
+        exact_x1 = x1 - x0 - (TILE_EDGE_MARGIN if x1 < width else 0)
+        exact_y1 = y1 - y0 - (TILE_EDGE_MARGIN if y1 < height else 0)
+
+        class_map = segment_class_map(gray_eq, thresh1, thresh2)
+        for type_name, count in class_pixel_counts(class_map[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]).items():
+            pixel_counts[type_name] += count
+        for type_index, type_name in enumerate(PARTICLE_TYPE_NAMES):
+            mask_clean = clean_particle_mask(class_mask(class_map, type_index))
+            contours, _ = cv2.findContours(mask_clean, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if not contours:
+                continue
+
+            labels, stats = label_mask_components(mask_clean)
+            contour_labels = contour_component_labels(contours, labels)
+            keys = np.array([cnt[0, 0] for cnt in contours]) + np.array([x0, y0])
+            incomplete = window_edge_contact(stats[contour_labels, :4], window, height, width)
+            owned = (
+                ~incomplete
+                & (keys[:, 0] >= cx0) & (keys[:, 0] < cx1)
+                & (keys[:, 1] >= cy0) & (keys[:, 1] < cy1)
+            )
+
+            owned_idx = np.flatnonzero(owned)
+            if len(owned_idx):
+                features, valid_contours = label_particle_features(
+                    [contours[i] for i in owned_idx],
+                    gray_eq,
+                    type_name,
+                    min_area=min_area,
+                    offset=(x0, y0),
+                )
+                for feature, cnt in zip(features, valid_contours):
+                    particles[type_name][tuple(cnt[0, 0])] = (feature, cnt)
+
+            for i in np.flatnonzero(incomplete):
+                # Graine : un pixel de la particule situé dans la zone exacte
+                points = contours[i][:, 0, :]
+                inside = (
+                    (points[:, 0] >= exact_x0) & (points[:, 0] < exact_x1)
+                    & (points[:, 1] >= exact_y0) & (points[:, 1] < exact_y1)
+                )
+                if inside.any():
+                    seed_x, seed_y = points[np.argmax(inside)]
+                else:
+                    region = labels[exact_y0:exact_y1, exact_x0:exact_x1] == contour_labels[i]
+                    if not region.any():
+                        continue
+                    seed_y, seed_x = np.unravel_index(np.argmax(region), region.shape)
+                    seed_x, seed_y = seed_x + exact_x0, seed_y + exact_y0
+                label = contour_labels[i]
+                bbox = (
+                    stats[label, cv2.CC_STAT_LEFT] + x0,
+                    stats[label, cv2.CC_STAT_TOP] + y0,
+                    stats[label, cv2.CC_STAT_WIDTH],
+                    stats[label, cv2.CC_STAT_HEIGHT],
+                )
+                border_seeds.append((type_index, (int(seed_x + x0), int(seed_y + y0)), bbox))
+
+    # Reconstruction des particules coupées, une seule fois chacune
+    rescued = {type_name: [] for type_name in PARTICLE_TYPE_NAMES}
+    oversized = {type_name: [] for type_name in PARTICLE_TYPE_NAMES}
+    oversized_seeds = {type_name: [] for type_name in PARTICLE_TYPE_NAMES}
+    for type_index, seed, bbox in border_seeds:
+        type_name = PARTICLE_TYPE_NAMES[type_index]
+        if contour_contains_seed(rescued[type_name], seed) or contour_contains_seed(oversized[type_name], seed):
+            continue
+        contour, features = rescue_border_particle(
+            gray, luts, clahe_tile_size, type_index, seed, bbox, thresh1, thresh2, min_area, halo, max_side
+        )
+        if features is None:
+            # Trop grande pour une fenêtre : recollée tuile par tuile plus bas
+            oversized[type_name].append((cv2.boundingRect(contour), contour))
+            oversized_seeds[type_name].append(seed)
+            continue
+        rescued[type_name].append((cv2.boundingRect(contour), contour))
+        if features:
+            particles[type_name][tuple(contour[0, 0])] = (features[0], contour)
+
+    stitched_types = [type_name for type_name in PARTICLE_TYPE_NAMES if oversized_seeds[type_name]]
+    if stitched_types:
+        print(f"   🧩 Composante(s) plus grande(s) que {max_side}px recollée(s) tuile par tuile ({', '.join(stitched_types)})")
+
+    all_features = []
+    all_contours = []
+    for type_index, type_name in enumerate(PARTICLE_TYPE_NAMES):
+        type_particles = particles[type_name]
+        if oversized_seeds[type_name]:
+            # Fond connexe... : composantes recollées tuile par tuile, particules incluses écartées
+            large_particles, nested = stitch_oversized_particles(
+                gray,
+                luts,
+                clahe_tile_size,
+                type_index,
+                oversized_seeds[type_name],
+                list(type_particles),
+                tile_size,
+                halo,
+                thresh1,
+                thresh2,
+                min_area,
+            )
+            for key in nested:
+                del type_particles[key]
+            type_particles.update(large_particles)
+
+        # Particules contenues dans une particule reconstruite : invisibles en RETR_EXTERNAL
+        if type_particles and rescued[type_name]:
+            keys = np.array(list(type_particles))
+            for (x, y, w, h), contour in rescued[type_name]:
+                in_box = np.flatnonzero(
+                    (keys[:, 0] >= x) & (keys[:, 0] < x + w) & (keys[:, 1] >= y) & (keys[:, 1] < y + h)
+                )
+                for key in map(tuple, keys[in_box]):
+                    if key in type_particles and cv2.pointPolygonTest(contour, (float(key[0]), float(key[1])), False) > 0:
+                        del type_particles[key]
+
+        # Ordre de cv2.findContours sur l'image complète : balayage raster inversé
+        ordered_keys = sorted(type_particles, key=lambda k: (k[1], k[0]), reverse=True)
+        all_features += [type_particles[k][0] for k in ordered_keys]
+        all_contours.append([type_particles[k][1] for k in ordered_keys])
+
+    df_particles = pd.DataFrame(all_features)
+    contours_type1, contours_type2, contours_type3 = all_contours
+
+    return df_particles, contours_type1, contours_type2, contours_type3, pixel_counts
+
+
 def add_scores(df_particles: pd.DataFrame):
     df_particles["Size_Score"] = df_particles["Area_px2"]
     df_particles["Shape_Score"] = (
@@ -167,88 +1033,256 @@ def add_scores(df_particles: pd.DataFrame):
     return df_particles
 
 
-def cluster_weighted(df_particles: pd.DataFrame):
-    feature_cols = ["Size_Score", "Circularity", "AspectRatio", "Solidity", "Intensity_Score"]
-    X = df_particles[feature_cols].values
+def weighted_cluster_features(df_particles: pd.DataFrame):
+    from sklearn.preprocessing import StandardScaler
+
+    X = df_particles[CLUSTER_FEATURE_COLS].values
 
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(X)
 
-    weights = np.array([1.3, 1.0, 0.9, 1.0, 1.4])
-    X_weighted = X_scaled * weights
+    weights = np.array(CLUSTER_FEATURE_WEIGHTS)
+    return X_scaled * weights
+
+
+def fit_kmeans(X, n_clusters, n_init, max_iter, minibatch=False):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if minibatch:
+        km = MiniBatchKMeans(
+            n_clusters=n_clusters,
+            random_state=42,
+            n_init=CLUSTER_MINIBATCH_N_INIT,
+            max_iter=max_iter,
+            batch_size=CLUSTER_MINIBATCH_BATCH_SIZE,
+        )
+    else:
+        km = KMeans(n_clusters=n_clusters, random_state=42, n_init=n_init, max_iter=max_iter)
+    labels = km.fit_predict(X)
+    return km, labels
+
+
+def select_k(X, k_min, k_max, n_init=50, max_iter=500, silhouette_sample=None, minibatch=False):
+    # Règle de sélection inchangée : 0.7 × silhouette + 0.3 × inertie normalisée
+    from sklearn.metrics import silhouette_score
+
+    models = {}
+    silhouette_scores = {}
+    inertia_scores = {}
+
+    for k in range(k_min, k_max + 1):
+        km, labels = fit_kmeans(X, k, n_init=n_init, max_iter=max_iter, minibatch=minibatch)
+        if silhouette_sample is not None and len(X) > silhouette_sample:
+            silhouette_scores[k] = silhouette_score(X, labels, sample_size=silhouette_sample, random_state=42)
+        else:
+            silhouette_scores[k] = silhouette_score(X, labels)
+        inertia_scores[k] = km.inertia_
+        models[k] = (km, labels)
+
+    inertias = np.array(list(inertia_scores.values()))
+    norm_inertias = 1 - (inertias - inertias.min()) / (inertias.max() - inertias.min())
+    combined_scores = {}
+    for i, k in enumerate(range(k_min, k_max + 1)):
+        combined_scores[k] = 0.7 * silhouette_scores[k] + 0.3 * norm_inertias[i]
+
+    best_k = max(combined_scores, key=combined_scores.get)
+    return best_k, models[best_k], combined_scores
+
+
+def cluster_weighted(df_particles: pd.DataFrame, mode="fast", model=None):
+    # "fast" : silhouette sur échantillon borné, MiniBatchKMeans au-delà de
+    #          CLUSTER_MINIBATCH_THRESHOLD particules, et le modèle gagnant du balayage est conservé
+    # "exhaustive" : silhouette complète O(n²) puis réajustement n_init=100 (référence)
+    # "shared" : simple prédiction avec le modèle commun au batch (ids comparables entre images)
+    if mode not in CLUSTER_MODES:
+        raise ValueError(f"Mode de clustering inconnu: {mode} (choix: {', '.join(CLUSTER_MODES)})")
+    if mode == "shared":
+        if model is None:
+            raise ValueError("Le mode de clustering 'shared' nécessite un modèle partagé (--cluster-model)")
+        df_particles["Cluster_Combined"] = shared_cluster_labels(df_particles, model)
+        return df_particles, model["k"]
+
+    X_weighted = weighted_cluster_features(df_particles)
 
     if len(df_particles) >= 12:
-        k_min = 6
-        k_max = min(10, len(df_particles) - 1)
-        silhouette_scores = {}
-        inertia_scores = {}
-
-        for k in range(k_min, k_max + 1):
-            km = KMeans(n_clusters=k, random_state=42, n_init=50, max_iter=500)
-            labels = km.fit_predict(X_weighted)
-            silhouette_scores[k] = silhouette_score(X_weighted, labels)
-            inertia_scores[k] = km.inertia_
-
-        inertias = np.array(list(inertia_scores.values()))
-        norm_inertias = 1 - (inertias - inertias.min()) / (inertias.max() - inertias.min())
-        combined_scores = {}
-        for i, k in enumerate(range(k_min, k_max + 1)):
-            combined_scores[k] = 0.7 * silhouette_scores[k] + 0.3 * norm_inertias[i]
-
-        best_k = max(combined_scores, key=combined_scores.get)
-        n_main_clusters = best_k
+        k_min = CLUSTER_K_MIN
+        k_max = min(CLUSTER_K_MAX, len(df_particles) - 1)
+        if mode == "fast":
+            minibatch = len(df_particles) > CLUSTER_MINIBATCH_THRESHOLD
+            n_main_clusters, (_, labels), _ = select_k(
+                X_weighted,
+                k_min,
+                k_max,
+                silhouette_sample=CLUSTER_SILHOUETTE_SAMPLE,
+                minibatch=minibatch,
+            )
+            df_particles["Cluster_Combined"] = labels
+            return df_particles, n_main_clusters
+
+        n_main_clusters, _, _ = select_k(X_weighted, k_min, k_max)
     else:
         n_main_clusters = min(9, max(6, len(df_particles) // 10))
 
+    from sklearn.cluster import KMeans
+
     kmeans_main = KMeans(n_clusters=n_main_clusters, random_state=42, n_init=100, max_iter=800)
     df_particles["Cluster_Combined"] = kmeans_main.fit_predict(X_weighted)
 
     return df_particles, n_main_clusters
 
 
-def interpret_clusters(df_particles: pd.DataFrame, n_main_clusters: int):
-    def interpret_combined_cluster(cluster_data):
-        avg_size = cluster_data["Size_Score"].mean()
-        avg_circ = cluster_data["Circularity"].mean()
-        avg_intensity = cluster_data["Intensity_Score"].mean()
-
-        if avg_size < 50:
-            size_label = "Très_Petites"
-        elif avg_size < 150:
-            size_label = "Petites"
-        elif avg_size < 400:
-            size_label = "Moyennes"
-        elif avg_size < 1000:
-            size_label = "Grandes"
-        else:
-            size_label = "Très_Grandes"
-
-        if avg_circ > 0.75:
-            shape_label = "Sphériques"
-        elif avg_circ > 0.6:
-            shape_label = "Compactes"
-        elif avg_circ < 0.4:
-            shape_label = "Irrégulières"
-        else:
-            shape_label = "Intermédiaires"
+def shared_cluster_labels(df_particles: pd.DataFrame, model: dict):
+    # Équivalent de StandardScaler.transform × poids puis KMeans.predict, en NumPy seul
+    X = df_particles[model["feature_cols"]].to_numpy(dtype=np.float64)
+    X_weighted = (X - np.asarray(model["scaler_mean"])) / np.asarray(model["scaler_scale"]) * np.asarray(model["weights"])
+    centers = np.asarray(model["centers"])
+    # ||x - c||² à une constante près : une multiplication matricielle, sans tableau n × k × d
+    distances = (centers**2).sum(axis=1) - 2.0 * X_weighted @ centers.T
+    return distances.argmin(axis=1)
+
+
+def fit_shared_cluster_model(df_sample: pd.DataFrame, image_names):
+    from sklearn.preprocessing import StandardScaler
+
+    if len(df_sample) < 12:
+        raise ValueError(f"Trop peu de particules pour le modèle partagé: {len(df_sample)}")
+
+    X = df_sample[CLUSTER_FEATURE_COLS].values
+    scaler = StandardScaler().fit(X)
+    X_weighted = scaler.transform(X) * np.array(CLUSTER_FEATURE_WEIGHTS)
+
+    # Même règle de choix de k que le mode "fast", une seule fois pour tout le batch
+    best_k, (km, _), scores = select_k(
+        X_weighted,
+        CLUSTER_K_MIN,
+        min(CLUSTER_K_MAX, len(X) - 1),
+        silhouette_sample=CLUSTER_SILHOUETTE_SAMPLE,
+        minibatch=len(X) > CLUSTER_MINIBATCH_THRESHOLD,
+    )
 
-        if avg_intensity < 90:
-            intensity_label = "Sombres"
-        elif avg_intensity < 160:
-            intensity_label = "Grises"
+    model = {
+        "pipeline_version": PIPELINE_VERSION,
+        "feature_cols": CLUSTER_FEATURE_COLS,
+        "weights": CLUSTER_FEATURE_WEIGHTS,
+        "scaler_mean": scaler.mean_.tolist(),
+        "scaler_scale": scaler.scale_.tolist(),
+        "centers": km.cluster_centers_.tolist(),
+        "k": int(best_k),
+        "scores": {str(k): float(v) for k, v in scores.items()},
+        "n_sample": len(df_sample),
+        "images": list(image_names),
+        "fitted_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    payload = json.dumps([model["scaler_mean"], model["scaler_scale"], model["weights"], model["centers"]])
+    model["id"] = hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+    return model
+
+
+def save_cluster_model(model: dict, model_path: Path):
+    model_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = model_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(model, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, model_path)
+
+
+def load_cluster_model(model_path: Path):
+    # None si le modèle est illisible ou ajusté avec d'autres features / pondérations / version
+    try:
+        with open(model_path, "r", encoding="utf-8") as f:
+            model = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"⚠️  Modèle de clustering illisible, ignoré: {model_path}")
+        return None
+    if (
+        model.get("pipeline_version") != PIPELINE_VERSION
+        or model.get("feature_cols") != CLUSTER_FEATURE_COLS
+        or model.get("weights") != CLUSTER_FEATURE_WEIGHTS
+    ):
+        print(f"⚠️  Modèle de clustering incompatible avec les paramètres actuels, ignoré: {model_path}")
+        return None
+    return model
+
+
+def check_clustering_agreement(df_particles: pd.DataFrame):
+    # Compare le mode rapide au mode exhaustif sur les mêmes particules
+    from sklearn.metrics import adjusted_rand_score
+
+    start = time.time()
+    df_fast, k_fast = cluster_weighted(df_particles[CLUSTER_FEATURE_COLS].copy(), mode="fast")
+    time_fast = time.time() - start
+
+    start = time.time()
+    df_exhaustive, k_exhaustive = cluster_weighted(df_particles[CLUSTER_FEATURE_COLS].copy(), mode="exhaustive")
+    time_exhaustive = time.time() - start
+
+    report = {
+        "n_particles": len(df_particles),
+        "k_fast": int(k_fast),
+        "k_exhaustive": int(k_exhaustive),
+        "same_k": bool(k_fast == k_exhaustive),
+        "adjusted_rand_index": float(
+            adjusted_rand_score(df_exhaustive["Cluster_Combined"], df_fast["Cluster_Combined"])
+        ),
+        "time_fast_s": time_fast,
+        "time_exhaustive_s": time_exhaustive,
+    }
+
+    print("\n🧪 ACCORD CLUSTERING (rapide vs exhaustif)")
+    print(f"  • k rapide: {report['k_fast']} | k exhaustif: {report['k_exhaustive']}")
+    print(f"  • Adjusted Rand Index: {report['adjusted_rand_index']:.3f}")
+    print(f"  • Temps: {time_fast:.2f}s vs {time_exhaustive:.2f}s")
+    return report
+
+
+@lru_cache(maxsize=None)
+def load_classification_rules(path: Path = CLASSIFICATION_RULES_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compile_rule_tree(frame: pd.DataFrame, rules, parent_mask):
+    # Aplatit l'arbre {"when", "rules" | "label"} en couples (masque, label) ordonnés :
+    # la première règle vraie l'emporte, comme les if/elif imbriqués d'origine.
+    conditions = []
+    labels = []
+    for rule in rules:
+        mask = parent_mask
+        if "when" in rule:
+            mask = parent_mask & frame.eval(rule["when"]).to_numpy(dtype=bool)
+        if "label" in rule:
+            conditions.append(mask)
+            labels.append(rule["label"])
         else:
-            intensity_label = "Claires"
+            sub_conditions, sub_labels = compile_rule_tree(frame, rule["rules"], mask)
+            conditions.extend(sub_conditions)
+            labels.extend(sub_labels)
+    return conditions, labels
+
+
+def apply_rule_tree(frame: pd.DataFrame, rules, flags=None, default="Non_Classé"):
+    frame = frame.copy()
+    for flag_name, expression in (flags or {}).items():
+        frame[flag_name] = frame.eval(expression).to_numpy(dtype=bool)
+
+    conditions, labels = compile_rule_tree(frame, rules, np.ones(len(frame), dtype=bool))
+    if not conditions:
+        return np.full(len(frame), default, dtype=object)
+    label_idx = np.select(conditions, np.arange(len(labels)), default=len(labels))
+    return np.array(labels + [default], dtype=object)[label_idx]
 
-        return f"{intensity_label}_{size_label}_{shape_label}"
 
-    cluster_labels = {}
-    for cluster_id in range(n_main_clusters):
-        cluster_data = df_particles[df_particles["Cluster_Combined"] == cluster_id]
-        if len(cluster_data) > 0:
-            cluster_labels[cluster_id] = interpret_combined_cluster(cluster_data)
+def interpret_clusters(df_particles: pd.DataFrame, n_main_clusters: int, rules=None):
+    rules = rules if rules is not None else load_classification_rules()["cluster_labels"]
 
-    df_particles["Cluster_Label"] = df_particles["Cluster_Combined"].map(cluster_labels)
-    df_particles["Cluster_Label"].fillna("Non_Classé", inplace=True)
+    # Une seule agrégation pour tous les clusters, puis les règles sur la table des moyennes
+    cluster_table = df_particles.groupby("Cluster_Combined").agg(rules["aggregate"])
+    cluster_table = cluster_table[cluster_table.index.isin(range(n_main_clusters))]
+    parts = [apply_rule_tree(cluster_table, part["rules"]) for part in rules["parts"]]
+    label_values = [rules["separator"].join(labels) for labels in zip(*parts)]
+    cluster_labels = {int(cluster_id): label for cluster_id, label in zip(cluster_table.index, label_values)}
+
+    df_particles[rules["column"]] = df_particles["Cluster_Combined"].map(cluster_labels).fillna(rules["default"])
 
     return df_particles, cluster_labels
 
@@ -264,66 +1298,36 @@ def cluster_3d(df_particles: pd.DataFrame):
     X_3d = df_particles[["Size_Normalized", "Shape_Normalized", "Intensity_Normalized"]].values
     n_3d_clusters = min(10, max(7, len(df_particles) // 15))
 
+    from sklearn.cluster import KMeans
+
     kmeans_3d = KMeans(n_clusters=n_3d_clusters, random_state=42, n_init=80, max_iter=600)
     df_particles["Cluster_3D"] = kmeans_3d.fit_predict(X_3d)
 
     return df_particles, n_3d_clusters
 
 
-def classify_particles(df_particles: pd.DataFrame):
-    def classify_particle_combined(row):
-        size = row["Size_Score"]
-        intensity = row["Intensity_Score"]
-        circ = row["Circularity"]
-        solid = row["Solidity"]
-        aspect = row["AspectRatio"]
-
-        is_compact = (circ > 0.65 and solid > 0.75)
-        is_porous = (solid < 0.65)
-        is_angular = not is_compact and not is_porous and (aspect > 1.4 or circ < 0.55)
-
-        if intensity < 85:
-            if size < 100:
-                return "Carbone_Amorphe_Fin" if is_compact else "Carbone_Dispersé"
-            elif size < 400:
-                return "Carbone_Cristallin_Dense" if solid > 0.85 else "Carbone_Dispersé"
-            else:
-                return "Agglomérat_Carbone"
-        elif intensity < 170:
-            if size < 100:
-                if is_compact:
-                    return "Particule_Transition_Compacte"
-                if is_angular:
-                    return "Particule_Transition_Anguleuse"
-                return "Particule_Transition_Ronde"
-            elif size < 400:
-                if is_porous:
-                    return "Dépôt_Poreux"
-                if is_compact:
-                    return "Particule_Transition_Compacte"
-                return "Particule_Transition_Anguleuse"
-            else:
-                return "Dépôt_Poreux" if is_porous else "Mélange_Intermédiaire"
-        else:
-            if size < 50:
-                return "Bruit_Optique"
-            elif size < 200:
-                return "Particule_Claire_Compacte" if is_compact else "Particule_Claire"
-            else:
-                return "Substrat_Exposé" if (circ < 0.5 or solid < 0.7) else "Particule_Claire_Compacte"
-
-    df_particles["Particle_Type_Combined"] = df_particles.apply(classify_particle_combined, axis=1)
+def classify_particles(df_particles: pd.DataFrame, rules=None):
+    rules = rules if rules is not None else load_classification_rules()["particle_types"]
+    df_particles[rules["column"]] = apply_rule_tree(
+        df_particles,
+        rules["rules"],
+        flags=rules.get("flags"),
+        default=rules.get("default", "Non_Classé"),
+    )
     return df_particles
 
 
+def run_pca(df_particles: pd.DataFrame):
     features_for_pca = ["Size_Score", "Circularity", "AspectRatio", "Solidity", "Intensity_Score", "Perimeter_px"]
     available_features = [feat for feat in features_for_pca if feat in df_particles.columns]
     if len(available_features) < 2:
         print("⚠️  PCA ignorée: pas assez de features disponibles")
         return df_particles, None
 
+    from sklearn.decomposition import PCA
+    from sklearn.preprocessing import StandardScaler
+
     X_pca = df_particles[available_features].values
-    X_pca = df_particles[features_for_pca].values
 
     scaler_pca = StandardScaler()
     X_pca_scaled = scaler_pca.fit_transform(X_pca)
@@ -335,6 +1339,7 @@ def classify_particles(df_particles: pd.DataFrame):
     df_particles["PCA_2"] = X_pca_3d[:, 1]
     df_particles["PCA_3"] = X_pca_3d[:, 2]
 
+    return df_particles, pca
 
 
 def resolve_feature_columns(df_particles: pd.DataFrame):
@@ -344,169 +1349,545 @@ def resolve_feature_columns(df_particles: pd.DataFrame):
     return size_col, shape_col, intensity_col
 
 
+FIGURE_DPI = 300
+# Qualité des figures sauvegardées : dpi et côté max des images (aperçu sous-échantillonné)
+FIGURE_QUALITIES = {
+    "full": {"dpi": FIGURE_DPI, "max_side": None},
+    "preview": {"dpi": 100, "max_side": 1024},
+}
+RENDER_WORKERS = 1
+# Figures en attente de rendu par processus avant que l'analyse n'attende le pool
+RENDER_MAX_PENDING_PER_WORKER = 4
+PANEL_METHODS = {"image": "imshow", "bar": "bar", "hist": "hist", "scatter3d": "scatter"}
+BOLD_TITLE = {"fontsize": 12, "fontweight": "bold"}
+
+
+def image_panel(data, title, colorbar=None, title_kwargs=BOLD_TITLE, **imshow_kwargs):
+    panel = {"kind": "image", "args": (data,), "kwargs": imshow_kwargs, "title": title, "title_kwargs": title_kwargs, "axis_off": True}
+    if colorbar is not None:
+        panel["colorbar"] = colorbar
+    return panel
+
+
+def draw_panel(fig, ax, panel):
+    kwargs = dict(panel.get("kwargs", {}))
+    if "cmap_colors" in panel:
+        from matplotlib import colormaps
+
+        kwargs["color"] = colormaps[panel["cmap_colors"]](np.linspace(0, 1, len(panel["args"][0])))
+    artist = getattr(ax, PANEL_METHODS[panel["kind"]])(*panel["args"], **kwargs)
+
+    for overlay in panel.get("overlays", []):
+        if overlay["kind"] == "rectangle":
+            from matplotlib.patches import Rectangle
+
+            ax.add_patch(Rectangle(*overlay["args"], **overlay.get("kwargs", {})))
+        else:
+            getattr(ax, overlay["kind"])(*overlay["args"], **overlay.get("kwargs", {}))
+
+    if "title" in panel:
+        ax.set_title(panel["title"], **panel.get("title_kwargs", {}))
+    if "xticklabels" in panel:
+        labels, tick_kwargs = panel["xticklabels"]
+        ax.set_xticks(range(len(labels)))
+        ax.set_xticklabels(labels, **tick_kwargs)
+    if "yticklabels" in panel:
+        labels, tick_kwargs = panel["yticklabels"]
+        ax.set_yticks(range(len(labels)))
+        ax.set_yticklabels(labels, **tick_kwargs)
+    if "xlabel" in panel:
+        ax.set_xlabel(panel["xlabel"][0], **panel["xlabel"][1])
+    if "ylabel" in panel:
+        ax.set_ylabel(panel["ylabel"][0], **panel["ylabel"][1])
+    if "grid" in panel:
+        ax.grid(True, **panel["grid"])
+    if panel.get("legend"):
+        ax.legend()
+    if panel.get("axis_off"):
+        ax.axis("off")
+
+    colorbar = panel.get("colorbar")
+    if colorbar is not None:
+        cbar = fig.colorbar(artist, ax=ax, **colorbar.get("kwargs", {"fraction": 0.046, "pad": 0.04}))
+        if "label" in colorbar:
+            cbar.set_label(colorbar["label"], **colorbar.get("label_kwargs", {}))
+        if "yticklabels" in colorbar:
+            cbar.ax.set_yticklabels(colorbar["yticklabels"])
+
+
+def render_figure(spec, path: Path | None = None, dpi=FIGURE_DPI, show=False):
+    # Hors affichage, une Figure nue (canvas Agg) suffit : pyplot n'est pas chargé
+    if any(panel.get("projection") == "3d" for panel in spec["panels"]):
+        from mpl_toolkits.mplot3d import Axes3D  # noqa: F401
+    if show:
+        fig = get_pyplot().figure(figsize=spec["figsize"])
+    else:
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=spec["figsize"])
+
+    rows, cols = spec["layout"]
+    for i, panel in enumerate(spec["panels"]):
+        ax = fig.add_subplot(rows, cols, i + 1, projection=panel.get("projection"))
+        draw_panel(fig, ax, panel)
+    fig.tight_layout()
+
+    if path is not None:
+        fig.savefig(path, dpi=dpi, bbox_inches="tight", facecolor="white")
+    if show:
+        get_pyplot().show()
+    return path
+
+
+def preview_figure_spec(spec, max_side=None):
+    # Aperçu : images sous-échantillonnées par pas entier, affichées dans leurs coordonnées d'origine
+    if max_side is None:
+        return spec
+    panels = []
+    for panel in spec["panels"]:
+        if panel["kind"] == "image":
+            data = panel["args"][0]
+            height, width = data.shape[:2]
+            step = -(-max(height, width) // max_side)
+            if step > 1:
+                kwargs = {"extent": (-0.5, width - 0.5, height - 0.5, -0.5), **panel.get("kwargs", {})}
+                panel = {**panel, "args": (data[::step, ::step],), "kwargs": kwargs}
+        panels.append(panel)
+    return {**spec, "panels": panels}
+
+
+def init_render_worker():
+    use_headless_backend()
+    setup_warnings()
+
+
+def start_figure_renderer(workers=RENDER_WORKERS, quality="full", dpi=None):
+    if quality not in FIGURE_QUALITIES:
+        raise ValueError(f"Qualité de figure inconnue: {quality} (choix: {', '.join(FIGURE_QUALITIES)})")
+    settings = FIGURE_QUALITIES[quality]
+    # workers = 0 : rendu synchrone dans le processus courant
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker) if workers > 0 else None
+    return {
+        "executor": executor,
+        "max_pending": max(1, workers) * RENDER_MAX_PENDING_PER_WORKER,
+        "quality": quality,
+        "dpi": dpi or settings["dpi"],
+        "max_side": settings["max_side"],
+        "pending": [],
+        "rendered": 0,
+        "errors": [],
+    }
+
+
+def collect_figures(renderer, keep=0):
+    # Attend les plus anciennes figures jusqu'à n'en laisser que `keep` en cours ;
+    # une erreur de rendu est signalée sans interrompre l'analyse
+    while len(renderer["pending"]) > keep:
+        path, future = renderer["pending"].pop(0)
+        try:
+            future.result()
+            renderer["rendered"] += 1
+        except Exception as e:
+            renderer["errors"].append(f"{path}: {e}")
+            print(f"   ❌ Rendu impossible: {path} ({e})")
+
+
+def submit_figure(renderer, spec, path: Path | None = None):
+    spec = preview_figure_spec(spec, renderer["max_side"])
+    if renderer["executor"] is None:
+        try:
+            render_figure(spec, path, dpi=renderer["dpi"])
+            renderer["rendered"] += 1
+        except Exception as e:
+            renderer["errors"].append(f"{path}: {e}")
+            print(f"   ❌ Rendu impossible: {path} ({e})")
+        return
+    # File bornée : au-delà de max_pending figures, l'analyse attend le pool (mémoire des tableaux bornée)
+    collect_figures(renderer, keep=renderer["max_pending"] - 1)
+    renderer["pending"].append((path, renderer["executor"].submit(render_figure, spec, path, renderer["dpi"])))
+
+
+def wait_figures(renderer):
+    # Barrière : toutes les figures soumises sont écrites au retour
+    start = time.time()
+    collect_figures(renderer)
+    print(
+        f"🖼️  {renderer['rendered']} figure(s) rendue(s) ({renderer['quality']}, {renderer['dpi']} dpi), "
+        f"{len(renderer['errors'])} erreur(s), attente {time.time() - start:.2f}s"
+    )
+
+
+def close_figure_renderer(renderer):
+    wait_figures(renderer)
+    if renderer["executor"] is not None:
+        renderer["executor"].shutdown()
+
+
+def emit_figure(spec, path: Path | None = None, show_plots=False, renderer=None):
+    # Affichage interactif : rendu immédiat ; sinon la figure part au pool de rendu s'il existe
+    if renderer is not None and not show_plots:
+        submit_figure(renderer, spec, path)
+    else:
+        render_figure(spec, path, dpi=renderer["dpi"] if renderer is not None else FIGURE_DPI, show=show_plots)
+
+
+def particle_density_map(shape, contour_lists):
+    # Somme des masques pleins des particules, chacun dessiné dans sa boîte englobante
+    density_map = np.zeros(shape, dtype=np.float32)
+    for contours_list in contour_lists:
+        for cnt in contours_list:
+            x, y, w, h = cv2.boundingRect(cnt)
+            mask_temp = np.zeros((h, w), dtype=np.uint8)
+            cv2.drawContours(mask_temp, [cnt], -1, 1, -1, offset=(-x, -y))
+            density_map[y:y + h, x:x + w] += mask_temp
+    return density_map
+
+
+COMPOSITE_TYPE_CODES = (3, 2, 1)
+
+
+def basic_heatmaps_figure(gray_eq: np.ndarray, class_map: np.ndarray, contours_type1, contours_type2, contours_type3):
+    density_map = particle_density_map(gray_eq.shape, [contours_type1, contours_type2, contours_type3])
+    # Équivalent à scipy gaussian_filter(sigma=15, mode="reflect", truncate=4.0), ~4x plus rapide
+    density_smooth = cv2.GaussianBlur(density_map, (121, 121), 15, borderType=cv2.BORDER_REFLECT)
+
+    # Codes 1 (noir) / 2 (gris) / 3 (blanc) lus dans la carte de classes par une LUT, en uint8
+    composite_lut = np.zeros(256, dtype=np.uint8)
+    composite_lut[list(SEGMENTATION_CLASS_VALUES)] = COMPOSITE_TYPE_CODES
+    composite_map = cv2.LUT(class_map, composite_lut)
+
+    return {
+        "name": "heatmaps_base",
+        "figsize": (16, 12),
+        "layout": (2, 2),
+        "panels": [
+            image_panel(
+                gray_eq, "Heat Map: Intensité Raman (0-255)", colorbar={"label": "Intensité"}, cmap="hot", vmin=0, vmax=255
+            ),
+            image_panel(
+                class_map, "Heat Map: Segmentation 3 Types", colorbar={"label": "Type"}, cmap="viridis", vmin=0, vmax=255
+            ),
+            image_panel(
+                density_smooth, "Heat Map: Densité des Particules", colorbar={"label": "Densité"}, cmap="jet", interpolation="bilinear"
+            ),
+            image_panel(
+                composite_map,
+                "Heat Map: Distribution des Types",
+                colorbar={
+                    "kwargs": {"fraction": 0.046, "pad": 0.04, "ticks": [1, 2, 3]},
+                    "yticklabels": ["Type 3\n(Noir)", "Type 2\n(Gris)", "Type 1\n(Blanc)"],
+                },
+                cmap="RdYlBu_r",
+                vmin=0.5,
+                vmax=3.5,
+            ),
+        ],
+    }
+
+
+def parametric_heatmaps_figure(heatmaps, size_col, intensity_col, shape_col):
+    heatmap_size_smooth, heatmap_intensity_smooth, heatmap_shape_smooth = heatmaps
+    title_kwargs = {"fontsize": 13, "fontweight": "bold", "pad": 10}
+    label_kwargs = {"fontsize": 10, "fontweight": "bold"}
+    return {
+        "name": "heatmaps_parametriques_3d",
+        "figsize": (22, 7),
+        "layout": (1, 3),
+        "panels": [
+            image_panel(
+                heatmap_size_smooth,
+                f"Heatmap: TAILLE des Particules\n({size_col})",
+                colorbar={"label": "Taille (px²)", "label_kwargs": label_kwargs},
+                title_kwargs=title_kwargs,
+                cmap="YlOrRd",
+                interpolation="bilinear",
+            ),
+            image_panel(
+                heatmap_intensity_smooth,
+                f"Heatmap: INTENSITÉ des Particules\n({intensity_col})",
+                colorbar={"label": "Intensité (0-255)", "label_kwargs": label_kwargs},
+                title_kwargs=title_kwargs,
+                cmap="plasma",
+                interpolation="bilinear",
+            ),
+            image_panel(
+                heatmap_shape_smooth,
+                f"Heatmap: FORME des Particules\n({shape_col})",
+                colorbar={"label": "Forme (circularité)", "label_kwargs": label_kwargs},
+                title_kwargs=title_kwargs,
+                cmap="viridis",
+                interpolation="bilinear",
+            ),
+        ],
+    }
+
+
+def pivot_heatmaps_figure(pivot_size, pivot_shape, pivot_intensity, pivot_count):
+    ticks = {
+        "xticklabels": (list(pivot_size.columns), {"rotation": 45, "ha": "right", "fontsize": 8}),
+        "yticklabels": ([f"C{cid}" for cid in pivot_size.index], {"fontsize": 9}),
+    }
+    panels = []
+    for pivot, title, cmap in [
+        (pivot_size, "Heatmap: Taille moyenne", "YlOrRd"),
+        (pivot_shape, "Heatmap: Forme moyenne", "viridis"),
+        (pivot_intensity, "Heatmap: Intensité moyenne", "plasma"),
+        (pivot_count, "Heatmap: Nombre de particules", "Blues"),
+    ]:
+        panel = image_panel(pivot.values, title, colorbar={}, title_kwargs={"fontweight": "bold"}, cmap=cmap, aspect="auto")
+        panel["axis_off"] = False
+        panels.append({**panel, **ticks})
+    return {"name": "pivots_heatmaps", "figsize": (18, 12), "layout": (2, 2), "panels": panels}
+
+
+def analysis_detail_figures(
+    img_rgb, gray, gray_eq, class_map, thresh1, thresh2, df_particles, contours_by_type, zone_coords, spatial_index=None
+):
+    # Figures de l'analyse détaillée (hors heatmaps) : images, particules, PCA 3D, zone équilibrée, histogramme
+    x_center, y_center, x_topleft, y_topleft, square_size = zone_coords
+    title13 = {"fontsize": 13, "fontweight": "bold"}
+    figures = [
+        {
+            "name": "images_originales",
+            "figsize": (14, 6),
+            "layout": (1, 2),
+            "panels": [
+                image_panel(img_rgb, "Image Originale (RGB)", title_kwargs=title13),
+                image_panel(gray, "Image en Niveaux de Gris (Intensité Raman)", title_kwargs=title13, cmap="gray"),
+            ],
+        },
+        {
+            "name": "pretraitement_segmentation",
+            "figsize": (16, 5),
+            "layout": (1, 3),
+            "panels": [
+                image_panel(img_rgb, "Image Originale"),
+                image_panel(gray_eq, "Image Améliorée (CLAHE)", cmap="gray"),
+                image_panel(class_map, f"Segmentation (Seuils: {thresh1}, {thresh2})", cmap="gray", vmin=0, vmax=255),
+            ],
+        },
+    ]
+
+    overlay = img_rgb.copy()
+    for contours, color in zip(contours_by_type, [(255, 0, 0), (0, 255, 0), (0, 0, 255)]):
+        cv2.drawContours(overlay, contours, -1, color, 2)
+    type_counts = df_particles["Type"].value_counts()
+    figures.append(
+        {
+            "name": "particules_detectees",
+            "figsize": (16, 7),
+            "layout": (1, 2),
+            "panels": [
+                image_panel(overlay, f"Particules Détectées (Total: {len(df_particles)})"),
+                {
+                    "kind": "bar",
+                    "args": (np.arange(len(type_counts)), type_counts.values),
+                    "kwargs": {"color": ["red", "green", "blue"][:len(type_counts)]},
+                    "xticklabels": (list(type_counts.index), {"rotation": 45, "ha": "right"}),
+                    "ylabel": ("Nombre de particules", {"fontweight": "bold"}),
+                    "title": "Distribution par Type d'Intensité",
+                    "title_kwargs": BOLD_TITLE,
+                    "grid": {"alpha": 0.3, "axis": "y"},
+                },
+            ],
+        }
+    )
+
+    if "PCA_1" in df_particles.columns:
+        pca_xyz = tuple(df_particles[col].to_numpy() for col in ("PCA_1", "PCA_2", "PCA_3"))
+        scatter_kwargs = {"s": 30, "alpha": 0.6, "edgecolors": "black", "linewidth": 0.3}
+        type_colors = {"Type_1_Blanc": 0, "Type_2_Gris": 1, "Type_3_Noir": 2}
+        ptype_to_num = {t: i for i, t in enumerate(df_particles["Particle_Type_Combined"].unique())}
+        pca_colorings = [
+            ("PCA 3D - Cluster", df_particles["Cluster_Combined"], "tab10"),
+            ("PCA 3D - Type Intensité", df_particles["Type"].map(type_colors), "RdYlBu_r"),
+            ("PCA 3D - Type Particule", df_particles["Particle_Type_Combined"].map(ptype_to_num), "tab20"),
+        ]
+        panels = [
+            {
+                "kind": "scatter3d",
+                "projection": "3d",
+                "args": pca_xyz,
+                "kwargs": {"c": colors.to_numpy(), "cmap": cmap, **scatter_kwargs},
+                "title": title,
+                "title_kwargs": BOLD_TITLE,
+            }
+            for title, colors, cmap in pca_colorings
+        ]
+        panels[0]["colorbar"] = {"kwargs": {"label": "Cluster ID", "shrink": 0.6, "pad": 0.1}}
+        figures.append({"name": "pca_3d", "figsize": (18, 6), "layout": (1, 3), "panels": panels})
+
+    cluster_ids = sorted(df_particles["Cluster_Combined"].unique())
+    if spatial_index is None:
+        spatial_index = build_spatial_index(df_particles)
+    in_best_window = spatial_rect_query(
+        spatial_index, x_topleft, y_topleft, x_topleft + square_size, y_topleft + square_size
+    )
+    region_cluster_counts = df_particles["Cluster_Combined"].iloc[in_best_window].value_counts().sort_index()
+    cluster_counts_in_zone = [region_cluster_counts.get(cid, 0) for cid in cluster_ids]
+    zone_panel = image_panel(img_rgb, "Zone Équilibrée (Carré Vert)")
+    zone_panel["overlays"] = [
+        {
+            "kind": "rectangle",
+            "args": ((x_topleft, y_topleft), square_size, square_size),
+            "kwargs": {"linewidth": 4, "edgecolor": "lime", "facecolor": "none"},
+        },
+        {"kind": "plot", "args": (x_center, y_center, "g+"), "kwargs": {"markersize": 25, "markeredgewidth": 4}},
+    ]
+    figures.append(
+        {
+            "name": "zone_equilibree",
+            "figsize": (20, 10),
+            "layout": (1, 2),
+            "panels": [
+                zone_panel,
+                {
+                    "kind": "bar",
+                    "args": (np.arange(len(cluster_ids)), cluster_counts_in_zone),
+                    "cmap_colors": "tab10",
+                    "xticklabels": ([f"Cluster {cid}" for cid in cluster_ids], {}),
+                    "title": "Distribution des clusters (zone)",
+                    "title_kwargs": BOLD_TITLE,
+                    "grid": {"alpha": 0.3, "axis": "y"},
+                },
+            ],
+        }
+    )
+
+    # Histogramme précalculé : seuls 50 comptes partent au rendu, pas tous les pixels
+    counts, edges = np.histogram(gray_eq.ravel(), bins=50)
+    axis_label = {"fontweight": "bold", "fontsize": 12}
+    figures.append(
+        {
+            "name": "histogramme_seuils",
+            "figsize": (12, 6),
+            "layout": (1, 1),
+            "panels": [
+                {
+                    "kind": "hist",
+                    "args": (edges[:-1],),
+                    "kwargs": {"bins": edges, "weights": counts, "color": "gray", "alpha": 0.7, "edgecolor": "black"},
+                    "overlays": [
+                        {
+                            "kind": "axvline",
+                            "args": (thresh1,),
+                            "kwargs": {"color": "blue", "linestyle": "--", "linewidth": 2, "label": f"Seuil Noir-Gris ({thresh1})"},
+                        },
+                        {
+                            "kind": "axvline",
+                            "args": (thresh2,),
+                            "kwargs": {"color": "green", "linestyle": "--", "linewidth": 2, "label": f"Seuil Gris-Blanc ({thresh2})"},
+                        },
+                    ],
+                    "xlabel": ("Intensité (0-255)", axis_label),
+                    "ylabel": ("Nombre de pixels", axis_label),
+                    "legend": True,
+                    "grid": {"alpha": 0.3},
+                }
+            ],
+        }
+    )
+    return figures
+
+
 def generate_basic_heatmaps(
     gray_eq: np.ndarray,
-    segmentation_img: np.ndarray,
+    class_map: np.ndarray,
     contours_type1,
     contours_type2,
     contours_type3,
-    mask_type1,
-    mask_type2,
-    mask_type3,
     output_dir: Path | None = None,
     show_plots: bool = True,
+    renderer=None,
 ):
     print("\n🔥 Génération des heatmaps...\n")
 
-    fig, axes = plt.subplots(2, 2, figsize=(16, 12))
-
-    # Heatmap 1: Intensité Raman
-    ax = axes[0, 0]
-    im1 = ax.imshow(gray_eq, cmap="hot", vmin=0, vmax=255)
-    ax.set_title("Heat Map: Intensité Raman (0-255)", fontsize=12, fontweight="bold")
-    ax.axis("off")
-    plt.colorbar(im1, ax=ax, fraction=0.046, pad=0.04, label="Intensité")
-
-    # Heatmap 2: Segmentation
-    ax = axes[0, 1]
-    im2 = ax.imshow(segmentation_img, cmap="viridis", vmin=0, vmax=255)
-    ax.set_title("Heat Map: Segmentation 3 Types", fontsize=12, fontweight="bold")
-    ax.axis("off")
-    plt.colorbar(im2, ax=ax, fraction=0.046, pad=0.04, label="Type")
-
-    # Heatmap 3: Densité
-    ax = axes[1, 0]
-    density_map = np.zeros_like(gray_eq, dtype=np.float32)
-    for contours_list in [contours_type1, contours_type2, contours_type3]:
-        for cnt in contours_list:
-            mask_temp = np.zeros_like(gray_eq, dtype=np.uint8)
-            cv2.drawContours(mask_temp, [cnt], -1, 1, -1)
-            density_map += mask_temp
-
-    density_smooth = gaussian_filter(density_map, sigma=15)
-    im3 = ax.imshow(density_smooth, cmap="jet", interpolation="bilinear")
-    ax.set_title("Heat Map: Densité des Particules", fontsize=12, fontweight="bold")
-    ax.axis("off")
-    plt.colorbar(im3, ax=ax, fraction=0.046, pad=0.04, label="Densité")
-
-    # Heatmap 4: Distribution types
-    ax = axes[1, 1]
-    composite_map = np.zeros_like(gray_eq, dtype=np.float32)
-    composite_map[mask_type3] = 1.0
-    composite_map[mask_type2] = 2.0
-    composite_map[mask_type1] = 3.0
-
-    im4 = ax.imshow(composite_map, cmap="RdYlBu_r", vmin=0.5, vmax=3.5)
-    ax.set_title("Heat Map: Distribution des Types", fontsize=12, fontweight="bold")
-    ax.axis("off")
-    cbar4 = plt.colorbar(im4, ax=ax, fraction=0.046, pad=0.04, ticks=[1, 2, 3])
-    cbar4.ax.set_yticklabels(["Type 3\n(Noir)", "Type 2\n(Gris)", "Type 1\n(Blanc)"])
-
-    plt.tight_layout()
-    if output_dir is not None:
-        plt.savefig(output_dir / "heatmaps_base.png", dpi=300, bbox_inches="tight", facecolor="white")
-    if show_plots:
-        plt.show()
-    else:
-        plt.close(fig)
+    spec = basic_heatmaps_figure(gray_eq, class_map, contours_type1, contours_type2, contours_type3)
+    emit_figure(spec, output_dir / "heatmaps_base.png" if output_dir is not None else None, show_plots, renderer)
 
     print("✓ Heat maps générées avec succès!")
 
 
+def particle_splat_kernel(radius=30, sigma=15.0, scale=1):
+    # Noyau gaussien tronqué au disque de rayon `radius` (mêmes poids que la boucle
+    # pixel par pixel historique), échantillonné à la résolution de sortie
+    r = int(np.ceil(radius / scale)) - 1
+    offsets = np.arange(-r, r + 1, dtype=np.float32) * scale
+    dist2 = offsets[None, :] ** 2 + offsets[:, None] ** 2
+    kernel = np.exp(-dist2 / (2 * sigma**2))
+    kernel[dist2 >= radius**2] = 0.0
+    return kernel.astype(np.float32)
+
+
+def splat_particle_maps(
+    df_particles: pd.DataFrame,
+    image_shape,
+    value_cols,
+    radius=30,
+    sigma_kernel=15.0,
+    sigma_smooth=10.0,
+    scale=1,
+):
+    # 1) scatter-add des valeurs de toutes les particules sur leur pixel central,
+    # 2) une convolution par le noyau tronqué (cv2.filter2D bascule en DFT pour les grands noyaux),
+    # 3) lissage gaussien final (sigma=10 px). Retourne un tableau (n_canaux, H/scale, W/scale).
+    height = -(-image_shape[0] // scale)
+    width = -(-image_shape[1] // scale)
+    n_channels = len(value_cols)
+    heatmaps = np.zeros((n_channels, height, width), dtype=np.float32)
+    if len(df_particles) == 0:
+        return heatmaps
+
+    rows = df_particles["Center_Y"].to_numpy().astype(np.int64) // scale
+    cols = df_particles["Center_X"].to_numpy().astype(np.int64) // scale
+    flat_idx = rows * width + cols
+
+    kernel = particle_splat_kernel(radius=radius, sigma=sigma_kernel, scale=scale)
+    # Équivalent à scipy gaussian_filter(mode="reflect", truncate=4.0), en float32
+    sigma = sigma_smooth / scale
+    ksize = 2 * int(4.0 * sigma + 0.5) + 1
+    for c, col in enumerate(value_cols):
+        values = df_particles[col].to_numpy(dtype=np.float64)
+        splat = np.bincount(flat_idx, weights=values, minlength=height * width).astype(np.float32)
+        spread = cv2.filter2D(splat.reshape(height, width), -1, kernel, borderType=cv2.BORDER_CONSTANT)
+        heatmaps[c] = cv2.GaussianBlur(spread, (ksize, ksize), sigma, borderType=cv2.BORDER_REFLECT)
+
+    return heatmaps
+
+
+HEATMAP_MAX_SIDE = 2048
+
+
 def generate_parametric_heatmaps(
     df_particles: pd.DataFrame,
     gray_eq: np.ndarray,
     output_dir: Path | None = None,
     show_plots: bool = True,
+    scale: int | None = None,
+    renderer=None,
 ):
     print("\n🔥 GÉNÉRATION DES HEATMAPS PARAMÉTRIQUES")
     print("=" * 80)
 
     size_col, shape_col, intensity_col = resolve_feature_columns(df_particles)
 
-    fig, axes = plt.subplots(1, 3, figsize=(22, 7))
-
-    # HEATMAP 1: TAILLE
-    print("\n📏 Création de la heatmap TAILLE...")
-    ax = axes[0]
-    heatmap_size = np.zeros_like(gray_eq, dtype=np.float32)
-    for _, row in df_particles.iterrows():
-        x, y = int(row["Center_X"]), int(row["Center_Y"])
-        size_value = row[size_col]
-        y_min, y_max = max(0, y - 30), min(gray_eq.shape[0], y + 30)
-        x_min, x_max = max(0, x - 30), min(gray_eq.shape[1], x + 30)
-        for yy in range(y_min, y_max):
-            for xx in range(x_min, x_max):
-                dist = np.sqrt((xx - x) ** 2 + (yy - y) ** 2)
-                if dist < 30:
-                    weight = np.exp(-(dist**2) / (2 * 15**2))
-                    heatmap_size[yy, xx] += size_value * weight
-
-    heatmap_size_smooth = gaussian_filter(heatmap_size, sigma=10)
-    im1 = ax.imshow(heatmap_size_smooth, cmap="YlOrRd", interpolation="bilinear")
-    ax.set_title(f"Heatmap: TAILLE des Particules\n({size_col})", fontsize=13, fontweight="bold", pad=10)
-    ax.axis("off")
-    cbar1 = plt.colorbar(im1, ax=ax, fraction=0.046, pad=0.04)
-    cbar1.set_label("Taille (px²)", fontsize=10, fontweight="bold")
-
-    # HEATMAP 2: INTENSITÉ
-    print("💡 Création de la heatmap INTENSITÉ...")
-    ax = axes[1]
-    heatmap_intensity = np.zeros_like(gray_eq, dtype=np.float32)
-    for _, row in df_particles.iterrows():
-        x, y = int(row["Center_X"]), int(row["Center_Y"])
-        intensity_value = row[intensity_col]
-        y_min, y_max = max(0, y - 30), min(gray_eq.shape[0], y + 30)
-        x_min, x_max = max(0, x - 30), min(gray_eq.shape[1], x + 30)
-        for yy in range(y_min, y_max):
-            for xx in range(x_min, x_max):
-                dist = np.sqrt((xx - x) ** 2 + (yy - y) ** 2)
-                if dist < 30:
-                    weight = np.exp(-(dist**2) / (2 * 15**2))
-                    heatmap_intensity[yy, xx] += intensity_value * weight
-
-    heatmap_intensity_smooth = gaussian_filter(heatmap_intensity, sigma=10)
-    im2 = ax.imshow(heatmap_intensity_smooth, cmap="plasma", interpolation="bilinear")
-    ax.set_title(
-        f"Heatmap: INTENSITÉ des Particules\n({intensity_col})",
-        fontsize=13,
-        fontweight="bold",
-        pad=10,
+    # Résolution de sortie : par défaut, côté max ~HEATMAP_MAX_SIDE px (suffisant pour une figure)
+    if scale is None:
+        scale = max(1, -(-max(gray_eq.shape[:2]) // HEATMAP_MAX_SIDE))
+    elif scale < 1:
+        raise ValueError(f"Facteur de sous-échantillonnage des heatmaps invalide: {scale} (entier ≥ 1)")
+
+    print(f"\n📏💡🔺 Création des heatmaps TAILLE / INTENSITÉ / FORME (résolution 1/{scale})...")
+    heatmaps = splat_particle_maps(
+        df_particles,
+        gray_eq.shape[:2],
+        [size_col, intensity_col, shape_col],
+        scale=scale,
     )
-    ax.axis("off")
-    cbar2 = plt.colorbar(im2, ax=ax, fraction=0.046, pad=0.04)
-    cbar2.set_label("Intensité (0-255)", fontsize=10, fontweight="bold")
-
-    # HEATMAP 3: FORME
-    print("🔺 Création de la heatmap FORME...")
-    ax = axes[2]
-    heatmap_shape = np.zeros_like(gray_eq, dtype=np.float32)
-    for _, row in df_particles.iterrows():
-        x, y = int(row["Center_X"]), int(row["Center_Y"])
-        shape_value = row[shape_col]
-        y_min, y_max = max(0, y - 30), min(gray_eq.shape[0], y + 30)
-        x_min, x_max = max(0, x - 30), min(gray_eq.shape[1], x + 30)
-        for yy in range(y_min, y_max):
-            for xx in range(x_min, x_max):
-                dist = np.sqrt((xx - x) ** 2 + (yy - y) ** 2)
-                if dist < 30:
-                    weight = np.exp(-(dist**2) / (2 * 15**2))
-                    heatmap_shape[yy, xx] += shape_value * weight
-
-    heatmap_shape_smooth = gaussian_filter(heatmap_shape, sigma=10)
-    im3 = ax.imshow(heatmap_shape_smooth, cmap="viridis", interpolation="bilinear")
-    ax.set_title(f"Heatmap: FORME des Particules\n({shape_col})", fontsize=13, fontweight="bold", pad=10)
-    ax.axis("off")
-    cbar3 = plt.colorbar(im3, ax=ax, fraction=0.046, pad=0.04)
-    cbar3.set_label("Forme (circularité)", fontsize=10, fontweight="bold")
-
-    plt.tight_layout()
-    if output_dir is not None:
-        plt.savefig(output_dir / "heatmaps_parametriques_3d.png", dpi=300, bbox_inches="tight", facecolor="white")
-    if show_plots:
-        plt.show()
-    else:
-        plt.close(fig)
+    heatmap_size_smooth, heatmap_intensity_smooth, heatmap_shape_smooth = heatmaps
+
+    spec = parametric_heatmaps_figure(heatmaps, size_col, intensity_col, shape_col)
+    emit_figure(spec, output_dir / "heatmaps_parametriques_3d.png" if output_dir is not None else None, show_plots, renderer)
 
     print("\n" + "=" * 80)
     print("✅ HEATMAPS PARAMÉTRIQUES GÉNÉRÉES!")
@@ -516,11 +1897,14 @@ def generate_parametric_heatmaps(
     print(f"   Heatmap Intensité: Min={heatmap_intensity_smooth.min():.2f} | Max={heatmap_intensity_smooth.max():.2f} | Moy={heatmap_intensity_smooth.mean():.2f}")
     print(f"   Heatmap Forme: Min={heatmap_shape_smooth.min():.2f} | Max={heatmap_shape_smooth.max():.2f} | Moy={heatmap_shape_smooth.mean():.2f}")
 
+    return heatmaps
+
 
 def generate_pivot_heatmaps(
     df_particles: pd.DataFrame,
     output_dir: Path | None = None,
     show_plots: bool = True,
+    renderer=None,
 ):
     print("\n🔥 GÉNÉRATION DES PIVOTS ET HEATMAPS PARAMÉTRIQUES")
     print("=" * 80)
@@ -560,45 +1944,15 @@ def generate_pivot_heatmaps(
         fill_value=0,
     )
 
-    fig, axes = plt.subplots(2, 2, figsize=(18, 12))
-
-    im1 = axes[0, 0].imshow(pivot_size.values, cmap="YlOrRd", aspect="auto")
-    axes[0, 0].set_title("Heatmap: Taille moyenne", fontweight="bold")
-    plt.colorbar(im1, ax=axes[0, 0], fraction=0.046, pad=0.04)
-
-    im2 = axes[0, 1].imshow(pivot_shape.values, cmap="viridis", aspect="auto")
-    axes[0, 1].set_title("Heatmap: Forme moyenne", fontweight="bold")
-    plt.colorbar(im2, ax=axes[0, 1], fraction=0.046, pad=0.04)
-
-    im3 = axes[1, 0].imshow(pivot_intensity.values, cmap="plasma", aspect="auto")
-    axes[1, 0].set_title("Heatmap: Intensité moyenne", fontweight="bold")
-    plt.colorbar(im3, ax=axes[1, 0], fraction=0.046, pad=0.04)
-
-    im4 = axes[1, 1].imshow(pivot_count.values, cmap="Blues", aspect="auto")
-    axes[1, 1].set_title("Heatmap: Nombre de particules", fontweight="bold")
-    plt.colorbar(im4, ax=axes[1, 1], fraction=0.046, pad=0.04)
-
-    for ax in axes.flat:
-        ax.set_xticks(range(len(pivot_size.columns)))
-        ax.set_xticklabels(pivot_size.columns, rotation=45, ha="right", fontsize=8)
-        ax.set_yticks(range(len(pivot_size.index)))
-        ax.set_yticklabels([f"C{cid}" for cid in pivot_size.index], fontsize=9)
-
-    plt.tight_layout()
+    spec = pivot_heatmaps_figure(pivot_size, pivot_shape, pivot_intensity, pivot_count)
+    emit_figure(spec, output_dir / "pivots_heatmaps.png" if output_dir is not None else None, show_plots, renderer)
     if output_dir is not None:
-        plt.savefig(output_dir / "pivots_heatmaps.png", dpi=300, bbox_inches="tight", facecolor="white")
         pivot_size.to_csv(output_dir / "pivot_taille_cluster_type.csv")
         pivot_shape.to_csv(output_dir / "pivot_forme_cluster_type.csv")
         pivot_intensity.to_csv(output_dir / "pivot_intensite_cluster_type.csv")
         pivot_count.to_csv(output_dir / "pivot_count_cluster_type.csv")
         print("✓ Pivots sauvegardés: pivot_*.csv")
 
-    if show_plots:
-        plt.show()
-    else:
-        plt.close(fig)
-
-
 
 def generate_final_report(df_particles: pd.DataFrame):
     size_col, shape_col, intensity_col = resolve_feature_columns(df_particles)
@@ -634,13 +1988,177 @@ def generate_final_report(df_particles: pd.DataFrame):
             print(f"  • {tname}: {count}")
 
 
-def export_results(df_particles: pd.DataFrame, output_dir: Path):
+EXPORT_SUFFIXES = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+CATEGORICAL_COLUMNS = ("Type", "Cluster_Label", "Particle_Type_Combined")
+
+
+def check_export_format(export_format):
+    if export_format not in EXPORT_SUFFIXES:
+        raise ValueError(f"Format d'export inconnu: {export_format} (choix: {', '.join(EXPORT_SUFFIXES)})")
+    if export_format != "csv":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError as e:
+            raise ImportError(f"Le format '{export_format}' nécessite pyarrow (pip install pyarrow)") from e
+
+
+def compact_table(df: pd.DataFrame):
+    # float64 -> float32, int64 -> int32 (si la plage le permet), colonnes texte répétitives -> catégories
+    dtypes = {}
+    int32_info = np.iinfo(np.int32)
+    for col in df.columns:
+        dtype = df[col].dtype
+        if col in CATEGORICAL_COLUMNS:
+            dtypes[col] = "category"
+        elif pd.api.types.is_float_dtype(dtype):
+            dtypes[col] = np.float32
+        elif pd.api.types.is_integer_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+            if len(df) == 0 or (df[col].min() >= int32_info.min and df[col].max() <= int32_info.max):
+                dtypes[col] = np.int32
+    return df.astype(dtypes)
+
+
+def table_path(path: Path, export_format="csv"):
+    return path.parent / f"{path.name}{EXPORT_SUFFIXES[export_format]}"
+
+
+def write_table(df: pd.DataFrame, path: Path, export_format="csv", index=False):
+    # path sans extension ; CSV inchangé, Parquet/Arrow en types compacts
+    output_path = table_path(path, export_format)
+    if export_format == "csv":
+        df.to_csv(output_path, index=index)
+        return output_path
+
+    table = compact_table(df.reset_index() if index else df.reset_index(drop=True))
+    table.columns = [str(col) for col in table.columns]
+    if export_format == "parquet":
+        table.to_parquet(output_path, index=False, compression="zstd")
+    else:
+        # Arrow IPC non compressé : lisible en memory-map sans copie
+        table.to_feather(output_path, compression="uncompressed")
+    return output_path
+
+
+def read_table(path: Path, columns=None):
+    # Lecture pour les outils aval ; Parquet/Arrow ouverts en memory-map
+    suffix = path.suffix.lower()
+    if suffix == ".parquet":
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+    if suffix == ".arrow":
+        from pyarrow import feather
+
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+
+PARTICLE_STORE_NAME = "particle_store"
+
+
+def particle_store_path(results_folder: Path):
+    return results_folder / PARTICLE_STORE_NAME
+
+
+def store_partition_path(store_path: Path, image_id: str):
+    # Partition Hive par image : <store>/image_id=<id encodé>/particles.parquet
+    return store_path / f"image_id={quote(image_id, safe='')}" / "particles.parquet"
+
+
+def write_store_partition(df_particles: pd.DataFrame, store_path: Path, image_id: str):
+    # Chaque image remplace sa propre partition (écriture atomique) : les workers n'écrivent
+    # jamais dans le même fichier et une image retraitée n'est pas dupliquée
+    path = store_partition_path(store_path, image_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Préfixe "." : ignoré par la découverte des fichiers du dataset tant que l'écriture n'est pas finie
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    compact_table(df_particles.reset_index(drop=True)).to_parquet(tmp_path, index=False, compression="zstd")
+    os.replace(tmp_path, path)
+    return path
+
+
+def open_particle_store(results_folder: Path):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([("image_id", pa.string())]), flavor="hive")
+    return ds.dataset(particle_store_path(results_folder), format="parquet", partitioning=partitioning)
+
+
+def particle_store_filter(images=None, types=None, clusters=None):
+    # Le filtre sur image_id ne lit que les partitions concernées ; les autres
+    # conditions s'appuient sur les statistiques Parquet des row groups
+    import pyarrow.dataset as ds
+
+    conditions = []
+    if images is not None:
+        conditions.append(ds.field("image_id").isin([str(image_id) for image_id in images]))
+    if types is not None:
+        conditions.append(ds.field("Type").isin(list(types)))
+    if clusters is not None:
+        conditions.append(ds.field("Cluster_Combined").isin([int(cluster) for cluster in clusters]))
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+def query_particles(results_folder: Path, columns=None, images=None, types=None, clusters=None):
+    # Particules de tout le batch, avec la colonne image_id ; seules les colonnes demandées sont lues
+    dataset = open_particle_store(results_folder)
+    table = dataset.to_table(columns=columns, filter=particle_store_filter(images, types, clusters))
+    return table.to_pandas()
+
+
+def aggregate_particles(
+    results_folder: Path, values, by="image_id", agg="mean", images=None, types=None, clusters=None
+):
+    # Ex. : aggregate_particles(dossier, ["Size_Score"], by=["image_id", "Type"], agg=["mean", "count"])
+    by = [by] if isinstance(by, str) else list(by)
+    values = [values] if isinstance(values, str) else list(values)
+    df = query_particles(results_folder, columns=by + values, images=images, types=types, clusters=clusters)
+    return df.groupby(by, observed=True)[values].agg(agg)
+
+
+# Ordre des colonnes de particles_by_intensity_types (analyse détaillée)
+SINGLE_ANALYSIS_COLUMNS = [
+    "Type",
+    "Area_px2",
+    "Perimeter_px",
+    "Circularity",
+    "AspectRatio",
+    "Solidity",
+    "MeanIntensity",
+    "Center_X",
+    "Center_Y",
+    "Size_Score",
+    "Shape_Score",
+    "Intensity_Score",
+    "Cluster_Combined",
+    "Size_Normalized",
+    "Shape_Normalized",
+    "Intensity_Normalized",
+    "Cluster_3D",
+    "Cluster_Label",
+    "Particle_Type_Combined",
+    "PCA_1",
+    "PCA_2",
+    "PCA_3",
+    "NN_Distance_px",
+    "Local_Density",
+]
+
+
+def export_results(df_particles: pd.DataFrame, output_dir: Path, export_format="csv"):
     output_dir.mkdir(parents=True, exist_ok=True)
 
     size_col, shape_col, intensity_col = resolve_feature_columns(df_particles)
 
-    df_particles.to_csv(output_dir / "particles_by_intensity_types.csv", index=False)
-    df_particles.to_csv(output_dir / "particles_by_intensity_types.csv", index=False)
+    write_table(df_particles, output_dir / "particles_by_intensity_types", export_format)
 
     # Résumé par cluster si disponible
     if "Cluster_Combined" in df_particles.columns:
@@ -656,60 +2174,443 @@ def export_results(df_particles: pd.DataFrame, output_dir: Path):
                 AspectRatio_Mean=("AspectRatio", "mean"),
             )
             .reset_index()
-        df_cluster_summary.to_csv(output_dir / "cluster_detailed_analysis.csv", index=False)
-        df_cluster_summary.to_csv(output_dir / "cluster_detailed_analysis.csv", index=False)
+        )
+        write_table(df_cluster_summary, output_dir / "cluster_detailed_analysis", export_format)
 
     # PCA
-    df_particles[["PCA_1", "PCA_2", "PCA_3"]].to_csv(output_dir / "pca_3d_results.csv", index=False)
-        df_particles[["PCA_1", "PCA_2", "PCA_3"]].to_csv(output_dir / "pca_3d_results.csv", index=False)
+    if "PCA_1" in df_particles.columns:
+        write_table(df_particles[["PCA_1", "PCA_2", "PCA_3"]], output_dir / "pca_3d_results", export_format)
 
     # Crosstab clusters vs intensité
     if "Cluster_Combined" in df_particles.columns and "Type" in df_particles.columns:
-        crosstab_intensity.to_csv(output_dir / "crosstab_clusters_vs_intensity.csv")
-        crosstab_intensity.to_csv(output_dir / "crosstab_clusters_vs_intensity.csv")
+        crosstab_intensity = pd.crosstab(df_particles["Cluster_Combined"], df_particles["Type"])
+        write_table(crosstab_intensity, output_dir / "crosstab_clusters_vs_intensity", export_format, index=True)
 
     # Crosstab clusters vs types physiques
     if "Cluster_Combined" in df_particles.columns and "Particle_Type_Combined" in df_particles.columns:
         crosstab_physical = pd.crosstab(
             df_particles["Cluster_Combined"],
             df_particles["Particle_Type_Combined"],
-        crosstab_physical.to_csv(output_dir / "crosstab_clusters_vs_particle_types.csv")
-        crosstab_physical.to_csv(output_dir / "crosstab_clusters_vs_particle_types.csv")
-    print("\n✓ Résultats exportés")
+        )
+        write_table(crosstab_physical, output_dir / "crosstab_clusters_vs_particle_types", export_format, index=True)
     print("\n✓ Résultats exportés")
-    print("\n✓ Heatmaps paramétriques générées")
-    return df_particles, pca
 
 
-def find_balanced_zone(df_particles: pd.DataFrame, img_rgb: np.ndarray):
-    total_clusters = df_particles["Cluster_Combined"].nunique()
-    global_cluster_counts = df_particles["Cluster_Combined"].value_counts().sort_index()
-    global_cluster_distribution = (global_cluster_counts / len(df_particles)).values
-
-    window_sizes = [300, 400, 500, 600, 700, 800]
-    step_size = 50
+SPATIAL_CELL_SIZE = 64
+
+
+def build_spatial_index(df_particles: pd.DataFrame, cell_size=SPATIAL_CELL_SIZE):
+    # Grille uniforme sur Center_X / Center_Y, construite une fois par image. Stockage CSR :
+    # les particules sont triées par cellule (ligne de grille, puis colonne), donc une bande
+    # de cellules consécutives sur une même ligne est une seule tranche de `order`.
+    coords = df_particles[["Center_X", "Center_Y"]].to_numpy(dtype=np.int64)
+    n_cols = int(coords[:, 0].max()) // cell_size + 1 if len(coords) else 1
+    n_rows = int(coords[:, 1].max()) // cell_size + 1 if len(coords) else 1
+    cell_ids = (coords[:, 1] // cell_size) * n_cols + coords[:, 0] // cell_size
+    order = np.argsort(cell_ids, kind="stable")
+    offsets = np.searchsorted(cell_ids[order], np.arange(n_rows * n_cols + 1))
+    return {"coords": coords, "cell_size": cell_size, "n_cols": n_cols, "n_rows": n_rows, "order": order, "offsets": offsets}
+
+
+def spatial_rect_query(spatial_index, x_min, y_min, x_max, y_max):
+    # Positions (triées) des particules dans [x_min, x_max] × [y_min, y_max], bornes incluses.
+    # Coût : particules des cellules touchées, pas la table entière.
+    cell_size, n_cols = spatial_index["cell_size"], spatial_index["n_cols"]
+    col0, col1 = max(int(x_min) // cell_size, 0), min(int(np.floor(x_max)) // cell_size, n_cols - 1)
+    row0, row1 = max(int(y_min) // cell_size, 0), min(int(np.floor(y_max)) // cell_size, spatial_index["n_rows"] - 1)
+    if x_max < 0 or y_max < 0 or col0 > col1 or row0 > row1:
+        return np.empty(0, dtype=np.int64)
+
+    offsets = spatial_index["offsets"]
+    candidates = np.concatenate([
+        spatial_index["order"][offsets[row * n_cols + col0]:offsets[row * n_cols + col1 + 1]] for row in range(row0, row1 + 1)
+    ])
+    xy = spatial_index["coords"][candidates]
+    inside = (xy[:, 0] >= x_min) & (xy[:, 0] <= x_max) & (xy[:, 1] >= y_min) & (xy[:, 1] <= y_max)
+    return np.sort(candidates[inside])
+
+
+def spatial_radius_query(spatial_index, x, y, radius):
+    # Positions (triées) des particules à une distance <= radius de (x, y)
+    candidates = spatial_rect_query(spatial_index, x - radius, y - radius, x + radius, y + radius)
+    offsets = spatial_index["coords"][candidates] - np.array([x, y])
+    return candidates[(offsets**2).sum(axis=1) <= radius**2]
+
+
+def spatial_knn_query(spatial_index, x, y, k):
+    # k plus proches voisins de (x, y), du plus proche au plus lointain (la particule elle-même
+    # incluse si (x, y) est un centre). Rayon doublé jusqu'à contenir k particules : celles
+    # hors du disque sont forcément plus loin que la k-ième trouvée dedans.
+    n_particles = len(spatial_index["coords"])
+    k = min(k, n_particles)
+    span = spatial_index["cell_size"] * max(spatial_index["n_cols"], spatial_index["n_rows"])
+    radius = spatial_index["cell_size"]
+    while True:
+        candidates = spatial_radius_query(spatial_index, x, y, radius)
+        if len(candidates) >= k or radius > 2 * span + abs(x) + abs(y):
+            break
+        radius *= 2
+    distances = ((spatial_index["coords"][candidates] - np.array([x, y])) ** 2).sum(axis=1)
+    return candidates[np.argsort(distances, kind="stable")[:k]]
+
+
+# Statistiques par type d'intensité, par cluster et par type physique (si classifié)
+SPATIAL_GROUP_COLUMNS = {"by_type": "Type", "by_cluster": "Cluster_Combined", "by_particle_type": "Particle_Type_Combined"}
+
+
+def point_pattern_stats(coords, area, radii=SPATIAL_STATS_RADII, tree=None):
+    # Semis de centres : plus proche voisin, Clark-Evans et Ripley K/L, par requêtes d'arbre k-d
+    # (O(n log n), aucune matrice de distances). Sans correction de bord : biais faible tant
+    # que les rayons restent petits devant l'image.
+    from scipy.spatial import cKDTree
+
+    n_points = len(coords)
+    stats = {"n": n_points, "intensity": n_points / area, "nn_distance": None, "clark_evans": None, "ripley": None}
+    if n_points < 2:
+        return stats, np.full(n_points, np.nan)
+
+    tree = tree if tree is not None else cKDTree(coords)
+    nn_distances = tree.query(coords, k=2)[0][:, 1]
+    # count_neighbors compte les paires ordonnées à distance <= r, (i, i) compris
+    pairs = tree.count_neighbors(tree, np.asarray(radii, dtype=np.float64)) - n_points
+    ripley_k = area * pairs / (n_points * (n_points - 1))
+
+    stats["nn_distance"] = {
+        "mean": float(nn_distances.mean()),
+        "median": float(np.median(nn_distances)),
+        "p10": float(np.percentile(nn_distances, 10)),
+        "p90": float(np.percentile(nn_distances, 90)),
+    }
+    # R < 1 : agrégats, R ≈ 1 : aléatoire (Poisson), R > 1 : répartition régulière
+    stats["clark_evans"] = float(nn_distances.mean() * 2 * np.sqrt(n_points / area))
+    # L(r) = r pour un semis aléatoire ; L(r) > r : agrégation à l'échelle r
+    stats["ripley"] = {
+        "radii": [float(r) for r in radii],
+        "K": ripley_k.tolist(),
+        "L": np.sqrt(ripley_k / np.pi).tolist(),
+    }
+    return stats, nn_distances
+
+
+def spatial_statistics(df_particles: pd.DataFrame, shape, radii=SPATIAL_STATS_RADII, density_radius=LOCAL_DENSITY_RADIUS):
+    # Ajoute NN_Distance_px et Local_Density (particules / 10⁴ px² dans un disque de density_radius)
+    # à la table, et renvoie les statistiques de l'image entière et par groupe
+    from scipy.spatial import cKDTree
+
+    coords = df_particles[["Center_X", "Center_Y"]].to_numpy(dtype=np.float64)
+    area = float(shape[0] * shape[1])
+    tree = cKDTree(coords) if len(coords) else None
+    stats, nn_distances = point_pattern_stats(coords, area, radii, tree)
+
+    df_particles = df_particles.copy()
+    df_particles["NN_Distance_px"] = nn_distances
+    if tree is not None:
+        neighbours = tree.query_ball_point(coords, density_radius, return_length=True) - 1
+        df_particles["Local_Density"] = neighbours / (np.pi * density_radius**2) * 1e4
+    else:
+        df_particles["Local_Density"] = np.empty(0)
+    stats["local_density"] = {
+        "radius": density_radius,
+        "mean": float(df_particles["Local_Density"].mean()) if len(df_particles) else None,
+        "max": float(df_particles["Local_Density"].max()) if len(df_particles) else None,
+    }
+
+    for key, column in SPATIAL_GROUP_COLUMNS.items():
+        if column in df_particles.columns:
+            stats[key] = {
+                str(value): point_pattern_stats(coords[positions], area, radii)[0]
+                for value, positions in df_particles.groupby(column, sort=True, observed=True).indices.items()
+            }
+    return df_particles, stats
+
+
+ZONE_WINDOW_SIZES = (300, 400, 500, 600, 700, 800)
+ZONE_STEP_SIZE = 50
+# Recherche "refine" : grille grossière, puis pas divisé par 2 autour des meilleures fenêtres
+ZONE_COARSE_STEP = 100
+ZONE_REFINE_MIN_STEP = 1
+ZONE_REFINE_SEEDS = 16
+ZONE_TOP_K = 50
+
+
+def finalize_balanced_zone(df_particles, img_rgb, best_window, best_score_overall, candidates):
     img_height, img_width = img_rgb.shape[:2]
+    if best_window is None:
+        best_window = {
+            "x": 0,
+            "y": 0,
+            "size": min(img_height, img_width),
+            "n_particles": len(df_particles),
+            "distribution": df_particles["Cluster_Combined"].value_counts().to_dict(),
+        }
+
+    x_center = best_window["x"] + best_window["size"] // 2
+    y_center = best_window["y"] + best_window["size"] // 2
+    square_size = best_window["size"]
+    x_topleft = best_window["x"]
+    y_topleft = best_window["y"]
+
+    return best_window, best_score_overall, (x_center, y_center, x_topleft, y_topleft, square_size), candidates
 
-    best_score_overall = -np.inf
-    best_window = None
-    candidates = []
 
+def enumerate_zone_windows(img_height, img_width, window_sizes, step_size):
+    # Même ordre de parcours que le balayage de référence : taille, puis y, puis x
+    windows = []
     for window_size in window_sizes:
-        for y in range(0, img_height - window_size, step_size):
-            for x in range(0, img_width - window_size, step_size):
-                x_min, x_max = x, x + window_size
-                y_min, y_max = y, y + window_size
+        ys = np.arange(0, img_height - window_size, step_size)
+        xs = np.arange(0, img_width - window_size, step_size)
+        if len(ys) == 0 or len(xs) == 0:
+            continue
+        grid_y, grid_x = np.meshgrid(ys, xs, indexing="ij")
+        windows.append((window_size, grid_y.ravel(), grid_x.ravel()))
+    return windows
+
+
+def build_cluster_integral(coords, cluster_idx, n_clusters, edges_x, edges_y):
+    # Table de sommes cumulées par cluster : S[i, j, c] = nb de centres du cluster c
+    # dont le bin y est < i et le bin x est < j. Les bords des bins sont exactement
+    # les bords de fenêtres, ce qui conserve les bornes inclusives [x, x + taille].
+    bins_x = np.searchsorted(edges_x, coords[:, 0], side="right")
+    bins_y = np.searchsorted(edges_y, coords[:, 1], side="right")
+    shape = (len(edges_y) + 2, len(edges_x) + 2, n_clusters)
+    flat_idx = ((bins_y + 1) * shape[1] + (bins_x + 1)) * n_clusters + cluster_idx
+    grid = np.bincount(flat_idx, minlength=shape[0] * shape[1] * n_clusters).reshape(shape)
+    return grid.cumsum(axis=0, dtype=np.int32).cumsum(axis=1, dtype=np.int32)
+
+
+def window_cluster_counts(integral, edges_x, edges_y, window_size, ys, xs):
+    # Histogramme de clusters de chaque fenêtre en O(k) : 4 lectures dans la table
+    col0 = np.searchsorted(edges_x, xs) + 1
+    col1 = np.searchsorted(edges_x, xs + window_size + 1) + 1
+    row0 = np.searchsorted(edges_y, ys) + 1
+    row1 = np.searchsorted(edges_y, ys + window_size + 1) + 1
+    return (
+        integral[row1, col1].astype(np.int64)
+        - integral[row0, col1]
+        - integral[row1, col0]
+        + integral[row0, col0]
+    )
 
-                in_window = (
-                    (df_particles["Center_X"] >= x_min)
-                    & (df_particles["Center_X"] <= x_max)
-                    & (df_particles["Center_Y"] >= y_min)
-                    & (df_particles["Center_Y"] <= y_max)
-                )
-                particles_in_window = df_particles[in_window]
 
-                if len(particles_in_window) < total_clusters * 2:
-                    continue
+def score_window_distributions(local_counts, global_cluster_distribution):
+    n_in_window = local_counts.sum(axis=1)
+    local_distribution = local_counts / n_in_window[:, None]
+    total_clusters = local_counts.shape[1]
+
+    # Wasserstein 1D entre deux échantillons de même taille = moyenne des écarts triés
+    wasserstein_dist = np.abs(
+        np.sort(local_distribution, axis=1) - np.sort(global_cluster_distribution)
+    ).mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        max_entropy = -np.log(1.0 / total_clusters)
+        actual_entropy = -(local_distribution * np.log(local_distribution)).sum(axis=1)
+        balance_score = actual_entropy / max_entropy
+
+    min_count_in_cluster = local_counts.min(axis=1)
+    min_proportion_penalty = np.exp(-5.0 / (min_count_in_cluster + 1))
+    similarity_score = 1.0 / (1.0 + wasserstein_dist)
+
+    return (
+        similarity_score * 0.3
+        + balance_score * 0.5
+        + (1.0 - min_proportion_penalty) * 0.2
+    )
+
+
+def score_zone_windows(coords, cluster_idx, global_cluster_distribution, windows):
+    # Fenêtres [(taille, ys, xs)] : histogrammes par table de sommes cumulées dont les bords
+    # sont ceux des fenêtres, puis scores des fenêtres retenues
+    total_clusters = len(global_cluster_distribution)
+    edges_x = np.unique(np.concatenate([np.concatenate((xs, xs + size + 1)) for size, _, xs in windows]))
+    edges_y = np.unique(np.concatenate([np.concatenate((ys, ys + size + 1)) for size, ys, _ in windows]))
+    integral = build_cluster_integral(coords, cluster_idx, total_clusters, edges_x, edges_y)
+
+    local_counts = np.concatenate([
+        window_cluster_counts(integral, edges_x, edges_y, size, ys, xs) for size, ys, xs in windows
+    ])
+    window_x = np.concatenate([xs for _, _, xs in windows])
+    window_y = np.concatenate([ys for _, ys, _ in windows])
+    window_size = np.concatenate([np.full(len(xs), size) for size, _, xs in windows])
+
+    # Fenêtres retenues : assez de particules et tous les clusters présents
+    valid = (local_counts.sum(axis=1) >= total_clusters * 2) & (local_counts > 0).all(axis=1)
+    valid_idx = np.flatnonzero(valid)
+    scores = score_window_distributions(local_counts[valid_idx], global_cluster_distribution)
+    return window_x, window_y, window_size, local_counts, valid_idx, scores
+
+
+def zone_window_record(cluster_ids, x, y, size, counts):
+    return {
+        "x": int(x),
+        "y": int(y),
+        "size": int(size),
+        "n_particles": int(counts.sum()),
+        "distribution": {int(cid): int(count) for cid, count in zip(cluster_ids, counts)},
+    }
+
+
+def find_balanced_zone_integral(
+    df_particles: pd.DataFrame,
+    img_rgb: np.ndarray,
+    window_sizes=ZONE_WINDOW_SIZES,
+    step_size=ZONE_STEP_SIZE,
+    keep_candidates=True,
+    spatial_index=None,
+):
+    cluster_ids, cluster_idx = np.unique(df_particles["Cluster_Combined"].to_numpy(), return_inverse=True)
+    total_clusters = len(cluster_ids)
+    global_cluster_distribution = np.bincount(cluster_idx, minlength=total_clusters) / len(df_particles)
+
+    img_height, img_width = img_rgb.shape[:2]
+    windows = enumerate_zone_windows(img_height, img_width, window_sizes, step_size)
+    if not windows:
+        return finalize_balanced_zone(df_particles, img_rgb, None, -np.inf, [])
+
+    coords = spatial_index["coords"] if spatial_index is not None else df_particles[["Center_X", "Center_Y"]].to_numpy()
+    window_x, window_y, window_size, local_counts, valid_idx, scores = score_zone_windows(
+        coords, cluster_idx, global_cluster_distribution, windows
+    )
+    if len(valid_idx) == 0:
+        return finalize_balanced_zone(df_particles, img_rgb, None, -np.inf, [])
+
+    def window_record(i):
+        return zone_window_record(cluster_ids, window_x[i], window_y[i], window_size[i], local_counts[i])
+
+    candidates = []
+    if keep_candidates:
+        candidates = [{"score": float(score), **window_record(i)} for i, score in zip(valid_idx, scores)]
+
+    best_window = None
+    best_score_overall = -np.inf
+    if not np.isnan(scores).all():
+        best_pos = int(np.nanargmax(scores))
+        best_score_overall = float(scores[best_pos])
+        best_window = window_record(valid_idx[best_pos])
+
+    return finalize_balanced_zone(df_particles, img_rgb, best_window, best_score_overall, candidates)
+
+
+def refine_zone_windows(seeds, step, img_height, img_width, coarse_step, seen):
+    # Voisins non encore évalués des fenêtres graines, décalés de ±step (même taille, mêmes
+    # bornes que la grille : 0 <= x < largeur - taille). Les positions multiples de
+    # coarse_step sont déjà sur la grille grossière.
+    by_size = {}
+    for _, _, (x, y, size), _ in seeds:
+        for dy in (-step, 0, step):
+            for dx in (-step, 0, step):
+                key = (size, int(y) + dy, int(x) + dx)
+                if not (0 <= key[1] < img_height - size and 0 <= key[2] < img_width - size):
+                    continue
+                if (key[1] % coarse_step == 0 and key[2] % coarse_step == 0) or key in seen:
+                    continue
+                seen.add(key)
+                by_size.setdefault(size, []).append(key[1:])
+    return [(size, np.array([y for y, _ in keys]), np.array([x for _, x in keys])) for size, keys in by_size.items()]
+
+
+def find_balanced_zone_refine(
+    df_particles: pd.DataFrame,
+    img_rgb: np.ndarray,
+    window_sizes=ZONE_WINDOW_SIZES,
+    step_size=ZONE_COARSE_STEP,
+    keep_candidates=True,
+    spatial_index=None,
+    min_step=ZONE_REFINE_MIN_STEP,
+    n_seeds=ZONE_REFINE_SEEDS,
+    top_k=ZONE_TOP_K,
+    search_stats=None,
+):
+    # Grille grossière au pas step_size, puis tours d'affinage : pas divisé par 2 autour des
+    # n_seeds meilleures fenêtres jusqu'à min_step (1 = alignement au pixel). Seul un tas
+    # borné des top_k meilleures fenêtres est gardé : il fournit aussi les graines.
+    cluster_ids, cluster_idx = np.unique(df_particles["Cluster_Combined"].to_numpy(), return_inverse=True)
+    global_cluster_distribution = np.bincount(cluster_idx, minlength=len(cluster_ids)) / len(df_particles)
+
+    img_height, img_width = img_rgb.shape[:2]
+    windows = enumerate_zone_windows(img_height, img_width, window_sizes, step_size)
+    seen = set()
+    coords = spatial_index["coords"] if spatial_index is not None else df_particles[["Center_X", "Center_Y"]].to_numpy()
+
+    # Tas min de (score, -ordre, (x, y, taille), histogramme) : à score égal, la première
+    # fenêtre évaluée gagne, comme np.nanargmax
+    heap = []
+    top_k = max(top_k, n_seeds)
+    n_evaluated = n_rounds = 0
+    step = step_size
+    while True:
+        if windows:
+            window_x, window_y, window_size, local_counts, valid_idx, scores = score_zone_windows(
+                coords, cluster_idx, global_cluster_distribution, windows
+            )
+            n_evaluated += len(window_x)
+            n_rounds += 1
+            # Seules les top_k meilleures fenêtres du tour peuvent entrer dans le tas
+            for pos in np.argsort(-scores, kind="stable")[:top_k]:
+                if np.isnan(scores[pos]):
+                    continue
+                i = valid_idx[pos]
+                order = n_evaluated - len(window_x) + int(i)
+                window = (window_x[i], window_y[i], window_size[i])
+                entry = (float(scores[pos]), -order, window, local_counts[i])
+                if len(heap) < top_k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+        if not heap or step <= min_step:
+            break
+        step = max(step // 2, min_step)
+        windows = refine_zone_windows(heapq.nlargest(n_seeds, heap), step, img_height, img_width, step_size, seen)
+
+    if search_stats is not None:
+        search_stats.update({"windows_evaluated": n_evaluated, "rounds": n_rounds, "candidates_kept": len(heap)})
+    if not heap:
+        return finalize_balanced_zone(df_particles, img_rgb, None, -np.inf, [])
+
+    ranked = heapq.nlargest(len(heap), heap)
+    candidates = []
+    if keep_candidates:
+        candidates = [
+            {"score": score, **zone_window_record(cluster_ids, *window, counts)} for score, _, window, counts in ranked
+        ]
+    best_score, _, best_xy, best_counts = ranked[0]
+    return finalize_balanced_zone(
+        df_particles, img_rgb, zone_window_record(cluster_ids, *best_xy, best_counts), best_score, candidates
+    )
+
+
+def find_balanced_zone_scan(
+    df_particles: pd.DataFrame,
+    img_rgb: np.ndarray,
+    window_sizes=ZONE_WINDOW_SIZES,
+    step_size=ZONE_STEP_SIZE,
+    keep_candidates=True,
+    spatial_index=None,
+):
+    from scipy.stats import entropy, wasserstein_distance
+
+    if spatial_index is None:
+        spatial_index = build_spatial_index(df_particles)
+
+    total_clusters = df_particles["Cluster_Combined"].nunique()
+    global_cluster_counts = df_particles["Cluster_Combined"].value_counts().sort_index()
+    global_cluster_distribution = (global_cluster_counts / len(df_particles)).values
+
+    img_height, img_width = img_rgb.shape[:2]
+
+    best_score_overall = -np.inf
+    best_window = None
+    candidates = []
+
+    for window_size in window_sizes:
+        for y in range(0, img_height - window_size, step_size):
+            for x in range(0, img_width - window_size, step_size):
+                x_min, x_max = x, x + window_size
+                y_min, y_max = y, y + window_size
+
+                particles_in_window = df_particles.iloc[spatial_rect_query(spatial_index, x_min, y_min, x_max, y_max)]
+
+                if len(particles_in_window) < total_clusters * 2:
+                    continue
 
                 unique_clusters_in_window = particles_in_window["Cluster_Combined"].nunique()
                 if unique_clusters_in_window == total_clusters:
@@ -732,14 +2633,15 @@ def find_balanced_zone(df_particles: pd.DataFrame, img_rgb: np.ndarray):
                             + (1.0 - min_proportion_penalty) * 0.2
                         )
 
-                        candidates.append({
-                            "score": combined_score,
-                            "x": x,
-                            "y": y,
-                            "size": window_size,
-                            "n_particles": len(particles_in_window),
-                            "distribution": local_cluster_counts.to_dict(),
-                        })
+                        if keep_candidates:
+                            candidates.append({
+                                "score": combined_score,
+                                "x": x,
+                                "y": y,
+                                "size": window_size,
+                                "n_particles": len(particles_in_window),
+                                "distribution": local_cluster_counts.to_dict(),
+                            })
 
                         if combined_score > best_score_overall:
                             best_score_overall = combined_score
@@ -751,111 +2653,912 @@ def find_balanced_zone(df_particles: pd.DataFrame, img_rgb: np.ndarray):
                                 "distribution": local_cluster_counts.to_dict(),
                             }
 
-    if best_window is None:
-        best_window = {
-            "x": 0,
-            "y": 0,
-            "size": min(img_height, img_width),
-            "n_particles": len(df_particles),
-            "distribution": df_particles["Cluster_Combined"].value_counts().to_dict(),
+    return finalize_balanced_zone(df_particles, img_rgb, best_window, best_score_overall, candidates)
+
+
+ZONE_SEARCH_METHODS = {
+    "integral": find_balanced_zone_integral,
+    "scan": find_balanced_zone_scan,
+    "refine": find_balanced_zone_refine,
+}
+
+
+def find_balanced_zone(df_particles: pd.DataFrame, img_rgb: np.ndarray, method="integral", **kwargs):
+    # "integral" : tables de sommes cumulées par cluster, scores vectorisés
+    # "scan" : balayage de référence, une requête d'index spatial par fenêtre
+    # "refine" : grille grossière puis affinage jusqu'au pixel, top-K fenêtres seulement
+    if method not in ZONE_SEARCH_METHODS:
+        raise ValueError(f"Méthode de recherche de zone inconnue: {method} (choix: {', '.join(ZONE_SEARCH_METHODS)})")
+    return ZONE_SEARCH_METHODS[method](df_particles, img_rgb, **kwargs)
+
+
+def check_zone_search_agreement(df_particles: pd.DataFrame, img_rgb: np.ndarray, spatial_index=None):
+    # Compare la recherche grossière → fine à la grille exhaustive (pas ZONE_STEP_SIZE)
+    report = {}
+    for method in ("integral", "refine"):
+        search_stats = {"windows_evaluated": None, "rounds": 1}
+        kwargs = {"search_stats": search_stats} if method == "refine" else {}
+        tracemalloc.start()
+        start = time.perf_counter()
+        best_window, best_score, _, candidates = find_balanced_zone(
+            df_particles, img_rgb, method=method, spatial_index=spatial_index, **kwargs
+        )
+        elapsed = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if method == "integral":
+            img_height, img_width = img_rgb.shape[:2]
+            windows = enumerate_zone_windows(img_height, img_width, ZONE_WINDOW_SIZES, ZONE_STEP_SIZE)
+            search_stats["windows_evaluated"] = sum(len(xs) for _, _, xs in windows)
+        report[method] = {
+            "best_window": {key: best_window[key] for key in ("x", "y", "size", "n_particles")},
+            "score": float(best_score) if np.isfinite(best_score) else None,
+            "time_s": elapsed,
+            "peak_mem_mb": peak_bytes / 1e6,
+            "candidates_kept": len(candidates),
+            **search_stats,
         }
 
-    x_center = best_window["x"] + best_window["size"] // 2
-    y_center = best_window["y"] + best_window["size"] // 2
-    square_size = best_window["size"]
-    x_topleft = best_window["x"]
-    y_topleft = best_window["y"]
+    grid, refine = report["integral"], report["refine"]
+    print("\n🧪 RECHERCHE DE ZONE (grille exhaustive vs grossière → fine)")
+    for label, result in (("grille", grid), ("affinée", refine)):
+        window = result["best_window"]
+        score = f"{result['score']:.4f}" if result["score"] is not None else "n/a"
+        print(
+            f"  • {label}: score {score} | fenêtre ({window['x']}, {window['y']}) {window['size']} px | "
+            f"{result['windows_evaluated']} fenêtres, {result['candidates_kept']} candidates | "
+            f"{result['time_s'] * 1e3:.0f} ms, pic {result['peak_mem_mb']:.1f} Mo"
+        )
+    return report
+
+
+def file_content_hash(path: Path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def pipeline_parameters(
+    detection_method="labels",
+    cluster_mode="fast",
+    tile_size=None,
+    export_format="csv",
+    figure_quality=None,
+    cluster_model_id=None,
+    particle_store=False,
+    zone_method="integral",
+):
+    return {
+        "pipeline_version": PIPELINE_VERSION,
+        "thresh1": SEGMENTATION_THRESH1,
+        "thresh2": SEGMENTATION_THRESH2,
+        "clahe_clip_limit": CLAHE_CLIP_LIMIT,
+        "clahe_tile_grid_size": list(CLAHE_TILE_GRID_SIZE),
+        "morph_kernel_size": list(MORPH_KERNEL_SIZE),
+        "min_area": MIN_PARTICLE_AREA,
+        "detection_method": detection_method,
+        "tile_size": tile_size,
+        "cluster_features": CLUSTER_FEATURE_COLS,
+        "cluster_weights": CLUSTER_FEATURE_WEIGHTS,
+        "k_range": [CLUSTER_K_MIN, CLUSTER_K_MAX],
+        "cluster_mode": cluster_mode,
+        "cluster_model": cluster_model_id,
+        "silhouette_sample": CLUSTER_SILHOUETTE_SAMPLE,
+        "minibatch_threshold": CLUSTER_MINIBATCH_THRESHOLD,
+        "zone_window_sizes": list(ZONE_WINDOW_SIZES),
+        "zone_step_size": ZONE_STEP_SIZE,
+        "zone_method": zone_method,
+        "zone_refine": [ZONE_COARSE_STEP, ZONE_REFINE_MIN_STEP, ZONE_REFINE_SEEDS],
+        "spatial_radii": list(SPATIAL_STATS_RADII),
+        "local_density_radius": LOCAL_DENSITY_RADIUS,
+        "export_format": export_format,
+        "figure_quality": figure_quality,
+        "particle_store": particle_store,
+    }
+
+
+def parameters_hash(params: dict):
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def batch_output_paths(image_path: Path, results_folder: Path, export_format="csv", particle_store=False):
+    image_results_folder = results_folder / image_path.stem
+    if particle_store:
+        particles_path = store_partition_path(particle_store_path(results_folder), image_path.stem)
+    else:
+        particles_path = table_path(image_results_folder / f"{image_path.stem}_particles", export_format)
+    return [particles_path, image_results_folder / f"{image_path.stem}_stats.json"]
+
+
+def load_cache_manifest(results_folder: Path):
+    manifest_path = results_folder / CACHE_MANIFEST_NAME
+    if not manifest_path.exists():
+        return {"images": {}}
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"⚠️  Manifeste de cache illisible, ignoré: {manifest_path}")
+        return {"images": {}}
+
+
+def save_cache_manifest(results_folder: Path, manifest: dict):
+    # Écriture atomique : un batch interrompu ne laisse jamais un manifeste tronqué
+    manifest_path = results_folder / CACHE_MANIFEST_NAME
+    tmp_path = manifest_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+
+def lookup_cached_result(manifest: dict, image_path: Path, results_folder: Path, image_hash: str, params_hash: str):
+    entry = manifest["images"].get(image_path.name)
+    if entry is None or entry["image_hash"] != image_hash or entry["params_hash"] != params_hash:
+        return None
+    if any(not (results_folder / rel_path).exists() for rel_path in entry["outputs"]):
+        return None
+    return entry["result"]
+
+
+def record_cached_result(
+    manifest: dict,
+    image_path: Path,
+    results_folder: Path,
+    image_hash: str,
+    params_hash: str,
+    result: dict,
+    export_format="csv",
+    particle_store=False,
+):
+    # Seuls les résultats complets sont mis en cache ; une erreur sera retentée au prochain run
+    if "✓" in result.get("status", ""):
+        outputs = [
+            str(p.relative_to(results_folder))
+            for p in batch_output_paths(image_path, results_folder, export_format, particle_store)
+        ]
+    elif "⚠️" in result.get("status", ""):
+        outputs = []
+    else:
+        manifest["images"].pop(image_path.name, None)
+        return
+    manifest["images"][image_path.name] = {
+        "image_hash": image_hash,
+        "params_hash": params_hash,
+        "computed_at": datetime.now().isoformat(timespec="seconds"),
+        "outputs": outputs,
+        "result": result,
+    }
+
+
+def invalidate_cache(results_folder: Path, image_names=None):
+    manifest = load_cache_manifest(results_folder)
+    if not image_names:
+        removed = len(manifest["images"])
+        manifest["images"] = {}
+    else:
+        removed = sum(manifest["images"].pop(name, None) is not None for name in image_names)
+    save_cache_manifest(results_folder, manifest)
+    print(f"🗑️  Cache invalidé: {removed} entrée(s) supprimée(s)")
+    return removed
 
-    return best_window, best_score_overall, (x_center, y_center, x_topleft, y_topleft, square_size), candidates
 
+STAGE_ARTIFACTS_DIR = "artifacts"
+STAGE_ARTIFACTS_META = "stage_artifacts.json"
 
-def batch_process_images(image_files, results_folder):
-    print("\n" + "=" * 80)
-    print("🔄 LANCEMENT DU PIPELINE COMPLET SUR TOUTES LES IMAGES")
-    print("=" * 80)
 
-    batch_results = []
-    start_time_global = time.time()
+def artifact_parameters_hash(detection_method="labels", cluster_mode="fast", cluster_model=None):
+    # Seuls les paramètres qui déterminent segmentation, détection, scores et clustering
+    cluster_model_id = cluster_model["id"] if cluster_model is not None else None
+    return parameters_hash(pipeline_parameters(detection_method, cluster_mode, cluster_model_id=cluster_model_id))
 
-    for idx, image_path in enumerate(image_files, 1):
-        print(f"\n{'=' * 80}")
-        print(f"[{idx}/{len(image_files)}] 🔄 {image_path.name}")
-        print(f"{'=' * 80}")
 
-        start_time = time.time()
+def stage_artifacts_dir(results_folder: Path, image_path: Path):
+    return results_folder / image_path.stem / STAGE_ARTIFACTS_DIR
 
-        try:
-            img, img_rgb, gray = process_single_image(image_path)
-            if gray is None:
-                batch_results.append({"image": image_path.name, "status": "❌ Erreur chargement"})
-                continue
 
-            image_name = image_path.stem
-            image_results_folder = results_folder / image_name
-            image_results_folder.mkdir(parents=True, exist_ok=True)
+def save_stage_artifacts(results_folder: Path, image_path: Path, params_hash: str, stages: dict):
+    # Sorties des étapes amont d'une image : CLAHE et carte de classes (.npy), contours (.npz),
+    # particules avec scores et clusters (.pkl, types exacts), k et seuils dans le JSON
+    artifacts_dir = stage_artifacts_dir(results_folder, image_path)
+    artifacts_dir.mkdir(parents=True, exist_ok=True)
+    meta_path = artifacts_dir / STAGE_ARTIFACTS_META
+    # Métadonnées retirées d'abord et réécrites en dernier : un jeu incomplet n'est jamais relu
+    meta_path.unlink(missing_ok=True)
 
-            gray_eq, mask_type1, mask_type2, mask_type3, _, thresh1, thresh2 = preprocess_and_segment(gray)
+    np.save(artifacts_dir / "gray_eq.npy", stages["gray_eq"])
+    np.save(artifacts_dir / "class_map.npy", stages["class_map"])
+    contour_arrays = {}
+    for type_index, contours in enumerate(stages["contours_by_type"]):
+        contour_arrays[f"lengths_{type_index}"] = np.array([len(cnt) for cnt in contours], dtype=np.int64)
+        contour_arrays[f"points_{type_index}"] = (
+            np.concatenate(contours).reshape(-1, 2) if contours else np.empty((0, 2), dtype=np.int32)
+        )
+    np.savez(artifacts_dir / "contours.npz", **contour_arrays)
+    stages["df_particles"].to_pickle(artifacts_dir / "particles.pkl")
+
+    meta = {
+        "image_hash": file_content_hash(image_path),
+        "params_hash": params_hash,
+        "n_clusters": int(stages["n_clusters"]),
+        # None pour les artefacts du batch (pas de clustering 3D)
+        "n_3d_clusters": stages.get("n_3d_clusters"),
+        "thresh1": int(stages["thresh1"]),
+        "thresh2": int(stages["thresh2"]),
+        "computed_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    tmp_path = meta_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, meta_path)
+
+
+def load_stage_artifacts(results_folder: Path, image_path: Path, params_hash: str):
+    # None si absents, incomplets ou calculés sur une autre image / avec d'autres paramètres
+    artifacts_dir = stage_artifacts_dir(results_folder, image_path)
+    meta_path = artifacts_dir / STAGE_ARTIFACTS_META
+    if not meta_path.exists():
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if meta.get("params_hash") != params_hash or meta.get("image_hash") != file_content_hash(image_path):
+        return None
+
+    with np.load(artifacts_dir / "contours.npz") as contour_arrays:
+        contours_by_type = []
+        for type_index in range(len(PARTICLE_TYPE_NAMES)):
+            lengths = contour_arrays[f"lengths_{type_index}"]
+            points = contour_arrays[f"points_{type_index}"].reshape(-1, 1, 2)
+            contours_by_type.append(np.split(points, np.cumsum(lengths)[:-1]) if len(lengths) else [])
+    return {
+        # memory-map : les pages déjà en cache disque (écrites par le batch) ne sont pas recopiées
+        "gray_eq": np.load(artifacts_dir / "gray_eq.npy", mmap_mode="r"),
+        "class_map": np.load(artifacts_dir / "class_map.npy", mmap_mode="r"),
+        "contours_by_type": contours_by_type,
+        "df_particles": pd.read_pickle(artifacts_dir / "particles.pkl"),
+        "n_clusters": meta["n_clusters"],
+        "n_3d_clusters": meta.get("n_3d_clusters"),
+        "thresh1": meta["thresh1"],
+        "thresh2": meta["thresh2"],
+    }
+
+
+def process_memory_kb():
+    # (RSS courant, pic RSS) en Ko ; Linux : /proc/self/status, sinon ru_maxrss (pic seul), sinon None
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None, peak
+
+
+def reset_peak_memory():
+    # Linux : ramène le pic RSS (VmHWM) au niveau courant pour mesurer le pic d'une seule étape
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def timed_stage(timings: dict, name: str, snapshots: dict | None = None, background=False):
+    # Temps mur, temps CPU et pic mémoire d'une étape ; l'appelant renseigne stage["items"].
+    # background=True (thread lecteur / écrivain) : temps CPU du thread seul, pas de pic mémoire
+    # (partagé avec le calcul, dont il ne faut pas remettre le pic à zéro)
+    stage = {"items": None}
+    cpu_clock = time.thread_time if background else time.process_time
+    rss_start, peak_start = (None, None) if background else process_memory_kb()
+    if not background and reset_peak_memory():
+        peak_start = rss_start
+    if not background and tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    wall_start, cpu_start = time.perf_counter(), cpu_clock()
+    try:
+        yield stage
+    finally:
+        wall_s, cpu_s = time.perf_counter() - wall_start, cpu_clock() - cpu_start
+        _, peak_end = (None, None) if background else process_memory_kb()
+        timings[name] = {
+            "wall_s": round(wall_s, 6),
+            "cpu_s": round(cpu_s, 6),
+            "peak_mem_delta_mb": round((peak_end - peak_start) / 1024, 2) if peak_start is not None else None,
+            "items": stage["items"],
+        }
+        # Mode --profile : pic tracemalloc et allocations vivantes en fin d'étape
+        if not background and tracemalloc.is_tracing():
+            timings[name]["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+            if snapshots is not None:
+                snapshots[name] = tracemalloc.take_snapshot()
+
+
+def print_stage_timings(timings: dict):
+    total = sum(t["wall_s"] for t in timings.values()) or 1.0
+    print(f"\n⏱️  {'Étape':<15} {'mur (s)':>9} {'CPU (s)':>9} {'Δ pic (Mo)':>11} {'éléments':>10}  part")
+    for name, t in timings.items():
+        peak = f"{t['peak_mem_delta_mb']:.1f}" if t["peak_mem_delta_mb"] is not None else "-"
+        items = t["items"] if t["items"] is not None else "-"
+        print(f"   {name:<15} {t['wall_s']:9.3f} {t['cpu_s']:9.3f} {peak:>11} {items:>10}  {t['wall_s'] / total:5.1%}")
+
+
+def sample_model_particles(image_path: Path, detection_method="labels", tile_size=None, quota=None):
+    # Phase 1 du mode "shared" : détection + scores, puis échantillon stratifié par type d'intensité
+    if tile_size:
+        df_particles, _, _, _, _ = extract_particles_tiled(load_gray_image(image_path), tile_size=tile_size)
+    else:
+        _, _, gray = process_single_image(image_path)
+        if gray is None:
+            return pd.DataFrame(columns=CLUSTER_FEATURE_COLS + ["Type"])
+        gray_eq, class_map, _, _ = preprocess_and_segment(gray)
+        df_particles, _, _, _ = extract_particles(gray_eq, class_map, method=detection_method)
+    if len(df_particles) == 0:
+        return pd.DataFrame(columns=CLUSTER_FEATURE_COLS + ["Type"])
+
+    df_particles = add_scores(df_particles)[CLUSTER_FEATURE_COLS + ["Type"]]
+    if quota is not None and len(df_particles) > quota:
+        df_particles = df_particles.groupby("Type", group_keys=False).sample(
+            frac=quota / len(df_particles), random_state=42
+        )
+    return df_particles
 
-            features_type1, _ = detect_particles_in_mask(mask_type1, gray_eq, "Type_1_Blanc")
-            features_type2, _ = detect_particles_in_mask(mask_type2, gray_eq, "Type_2_Gris")
-            features_type3, _ = detect_particles_in_mask(mask_type3, gray_eq, "Type_3_Noir")
 
-            df_particles_img = pd.DataFrame(features_type1 + features_type2 + features_type3)
-            n_particles = len(df_particles_img)
+def prepare_shared_cluster_model(
+    image_files, model_path: Path, detection_method="labels", tile_size=None, workers=1, refit=False
+):
+    # Réutilise le modèle sauvegardé s'il est compatible, sinon l'ajuste sur un échantillon
+    # borné : au plus SHARED_MODEL_MAX_IMAGES images réparties sur le batch, quota égal par image
+    if model_path.exists() and not refit:
+        model = load_cluster_model(model_path)
+        if model is not None:
+            print(f"♻️  Modèle de clustering partagé réutilisé: k={model['k']}, id {model['id']} ({model_path})")
+            return model
+    if not image_files:
+        print("❌ Aucune image pour ajuster le modèle de clustering partagé.")
+        return None
+
+    start = time.time()
+    n_sampled = min(len(image_files), SHARED_MODEL_MAX_IMAGES)
+    sampled = [image_files[i] for i in np.unique(np.linspace(0, len(image_files) - 1, n_sampled).round().astype(int))]
+    quota = -(-SHARED_MODEL_SAMPLE // len(sampled))
+    print(f"\n🧮 Modèle de clustering partagé: échantillon de {len(sampled)} image(s), ≤ {quota} particules par image")
+
+    if workers > 1 and len(sampled) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(sampled)), initializer=init_batch_worker) as executor:
+            samples = list(
+                executor.map(
+                    sample_model_particles,
+                    sampled,
+                    [detection_method] * len(sampled),
+                    [tile_size] * len(sampled),
+                    [quota] * len(sampled),
+                )
+            )
+    else:
+        samples = [sample_model_particles(path, detection_method, tile_size, quota) for path in sampled]
 
-            if n_particles >= 5:
+    model = fit_shared_cluster_model(pd.concat(samples, ignore_index=True), [path.name for path in sampled])
+    save_cluster_model(model, model_path)
+    print(
+        f"✓ Modèle ajusté sur {model['n_sample']} particules: k={model['k']}, id {model['id']} "
+        f"({time.time() - start:.2f}s) → {model_path}"
+    )
+    return model
+
+
+def process_batch_image(
+    image_path: Path,
+    results_folder: Path,
+    detection_method="labels",
+    cluster_mode="fast",
+    tile_size=None,
+    export_format="csv",
+    snapshots=None,
+    figure_quality=None,
+    cluster_model=None,
+    particle_store=False,
+    keep_artifacts=False,
+    zone_method="integral",
+    decoded=None,
+    writer=None,
+):
+    # decoded : future du thread lecteur (image déjà décodée) ; writer : thread d'écriture
+    # des sorties, le résultat porte alors la future de l'écriture ("write")
+    if tile_size:
+        check_tiled_options(detection_method)
+    elif image_path.suffix.lower() == ".npy":
+        return {"image": image_path.name, "status": "❌ Erreur: fichier .npy lu uniquement en mode tuilé (--tile-size)"}
+    start_time = time.time()
+    timings = {}
+
+    try:
+        with timed_stage(timings, "load", snapshots) as stage:
+            if decoded is not None:
+                # L'étape ne mesure que l'attente du lecteur ; son décodage est l'étape "decode"
+                gray, timings["decode"] = decoded.result()
+            elif tile_size:
+                # Mosaïques : seule l'image en niveaux de gris est chargée, le reste est calculé par tuile
+                gray = load_gray_image(image_path)
+            else:
+                img, img_rgb, gray = process_single_image(image_path)
+            stage["items"] = int(gray.shape[0] * gray.shape[1]) if gray is not None else 0
+        if gray is None:
+            return {"image": image_path.name, "status": "❌ Erreur chargement"}
+
+        image_name = image_path.stem
+        image_results_folder = results_folder / image_name
+        image_results_folder.mkdir(parents=True, exist_ok=True)
+
+        thresh1, thresh2 = SEGMENTATION_THRESH1, SEGMENTATION_THRESH2
+        if tile_size:
+            # CLAHE, segmentation et détection sont fusionnées tuile par tuile
+            with timed_stage(timings, "detection", snapshots) as stage:
+                df_particles_img, _, _, _, pixel_counts = extract_particles_tiled(gray, tile_size=tile_size)
+                stage["items"] = len(df_particles_img)
+        else:
+            with timed_stage(timings, "segmentation", snapshots) as stage:
+                gray_eq, class_map, thresh1, thresh2 = preprocess_and_segment(gray)
+                stage["items"] = int(gray_eq.size)
+            with timed_stage(timings, "detection", snapshots) as stage:
+                df_particles_img, contours_type1, contours_type2, contours_type3 = extract_particles(
+                    gray_eq, class_map, method=detection_method
+                )
+                stage["items"] = len(df_particles_img)
+            pixel_counts = class_pixel_counts(class_map)
+
+        n_particles = len(df_particles_img)
+        type_counts = df_particles_img["Type"].value_counts() if n_particles else pd.Series(dtype=int)
+
+        if n_particles >= 5:
+            with timed_stage(timings, "scoring", snapshots) as stage:
                 df_particles_img = add_scores(df_particles_img)
-                df_particles_img, n_clusters = cluster_weighted(df_particles_img)
-
-                csv_path = image_results_folder / f"{image_name}_particles.csv"
-                df_particles_img.to_csv(csv_path, index=False)
-
-                stats = {
-                    "image_name": image_path.name,
-                    "dimensions": {"width": gray.shape[1], "height": gray.shape[0]},
-                    "segmentation": {
-                        "blanc_pixels": int(np.sum(mask_type1)),
-                        "gris_pixels": int(np.sum(mask_type2)),
-                        "noir_pixels": int(np.sum(mask_type3)),
-                        "thresh1": int(thresh1),
-                        "thresh2": int(thresh2),
-                    },
-                    "particles": {
-                        "total": n_particles,
-                        "blanc": len(features_type1),
-                        "gris": len(features_type2),
-                        "noir": len(features_type3),
-                    },
-                    "clustering": {
-                        "n_clusters": n_clusters,
-                        "distribution": df_particles_img["Cluster_Combined"].value_counts().to_dict(),
-                    },
+                stage["items"] = n_particles
+            with timed_stage(timings, "clustering", snapshots) as stage:
+                df_particles_img, n_clusters = cluster_weighted(df_particles_img, mode=cluster_mode, model=cluster_model)
+                stage["items"] = n_particles
+            with timed_stage(timings, "zone_search", snapshots) as stage:
+                best_window, best_score, _, _ = find_balanced_zone(
+                    df_particles_img, gray, method=zone_method, keep_candidates=False
+                )
+                stage["items"] = n_particles
+            with timed_stage(timings, "spatial", snapshots) as stage:
+                df_particles_img, spatial_stats = spatial_statistics(df_particles_img, gray.shape[:2])
+                stage["items"] = n_particles
+
+            figures = []
+            if figure_quality is not None:
+                # Seules les specs (tableaux + métadonnées) sont construites ici ; le rendu PNG
+                # est fait par le pool de rendu du processus principal
+                with timed_stage(timings, "figures", snapshots) as stage:
+                    specs = []
+                    if not tile_size:
+                        specs.append(
+                            basic_heatmaps_figure(gray_eq, class_map, contours_type1, contours_type2, contours_type3)
+                        )
+                    size_col, shape_col, intensity_col = resolve_feature_columns(df_particles_img)
+                    heatmaps = splat_particle_maps(
+                        df_particles_img,
+                        gray.shape[:2],
+                        [size_col, intensity_col, shape_col],
+                        scale=max(1, -(-max(gray.shape[:2]) // HEATMAP_MAX_SIDE)),
+                    )
+                    specs.append(parametric_heatmaps_figure(heatmaps, size_col, intensity_col, shape_col))
+                    max_side = FIGURE_QUALITIES[figure_quality]["max_side"]
+                    figures = [
+                        (preview_figure_spec(spec, max_side), image_results_folder / f"{image_name}_{spec['name']}.png")
+                        for spec in specs
+                    ]
+                    stage["items"] = len(figures)
+
+            _, json_path = batch_output_paths(image_path, results_folder, export_format, particle_store)
+            artifacts = None
+            if keep_artifacts and not tile_size:
+                # Reprises par l'analyse détaillée de la même image
+                artifacts = {
+                    "gray_eq": gray_eq,
+                    "class_map": class_map,
+                    "contours_by_type": (contours_type1, contours_type2, contours_type3),
+                    "df_particles": df_particles_img,
+                    "n_clusters": n_clusters,
+                    "thresh1": thresh1,
+                    "thresh2": thresh2,
                 }
 
-                json_path = image_results_folder / f"{image_name}_stats.json"
-                with open(json_path, "w", encoding="utf-8") as f:
-                    json.dump(stats, f, indent=2)
-
-                elapsed = time.time() - start_time
-                batch_results.append({
-                    "image": image_path.name,
-                    "status": "✓ Succès",
-                    "particles": n_particles,
-                    "clusters": n_clusters,
-                    "time_s": elapsed,
-                })
-            else:
-                batch_results.append({
-                    "image": image_path.name,
-                    "status": "⚠️  Trop peu de particules",
-                    "particles": n_particles,
-                })
-
-        except Exception as e:
-            batch_results.append({
+            stats = {
+                "image_name": image_path.name,
+                "dimensions": {"width": gray.shape[1], "height": gray.shape[0]},
+                "segmentation": {
+                    "blanc_pixels": pixel_counts["Type_1_Blanc"],
+                    "gris_pixels": pixel_counts["Type_2_Gris"],
+                    "noir_pixels": pixel_counts["Type_3_Noir"],
+                    "thresh1": int(thresh1),
+                    "thresh2": int(thresh2),
+                },
+                "particles": {
+                    "total": n_particles,
+                    "blanc": int(type_counts.get("Type_1_Blanc", 0)),
+                    "gris": int(type_counts.get("Type_2_Gris", 0)),
+                    "noir": int(type_counts.get("Type_3_Noir", 0)),
+                },
+                "clustering": {
+                    "n_clusters": n_clusters,
+                    "distribution": df_particles_img["Cluster_Combined"].value_counts().to_dict(),
+                },
+                "balanced_zone": {
+                    "x": best_window["x"],
+                    "y": best_window["y"],
+                    "size": best_window["size"],
+                    "n_particles": best_window["n_particles"],
+                    "score": float(best_score) if np.isfinite(best_score) else None,
+                },
+                "spatial": spatial_stats,
+                "timings": timings,
+            }
+
+            outputs = {
+                "image_path": image_path,
+                "results_folder": results_folder,
+                "df_particles": df_particles_img,
+                "export_format": export_format,
+                "particle_store": particle_store,
+                "artifacts": artifacts,
+                "artifacts_hash": artifact_parameters_hash(detection_method, cluster_mode, cluster_model),
+                "stats": stats,
+                "json_path": json_path,
+            }
+            result = {
                 "image": image_path.name,
-                "status": f"❌ Erreur: {str(e)}",
-            })
+                "status": "✓ Succès",
+                "particles": n_particles,
+                "clusters": n_clusters,
+                "time_s": None,
+                "timings": timings,
+                "figures": figures,
+            }
+            if writer is not None:
+                # time_s est complété par le thread d'écriture, une fois les sorties écrites
+                result["write"] = writer.submit(write_batch_outputs, outputs, timings, result, start_time, background=True)
+                return result
+            write_batch_outputs(outputs, timings, result, start_time, snapshots)
+            return result
+        return {
+            "image": image_path.name,
+            "status": "⚠️  Trop peu de particules",
+            "particles": n_particles,
+            "time_s": time.time() - start_time,
+            "timings": timings,
+        }
+
+    except Exception as e:
+        return {
+            "image": image_path.name,
+            "status": f"❌ Erreur: {str(e)}",
+            "timings": timings,
+        }
+
+
+def write_batch_outputs(outputs: dict, timings: dict, result: dict, start_time: float, snapshots=None, background=False):
+    # Sorties d'une image : particules (table ou partition du store), artefacts, puis
+    # *_stats.json en dernier (il contient le temps de l'étape export)
+    image_path, results_folder = outputs["image_path"], outputs["results_folder"]
+    df_particles = outputs["df_particles"]
+    with timed_stage(timings, "export", snapshots, background=background) as stage:
+        if outputs["particle_store"]:
+            write_store_partition(df_particles, particle_store_path(results_folder), image_path.stem)
+        else:
+            particles_path = results_folder / image_path.stem / f"{image_path.stem}_particles"
+            write_table(df_particles, particles_path, outputs["export_format"])
+        if outputs["artifacts"] is not None:
+            save_stage_artifacts(results_folder, image_path, outputs["artifacts_hash"], outputs["artifacts"])
+        stage["items"] = len(df_particles)
+
+    with open(outputs["json_path"], "w", encoding="utf-8") as f:
+        json.dump(outputs["stats"], f, indent=2)
+    result["time_s"] = time.time() - start_time
+    return result
+
+
+def profile_batch_image(image_path: Path, results_folder: Path, profile_dir: Path, **batch_kwargs):
+    # Réexécution instrumentée d'une image : cProfile + tracemalloc (≈3x plus lent, réservé aux images lentes)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    snapshots = {}
+    profiler = cProfile.Profile()
+
+    tracemalloc.start(10)
+    profiler.enable()
+    try:
+        result = process_batch_image(image_path, results_folder, snapshots=snapshots, **batch_kwargs)
+    finally:
+        profiler.disable()
+        tracemalloc.stop()
+
+    stem = image_path.stem
+    profiler.dump_stats(str(profile_dir / f"{stem}.prof"))
+    with open(profile_dir / f"{stem}_cprofile.txt", "w", encoding="utf-8") as f:
+        pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+
+    with open(profile_dir / f"{stem}_tracemalloc.txt", "w", encoding="utf-8") as f:
+        for name, timing in result.get("timings", {}).items():
+            f.write(f"=== {name}: pic tracemalloc {timing.get('traced_peak_mb')} Mo, {timing['wall_s']:.3f} s\n")
+            if name in snapshots:
+                for stat in snapshots[name].statistics("lineno")[:10]:
+                    f.write(f"  {stat}\n")
+            f.write("\n")
+
+    return result
+
+
+def init_batch_worker():
+    # Un processus par image : limiter chaque worker à un thread BLAS/OpenMP/OpenCV
+    # pour éviter la sur-souscription des cœurs.
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(limits=1)
+    cv2.setNumThreads(1)
+    # sklearn (et son runtime OpenMP) n'est chargé qu'à la première image :
+    # threadpool_limits ne le voit pas encore, la variable d'environnement prend le relais.
+    os.environ["OMP_NUM_THREADS"] = "1"
+    use_headless_backend()
+    setup_warnings()
+
+
+def iter_batch_parallel(
+    image_files,
+    results_folder,
+    detection_method,
+    cluster_mode,
+    workers,
+    tile_size=None,
+    export_format="csv",
+    figure_quality=None,
+    cluster_model=None,
+    particle_store=False,
+    artifact_images=frozenset(),
+    zone_method="integral",
+):
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker) as executor:
+        futures = {
+            executor.submit(
+                process_batch_image,
+                image_path,
+                results_folder,
+                detection_method,
+                cluster_mode,
+                tile_size,
+                export_format,
+                figure_quality=figure_quality,
+                cluster_model=cluster_model,
+                particle_store=particle_store,
+                keep_artifacts=image_path.name in artifact_images,
+                zone_method=zone_method,
+            ): idx
+            for idx, image_path in enumerate(image_files)
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # Crash du worker lui-même (mémoire, processus tué...) : isolé à cette image
+                result = {"image": image_files[idx].name, "status": f"❌ Erreur: {str(e)}"}
+            yield idx, result
+
+
+def decode_batch_image(image_path: Path, tile_size=None):
+    # Étape du thread lecteur : même décodage que process_batch_image
+    timings = {}
+    with timed_stage(timings, "decode", background=True) as stage:
+        if tile_size:
+            gray = load_gray_image(image_path)
+        else:
+            _, _, gray = process_single_image(image_path)
+        stage["items"] = int(gray.shape[0] * gray.shape[1]) if gray is not None else 0
+    return gray, timings["decode"]
+
+
+def iter_decoded_images(image_files, tile_size=None, prefetch=PIPELINE_DEPTH):
+    # Lecteur : décodage dans un thread, dans l'ordre des fichiers, avec au plus `prefetch`
+    # images décodées d'avance (mémoire bornée). cv2.imread libère le GIL.
+    files_iter = iter(image_files)
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        pending = deque(reader.submit(decode_batch_image, path, tile_size) for path in islice(files_iter, prefetch))
+        for image_path in image_files:
+            decoded = pending.popleft()
+            next_path = next(files_iter, None)
+            if next_path is not None:
+                pending.append(reader.submit(decode_batch_image, next_path, tile_size))
+            yield image_path, decoded
+
+
+def finish_batch_write(image_path: Path, result: dict, write=None):
+    # Attend l'écriture d'une image ; une erreur d'écriture devient le statut de l'image
+    if write is None:
+        return result
+    try:
+        return write.result()
+    except Exception as e:
+        return {"image": image_path.name, "status": f"❌ Erreur: {str(e)}", "timings": result.get("timings", {})}
+
+
+def iter_batch_serial(
+    image_files,
+    results_folder,
+    detection_method,
+    cluster_mode,
+    tile_size=None,
+    export_format="csv",
+    figure_quality=None,
+    cluster_model=None,
+    particle_store=False,
+    artifact_images=frozenset(),
+    zone_method="integral",
+    pipeline_depth=PIPELINE_DEPTH,
+):
+    # Pipeline lecteur → calcul → écrivain : décodage des images suivantes et écriture des
+    # précédentes pendant le calcul de la courante. Les deux files sont bornées à
+    # pipeline_depth images ; les résultats sortent dans l'ordre, une fois écrits.
+    if pipeline_depth > 0:
+        images = iter_decoded_images(image_files, tile_size, pipeline_depth)
+        writer = ThreadPoolExecutor(max_workers=1)
+    else:
+        images = ((image_path, None) for image_path in image_files)
+        writer = None
+    writes = deque()
+    try:
+        for idx, (image_path, decoded) in enumerate(images):
+            print(f"\n{'=' * 80}")
+            print(f"[{idx + 1}/{len(image_files)}] 🔄 {image_path.name}")
+            print(f"{'=' * 80}")
+            result = process_batch_image(
+                image_path,
+                results_folder,
+                detection_method,
+                cluster_mode,
+                tile_size,
+                export_format,
+                figure_quality=figure_quality,
+                cluster_model=cluster_model,
+                particle_store=particle_store,
+                keep_artifacts=image_path.name in artifact_images,
+                zone_method=zone_method,
+                decoded=decoded,
+                writer=writer,
+            )
+            writes.append((idx, image_path, result, result.pop("write", None)))
+            # File d'écriture pleine : le calcul attend l'écrivain ; sinon seules les écritures
+            # déjà terminées sont rendues
+            while writes and (len(writes) > pipeline_depth or writes[0][3] is None or writes[0][3].done()):
+                done_idx, done_path, done_result, write = writes.popleft()
+                yield done_idx, finish_batch_write(done_path, done_result, write)
+        while writes:
+            done_idx, done_path, done_result, write = writes.popleft()
+            yield done_idx, finish_batch_write(done_path, done_result, write)
+    finally:
+        if writer is not None:
+            writer.shutdown()
+
+
+def batch_process_images(
+    image_files,
+    results_folder,
+    detection_method="labels",
+    cluster_mode="fast",
+    workers=1,
+    use_cache=True,
+    tile_size=None,
+    export_format="csv",
+    profile=0,
+    renderer=None,
+    cluster_model=None,
+    particle_store=False,
+    artifact_images=frozenset(),
+    zone_method="integral",
+    pipeline_depth=PIPELINE_DEPTH,
+):
+    # artifact_images : noms des images dont les sorties d'étapes sont conservées pour l'analyse détaillée
+    print("\n" + "=" * 80)
+    print("🔄 LANCEMENT DU PIPELINE COMPLET SUR TOUTES LES IMAGES")
+    print("=" * 80)
+
+    start_time_global = time.time()
+    batch_results = [None] * len(image_files)
+    timing_rows = []
+
+    # Cache : clé = hash du contenu de l'image + hash des paramètres du pipeline
+    manifest = load_cache_manifest(results_folder)
+    figure_quality = renderer["quality"] if renderer is not None else None
+    cluster_model_id = cluster_model["id"] if cluster_model is not None else None
+    params = pipeline_parameters(
+        detection_method,
+        cluster_mode,
+        tile_size,
+        export_format,
+        figure_quality,
+        cluster_model_id,
+        particle_store,
+        zone_method,
+    )
+    params_hash = parameters_hash(params)
+    manifest["parameters"] = params
+    image_hashes = {}
+    pending = []
+    for idx, image_path in enumerate(image_files):
+        image_hashes[idx] = file_content_hash(image_path)
+        cached = lookup_cached_result(manifest, image_path, results_folder, image_hashes[idx], params_hash) if use_cache else None
+        if cached is not None:
+            batch_results[idx] = {**cached, "cached": True}
+        else:
+            pending.append(idx)
+
+    n_cached = len(image_files) - len(pending)
+    if n_cached:
+        print(f"♻️  {n_cached} image(s) inchangée(s) reprise(s) du cache")
+
+    pending_files = [image_files[idx] for idx in pending]
+    parallel = workers > 1 and len(pending_files) > 1
+    if parallel:
+        workers = min(workers, len(pending_files))
+        print(f"⚙️  Mode parallèle: {workers} processus")
+        results_iter = iter_batch_parallel(
+            pending_files,
+            results_folder,
+            detection_method,
+            cluster_mode,
+            workers,
+            tile_size,
+            export_format,
+            figure_quality,
+            cluster_model,
+            particle_store,
+            artifact_images,
+            zone_method,
+        )
+    else:
+        results_iter = iter_batch_serial(
+            pending_files,
+            results_folder,
+            detection_method,
+            cluster_mode,
+            tile_size,
+            export_format,
+            figure_quality,
+            cluster_model,
+            particle_store,
+            artifact_images,
+            zone_method,
+            pipeline_depth,
+        )
+
+    for n_done, (pending_idx, result) in enumerate(results_iter, 1):
+        idx = pending[pending_idx]
+        # Les temps par étape vont dans la table de timing, pas dans le résumé ni le cache
+        for stage_name, timing in result.pop("timings", {}).items():
+            timing_rows.append({"image": image_files[idx].name, "stage": stage_name, **timing})
+        # Figures rendues en arrière-plan pendant le traitement des images suivantes
+        for spec, path in result.pop("figures", []):
+            submit_figure(renderer, spec, path)
+        batch_results[idx] = result
+        if parallel:
+            print(f"[{n_done}/{len(pending_files)}] {result['status']} {image_files[idx].name}")
+        record_cached_result(
+            manifest, image_files[idx], results_folder, image_hashes[idx], params_hash, result, export_format, particle_store
+        )
+        save_cache_manifest(results_folder, manifest)
+
+    if renderer is not None:
+        # Barrière de fin de batch : toutes les figures sont écrites avant le résumé
+        wait_figures(renderer)
 
     total_time = time.time() - start_time_global
     print("\n" + "=" * 80)
@@ -873,85 +3576,420 @@ def batch_process_images(image_files, results_folder):
     print(f"\n💾 Tous les résultats sauvegardés dans: {results_folder}")
 
     summary_df = pd.DataFrame(batch_results)
-    summary_path = results_folder / "batch_summary.csv"
+    summary_path = results_folder / SUMMARY_NAME
     summary_df.to_csv(summary_path, index=False)
     print(f"📋 Résumé sauvegardé: {summary_path}")
+    if particle_store and success_count:
+        store = open_particle_store(results_folder)
+        print(
+            f"🗃️  Store de particules: {store.count_rows()} particules, {len(store.files)} image(s) "
+            f"→ {particle_store_path(results_folder)}"
+        )
+
+    if timing_rows:
+        timings_df = pd.DataFrame(timing_rows)
+        timings_path = results_folder / "batch_timings.csv"
+        timings_df.to_csv(timings_path, index=False)
+        stage_totals = timings_df.groupby("stage", sort=False).agg(
+            wall_s=("wall_s", "sum"),
+            cpu_s=("cpu_s", "sum"),
+            peak_mem_delta_mb=("peak_mem_delta_mb", "max"),
+            items=("items", "sum"),
+        )
+        print_stage_timings(stage_totals.to_dict(orient="index"))
+        print(f"⏱️  Temps par étape et par image: {timings_path}")
+
+    if profile:
+        # Images les plus lentes (hors cache) réexécutées sous cProfile + tracemalloc
+        computed = [idx for idx in pending if batch_results[idx].get("time_s") is not None]
+        slowest = sorted(computed, key=lambda idx: batch_results[idx]["time_s"], reverse=True)[:profile]
+        profile_dir = results_folder / "profiles"
+        for idx in slowest:
+            print(f"🔬 Profilage: {image_files[idx].name} ({batch_results[idx]['time_s']:.2f}s)")
+            profile_batch_image(
+                image_files[idx],
+                results_folder,
+                profile_dir,
+                detection_method=detection_method,
+                cluster_mode=cluster_mode,
+                tile_size=tile_size,
+                export_format=export_format,
+                cluster_model=cluster_model,
+                particle_store=particle_store,
+                zone_method=zone_method,
+            )
+        if slowest:
+            print(f"📂 Profils sauvegardés: {profile_dir}")
 
     return batch_results
 
 
-def analyze_single_image(image_path: Path, results_folder: Path, show_plots=True):
-    img, img_rgb, gray = process_single_image(image_path)
+def scan_image_files(raw_folder: Path):
+    # Signature (mtime, taille) de chaque image, sans affichage
+    if not raw_folder.exists():
+        return {}
+    signatures = {}
+    for f in raw_folder.glob("*.jpg"):
+        try:
+            stat = f.stat()
+        except OSError:
+            continue
+        if f.is_file():
+            signatures[f] = (stat.st_mtime_ns, stat.st_size)
+    return signatures
+
+
+def jpeg_complete(path: Path):
+    # Un JPEG entièrement écrit se termine par le marqueur EOI (FF D9)
+    try:
+        with open(path, "rb") as f:
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == b"\xff\xd9"
+    except OSError:
+        return False
+
+
+def append_summary_row(summary_path: Path, result: dict):
+    # Ajout incrémental au résumé ; les colonnes suivent l'en-tête existant
+    columns = pd.read_csv(summary_path, nrows=0).columns if summary_path.exists() else SUMMARY_COLUMNS
+    row = pd.DataFrame([result]).reindex(columns=columns)
+    row.to_csv(summary_path, mode="a", header=not summary_path.exists(), index=False)
+
+
+def init_watch_worker():
+    init_batch_worker()
+    # L'arrêt est piloté par le processus principal, qui laisse finir les images en cours
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Pool chaud : sklearn est chargé une fois pour toutes, pas à la première image
+    import sklearn.cluster  # noqa: F401
+    import sklearn.metrics  # noqa: F401
+    import sklearn.preprocessing  # noqa: F401
+
+
+def stop_watch(signum, frame):
+    raise KeyboardInterrupt
+
+
+def watch_folder(
+    raw_folder: Path,
+    results_folder: Path,
+    detection_method="labels",
+    cluster_mode="fast",
+    workers=1,
+    tile_size=None,
+    export_format="csv",
+    interval=WATCH_INTERVAL,
+    renderer=None,
+    cluster_model=None,
+    particle_store=False,
+    zone_method="integral",
+):
+    # Démon : scrute raw_folder et traite chaque image nouvelle ou modifiée par le chemin batch,
+    # avec un pool de processus gardé chaud entre les images. Ctrl+C pour arrêter.
+    figure_quality = renderer["quality"] if renderer is not None else None
+    manifest = load_cache_manifest(results_folder)
+    cluster_model_id = cluster_model["id"] if cluster_model is not None else None
+    params = pipeline_parameters(
+        detection_method,
+        cluster_mode,
+        tile_size,
+        export_format,
+        figure_quality,
+        cluster_model_id,
+        particle_store,
+        zone_method,
+    )
+    params_hash = parameters_hash(params)
+    manifest["parameters"] = params
+    summary_path = results_folder / SUMMARY_NAME
+
+    seen = {}
+    candidates = {}
+    in_flight = {}
+    # Mort d'un processus de calcul : images à relancer, images déjà relancées, pool à refaire
+    retry = []
+    crashed = set()
+    broken = False
+    n_processed = 0
+
+    def submit(image_path, image_hash, mtime):
+        future = executor.submit(
+            process_batch_image,
+            image_path,
+            results_folder,
+            detection_method,
+            cluster_mode,
+            tile_size,
+            export_format,
+            figure_quality=figure_quality,
+            cluster_model=cluster_model,
+            particle_store=particle_store,
+            zone_method=zone_method,
+        )
+        in_flight[future] = (image_path, image_hash, mtime)
+        return future
+
+    def handle(future):
+        nonlocal n_processed, broken
+        image_path, image_hash, mtime = in_flight.pop(future)
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            # Processus tué (OOM, SIGKILL) : toutes les images en cours échouent et la fautive est
+            # inconnue. Chacune est relancée seule ; si elle tue encore son processus, erreur.
+            broken = True
+            if image_path not in crashed:
+                crashed.add(image_path)
+                retry.append((image_path, image_hash, mtime))
+                return
+            result = {"image": image_path.name, "status": "❌ Erreur: processus de calcul interrompu (mémoire ?)"}
+        except Exception as e:
+            result = {"image": image_path.name, "status": f"❌ Erreur: {str(e)}"}
+        crashed.discard(image_path)
+        result.pop("timings", None)
+        for spec, path in result.pop("figures", []):
+            submit_figure(renderer, spec, path)
+        result["cached"] = False
+        record_cached_result(
+            manifest, image_path, results_folder, image_hash, params_hash, result, export_format, particle_store
+        )
+        save_cache_manifest(results_folder, manifest)
+        append_summary_row(summary_path, result)
+        latency = time.time() - mtime
+        print(f"[{datetime.now():%H:%M:%S}] {result['status']} {image_path.name} ({latency:.1f}s après écriture)")
+        n_processed += 1
+
+    def restart_pool():
+        # Pool cassé : on récupère toutes les images en cours, puis pool neuf (chaud)
+        nonlocal executor, broken
+        for future in wait(list(in_flight)).done:
+            handle(future)
+        while True:
+            executor.shutdown()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=init_watch_worker)
+            broken = False
+            print(
+                f"[{datetime.now():%H:%M:%S}] ⚠️  Processus de calcul interrompu : "
+                f"pool redémarré, {len(retry)} image(s) à relancer une par une"
+            )
+            # Relance une par une : une image qui tue encore son processus est seule en cause
+            while retry and not broken:
+                handle(submit(*retry.pop(0)))
+            if not broken:
+                break
+
+    print(f"\n👀 Surveillance de {raw_folder} toutes les {interval:g}s ({workers} processus, Ctrl+C pour arrêter)")
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_watch_worker)
+    # SIGTERM (systemd, kill) : même arrêt propre que Ctrl+C
+    previous_sigterm = signal.signal(signal.SIGTERM, stop_watch)
+    try:
+        while True:
+            current = scan_image_files(raw_folder)
+            # Une image supprimée puis recopiée doit être retraitée
+            seen = {path: signature for path, signature in seen.items() if path in current}
+            busy = {image_path for image_path, _, _ in in_flight.values()}
+            for image_path, signature in sorted(current.items()):
+                if seen.get(image_path) == signature or image_path in busy:
+                    continue
+                # Écriture terminée : taille et date identiques sur deux scans consécutifs et JPEG complet
+                if candidates.get(image_path) != signature or not jpeg_complete(image_path):
+                    candidates[image_path] = signature
+                    continue
+                del candidates[image_path]
+                seen[image_path] = signature
+                try:
+                    image_hash = file_content_hash(image_path)
+                except OSError:
+                    seen.pop(image_path)
+                    continue
+                # Contenu déjà traité avec ces paramètres (fichier touché, redémarrage du démon)
+                if lookup_cached_result(manifest, image_path, results_folder, image_hash, params_hash) is not None:
+                    continue
+                try:
+                    submit(image_path, image_hash, signature[0] / 1e9)
+                except BrokenProcessPool:
+                    restart_pool()
+                    submit(image_path, image_hash, signature[0] / 1e9)
+
+            if in_flight:
+                done, _ = wait(list(in_flight), timeout=interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future)
+                if broken:
+                    restart_pool()
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print(f"\n🛑 Arrêt demandé: {len(in_flight)} image(s) en cours terminée(s) avant sortie")
+        for future in list(in_flight):
+            handle(future)
+        # Pas de relance à l'arrêt : les images interrompues seront reprises au prochain lancement
+        for image_path, _, _ in retry:
+            print(f"[{datetime.now():%H:%M:%S}] ❌ Processus de calcul interrompu {image_path.name} (non relancée, arrêt)")
+    finally:
+        signal.signal(signal.SIGTERM, previous_sigterm)
+        executor.shutdown()
+    print(f"✅ {n_processed} image(s) traitée(s) en mode surveillance, résumé: {summary_path}")
+    return n_processed
+
+
+def analyze_single_image(
+    image_path: Path,
+    results_folder: Path,
+    show_plots=True,
+    detection_method="labels",
+    heatmap_scale=None,
+    cluster_mode="fast",
+    check_clustering=False,
+    export_format="csv",
+    renderer=None,
+    cluster_model=None,
+    reuse_artifacts=True,
+    zone_method="integral",
+    check_zone_search=False,
+):
+    timings = {}
+    with timed_stage(timings, "load") as stage:
+        img, img_rgb, gray = process_single_image(image_path)
+        stage["items"] = int(gray.size) if gray is not None else 0
     if gray is None:
         return
 
     print(f"\n🔄 Analyse détaillée: {image_path.name}")
-    compute_quality_metrics(gray)
-
-    gray_eq, mask_type1, mask_type2, mask_type3, segmentation_img, thresh1, thresh2 = preprocess_and_segment(gray)
-
-    df_particles, contours_type1, contours_type2, contours_type3 = extract_particles(
-        gray_eq, mask_type1, mask_type2, mask_type3
-    )
-
-    if len(df_particles) < 5:
-        print("⚠️  Trop peu de particules pour l'analyse avancée")
-        return
+    with timed_stage(timings, "quality") as stage:
+        compute_quality_metrics(gray)
+        stage["items"] = int(gray.size)
+
+    params_hash = artifact_parameters_hash(detection_method, cluster_mode, cluster_model)
+    stages = None
+    if reuse_artifacts:
+        with timed_stage(timings, "artifacts") as stage:
+            stages = load_stage_artifacts(results_folder, image_path, params_hash)
+            stage["items"] = len(stages["df_particles"]) if stages is not None else 0
+
+    if stages is not None:
+        # Image déjà traitée par le batch : segmentation, détection, scores et k-sweep repris tels quels
+        print(f"♻️  Segmentation, détection et clustering repris de {stage_artifacts_dir(results_folder, image_path)}")
+        gray_eq, class_map = stages["gray_eq"], stages["class_map"]
+        thresh1, thresh2 = stages["thresh1"], stages["thresh2"]
+        contours_type1, contours_type2, contours_type3 = stages["contours_by_type"]
+        df_particles, n_main_clusters = stages["df_particles"], stages["n_clusters"]
+        n_3d_clusters = stages["n_3d_clusters"]
+        if n_3d_clusters is None:
+            # Artefacts du batch : le clustering 3D n'y est pas calculé
+            with timed_stage(timings, "clustering") as stage:
+                df_particles, n_3d_clusters = cluster_3d(df_particles)
+                stage["items"] = len(df_particles)
+    else:
+        with timed_stage(timings, "segmentation") as stage:
+            gray_eq, class_map, thresh1, thresh2 = preprocess_and_segment(gray)
+            stage["items"] = int(gray_eq.size)
 
-    df_particles = add_scores(df_particles)
-    df_particles, n_main_clusters = cluster_weighted(df_particles)
-    df_particles, cluster_labels = interpret_clusters(df_particles, n_main_clusters)
-    df_particles, n_3d_clusters = cluster_3d(df_particles)
-    df_particles = classify_particles(df_particles)
+        with timed_stage(timings, "detection") as stage:
+            df_particles, contours_type1, contours_type2, contours_type3 = extract_particles(
+                gray_eq, class_map, method=detection_method
+            )
+            stage["items"] = len(df_particles)
+
+        if len(df_particles) < 5:
+            print("⚠️  Trop peu de particules pour l'analyse avancée")
+            return
+
+        with timed_stage(timings, "scoring") as stage:
+            df_particles = add_scores(df_particles)
+            stage["items"] = len(df_particles)
+        with timed_stage(timings, "clustering") as stage:
+            df_particles, n_main_clusters = cluster_weighted(df_particles, mode=cluster_mode, model=cluster_model)
+            df_particles, n_3d_clusters = cluster_3d(df_particles)
+            stage["items"] = len(df_particles)
+        if reuse_artifacts:
+            # Les analyses détaillées suivantes de cette image repartiront d'ici
+            with timed_stage(timings, "artifacts_save") as stage:
+                save_stage_artifacts(
+                    results_folder,
+                    image_path,
+                    params_hash,
+                    {
+                        "gray_eq": gray_eq,
+                        "class_map": class_map,
+                        "contours_by_type": (contours_type1, contours_type2, contours_type3),
+                        "df_particles": df_particles,
+                        "n_clusters": n_main_clusters,
+                        "n_3d_clusters": n_3d_clusters,
+                        "thresh1": thresh1,
+                        "thresh2": thresh2,
+                    },
+                )
+                stage["items"] = len(df_particles)
+    with timed_stage(timings, "classification") as stage:
+        df_particles, cluster_labels = interpret_clusters(df_particles, n_main_clusters)
+        df_particles = classify_particles(df_particles)
+        stage["items"] = len(df_particles)
 
     output_dir = results_folder / image_path.stem / "single_analysis"
     output_dir.mkdir(parents=True, exist_ok=True)
-    df_particles, pca = run_pca(df_particles)
-
-    best_window, best_score, coords, candidates = find_balanced_zone(df_particles, img_rgb)
+    if check_clustering:
+        agreement = check_clustering_agreement(df_particles)
+        with open(output_dir / "clustering_agreement.json", "w", encoding="utf-8") as f:
+            json.dump(agreement, f, indent=2)
+    with timed_stage(timings, "pca") as stage:
+        df_particles, pca = run_pca(df_particles)
+        stage["items"] = len(df_particles)
+
+    with timed_stage(timings, "zone_search") as stage:
+        # Index spatial construit une fois (les centres ne bougent plus) et partagé par la recherche
+        # de zone et les figures
+        spatial_index = build_spatial_index(df_particles)
+        best_window, best_score, coords, candidates = find_balanced_zone(
+            df_particles, img_rgb, method=zone_method, spatial_index=spatial_index
+        )
+        stage["items"] = len(candidates)
+    if check_zone_search:
+        zone_report = check_zone_search_agreement(df_particles, img_rgb, spatial_index)
+        with open(output_dir / "zone_search_comparison.json", "w", encoding="utf-8") as f:
+            json.dump(zone_report, f, indent=2)
+    x_center, y_center, x_topleft, y_topleft, square_size = coords
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    df_particles.to_csv(output_dir / "particles_by_intensity_types.csv", index=False)
-
-    if show_plots:
-        plt.figure(figsize=(14, 6))
-        plt.subplot(1, 2, 1)
-        plt.imshow(img_rgb)
-        plt.title("Image Originale (RGB)", fontsize=13, fontweight="bold")
-        plt.axis("off")
-
-        plt.subplot(1, 2, 2)
-        plt.imshow(gray, cmap="gray")
-        plt.title("Image en Niveaux de Gris (Intensité Raman)", fontsize=13, fontweight="bold")
-        plt.axis("off")
-        plt.tight_layout()
-        plt.show()
-
-        fig, axes = plt.subplots(1, 3, figsize=(16, 5))
-        axes[0].imshow(img_rgb)
-        axes[0].set_title("Image Originale", fontsize=12, fontweight="bold")
-        axes[0].axis("off")
-
-        axes[1].imshow(gray_eq, cmap="gray")
-        axes[1].set_title("Image Améliorée (CLAHE)", fontsize=12, fontweight="bold")
-        axes[1].axis("off")
+    with timed_stage(timings, "spatial") as stage:
+        df_particles, spatial_stats = spatial_statistics(df_particles, gray.shape[:2])
+        stage["items"] = len(df_particles)
+    with open(output_dir / "spatial_stats.json", "w", encoding="utf-8") as f:
+        json.dump(spatial_stats, f, indent=2)
+    if spatial_stats["clark_evans"] is not None:
+        print(
+            f"📐 Répartition spatiale: Clark-Evans R = {spatial_stats['clark_evans']:.2f}, "
+            f"distance au plus proche voisin médiane {spatial_stats['nn_distance']['median']:.1f} px"
+        )
 
-        axes[2].imshow(segmentation_img, cmap="gray", vmin=0, vmax=255)
-        axes[2].set_title(f"Segmentation (Seuils: {thresh1}, {thresh2})", fontsize=12, fontweight="bold")
-        axes[2].axis("off")
-        plt.tight_layout()
+    if show_plots or renderer is not None:
+        # À l'écran : rendu immédiat ; sans affichage, les PNG sont écrits par le pool de rendu
+        # pendant que l'analyse continue (rapport, exports)
+        detail_figures = analysis_detail_figures(
+            img_rgb,
+            gray,
+            gray_eq,
+            class_map,
+            thresh1,
+            thresh2,
+            df_particles,
+            (contours_type1, contours_type2, contours_type3),
+            coords,
+            spatial_index=spatial_index,
+        )
+        for spec in detail_figures[:2]:
+            emit_figure(spec, output_dir / f"{spec['name']}.png" if renderer is not None else None, show_plots, renderer)
 
         generate_basic_heatmaps(
             gray_eq,
-            segmentation_img,
+            class_map,
             contours_type1,
             contours_type2,
             contours_type3,
-            mask_type1,
-            mask_type2,
-            mask_type3,
             output_dir=output_dir,
             show_plots=show_plots,
+            renderer=renderer,
         )
 
         generate_parametric_heatmaps(
@@ -959,122 +3997,53 @@ def analyze_single_image(image_path: Path, results_folder: Path, show_plots=True
             gray_eq,
             output_dir=output_dir,
             show_plots=show_plots,
+            scale=heatmap_scale,
+            renderer=renderer,
         )
 
         generate_pivot_heatmaps(
             df_particles,
             output_dir=output_dir,
             show_plots=show_plots,
-
-    generate_final_report(df_particles)
-    export_results(df_particles, output_dir)
+            renderer=renderer,
         )
-        plt.show()
-
-        overlay = img_rgb.copy()
-        for cnt in contours_type1:
-            cv2.drawContours(overlay, [cnt], -1, (255, 0, 0), 2)
-        for cnt in contours_type2:
-            cv2.drawContours(overlay, [cnt], -1, (0, 255, 0), 2)
-        for cnt in contours_type3:
-            cv2.drawContours(overlay, [cnt], -1, (0, 0, 255), 2)
-
-        fig, axes = plt.subplots(1, 2, figsize=(16, 7))
-        axes[0].imshow(overlay)
-        axes[0].set_title(f"Particules Détectées (Total: {len(df_particles)})", fontsize=12, fontweight="bold")
-        axes[0].axis("off")
-
-        type_counts = df_particles["Type"].value_counts()
-        axes[1].bar(range(len(type_counts)), type_counts.values, color=["red", "green", "blue"][:len(type_counts)])
-        axes[1].set_xticks(range(len(type_counts)))
-        axes[1].set_xticklabels(type_counts.index, rotation=45, ha="right")
-        axes[1].set_ylabel("Nombre de particules", fontweight="bold")
-        axes[1].set_title("Distribution par Type d'Intensité", fontsize=12, fontweight="bold")
-        axes[1].grid(True, alpha=0.3, axis="y")
-        plt.tight_layout()
-        plt.show()
-
-        fig = plt.figure(figsize=(18, 6))
-        ax1 = fig.add_subplot(131, projection="3d")
-        scatter1 = ax1.scatter(
-            df_particles["PCA_1"], df_particles["PCA_2"], df_particles["PCA_3"],
-            c=df_particles["Cluster_Combined"], cmap="tab10", s=30, alpha=0.6, edgecolors="black", linewidth=0.3
-        )
-        ax1.set_title("PCA 3D - Cluster", fontsize=12, fontweight="bold")
-        plt.colorbar(scatter1, ax=ax1, label="Cluster ID", shrink=0.6, pad=0.1)
 
-        ax2 = fig.add_subplot(132, projection="3d")
-        type_colors = {"Type_1_Blanc": 0, "Type_2_Gris": 1, "Type_3_Noir": 2}
-        scatter2 = ax2.scatter(
-            df_particles["PCA_1"], df_particles["PCA_2"], df_particles["PCA_3"],
-            c=df_particles["Type"].map(type_colors), cmap="RdYlBu_r",
-            s=30, alpha=0.6, edgecolors="black", linewidth=0.3
-        )
-        ax2.set_title("PCA 3D - Type Intensité", fontsize=12, fontweight="bold")
-
-        ax3 = fig.add_subplot(133, projection="3d")
-        unique_ptypes = df_particles["Particle_Type_Combined"].unique()
-        ptype_to_num = {t: i for i, t in enumerate(unique_ptypes)}
-        scatter3 = ax3.scatter(
-            df_particles["PCA_1"], df_particles["PCA_2"], df_particles["PCA_3"],
-            c=df_particles["Particle_Type_Combined"].map(ptype_to_num), cmap="tab20",
-            s=30, alpha=0.6, edgecolors="black", linewidth=0.3
-        )
-        ax3.set_title("PCA 3D - Type Particule", fontsize=12, fontweight="bold")
-        plt.tight_layout()
-        plt.show()
-
-        fig, axes = plt.subplots(1, 2, figsize=(20, 10))
-        ax = axes[0]
-        ax.imshow(img_rgb)
-        green_square = Rectangle((x_topleft, y_topleft), square_size, square_size,
-                                 linewidth=4, edgecolor="lime", facecolor="none")
-        ax.add_patch(green_square)
-        ax.plot(x_center, y_center, "g+", markersize=25, markeredgewidth=4)
-        ax.set_title("Zone Équilibrée (Carré Vert)", fontsize=12, fontweight="bold")
-        ax.axis("off")
+        for spec in detail_figures[2:]:
+            emit_figure(spec, output_dir / f"{spec['name']}.png" if renderer is not None else None, show_plots, renderer)
 
-        ax2 = axes[1]
-        cluster_ids = sorted(df_particles["Cluster_Combined"].unique())
-        in_best_window = (
-            (df_particles["Center_X"] >= x_topleft)
-            & (df_particles["Center_X"] <= x_topleft + square_size)
-            & (df_particles["Center_Y"] >= y_topleft)
-            & (df_particles["Center_Y"] <= y_topleft + square_size)
-        )
-        particles_in_best = df_particles[in_best_window]
-        region_cluster_counts = particles_in_best["Cluster_Combined"].value_counts().sort_index()
-        cluster_counts_in_zone = [region_cluster_counts.get(cid, 0) for cid in cluster_ids]
-        ax2.bar(range(len(cluster_ids)), cluster_counts_in_zone, color=plt.cm.tab10(np.linspace(0, 1, len(cluster_ids))))
-        ax2.set_xticks(range(len(cluster_ids)))
-        ax2.set_xticklabels([f"Cluster {cid}" for cid in cluster_ids])
-        ax2.set_title("Distribution des clusters (zone)", fontsize=12, fontweight="bold")
-        ax2.grid(True, alpha=0.3, axis="y")
-        plt.tight_layout()
-        plt.show()
-
-        fig, ax = plt.subplots(figsize=(12, 6))
-        ax.hist(gray_eq.ravel(), bins=50, color="gray", alpha=0.7, edgecolor="black")
-        ax.axvline(thresh1, color="blue", linestyle="--", linewidth=2, label=f"Seuil Noir-Gris ({thresh1})")
-        ax.axvline(thresh2, color="green", linestyle="--", linewidth=2, label=f"Seuil Gris-Blanc ({thresh2})")
-        ax.set_xlabel("Intensité (0-255)", fontweight="bold", fontsize=12)
-        ax.set_ylabel("Nombre de pixels", fontweight="bold", fontsize=12)
-        ax.legend()
-        ax.grid(True, alpha=0.3)
-        plt.tight_layout()
-        plt.show()
+    generate_final_report(df_particles)
+    # Artefacts du batch repris ou non, les colonnes n'arrivent pas dans le même ordre
+    columns = [column for column in SINGLE_ANALYSIS_COLUMNS if column in df_particles.columns]
+    df_particles = df_particles[columns + df_particles.columns.difference(columns, sort=False).tolist()]
+    with timed_stage(timings, "export") as stage:
+        export_results(df_particles, output_dir, export_format)
+        stage["items"] = len(df_particles)
+
+    print_stage_timings(timings)
+    with open(output_dir / "stage_timings.json", "w", encoding="utf-8") as f:
+        json.dump(timings, f, indent=2)
 
     print("\n✅ Analyse détaillée terminée.")
     print(f"📁 Résultats détaillés: {output_dir}")
 
 
+def parse_heatmap_scale(text):
+    try:
+        scale = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"entier attendu: {text!r}") from None
+    if scale < 1:
+        raise argparse.ArgumentTypeError(f"facteur invalide: {scale} (entier ≥ 1, 1 = pleine résolution)")
+    return scale
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Analyse Raman - Pipeline complet et analyse détaillée.")
     parser.add_argument(
         "--raw-folder",
         type=Path,
         default=None,
-        help="Dossier contenant les images .jpg (par défaut: results/focus_stacking).",
+        help="Dossier contenant les images .jpg (et .npy avec --tile-size) (par défaut: results/focus_stacking).",
     )
     parser.add_argument(
         "--results-folder",
@@ -1098,6 +4067,161 @@ def parse_args():
         action="store_true",
         help="Ignorer le traitement batch.",
     )
+    parser.add_argument(
+        "--detection-method",
+        choices=sorted(DETECTION_METHODS),
+        default="labels",
+        help="Extraction des features: 'labels' (image de labels vectorisée) ou 'contours' (mode de référence).",
+    )
+    parser.add_argument(
+        "--heatmap-scale",
+        type=parse_heatmap_scale,
+        default=None,
+        help="Facteur de sous-échantillonnage des heatmaps paramétriques (1 = pleine résolution, défaut: auto).",
+    )
+    parser.add_argument(
+        "--cluster-mode",
+        choices=list(CLUSTER_MODES),
+        default="fast",
+        help=(
+            "Sélection de k: 'fast' (modèle gagnant réutilisé, silhouette échantillonnée), 'exhaustive' (référence) "
+            "ou 'shared' (un modèle ajusté une fois pour tout le batch, ids de clusters comparables)."
+        ),
+    )
+    parser.add_argument(
+        "--keep-artifacts",
+        action="store_true",
+        help=(
+            "Conserver les sorties d'étapes (CLAHE, carte de classes, contours, particules clusterisées) "
+            "de toutes les images batch, pour des analyses détaillées ultérieures sans recalcul."
+        ),
+    )
+    parser.add_argument(
+        "--no-artifacts",
+        action="store_true",
+        help="Ne pas conserver ni réutiliser les sorties d'étapes (l'analyse détaillée recalcule tout).",
+    )
+    parser.add_argument(
+        "--particle-store",
+        action="store_true",
+        help=(
+            f"Écrire les particules de toutes les images dans un seul dataset Parquet partitionné par image "
+            f"(<results-folder>/{PARTICLE_STORE_NAME}) au lieu d'un fichier par image."
+        ),
+    )
+    parser.add_argument(
+        "--cluster-model",
+        type=Path,
+        default=None,
+        help=f"Fichier du modèle de clustering partagé (défaut: <results-folder>/{CLUSTER_MODEL_NAME}).",
+    )
+    parser.add_argument(
+        "--refit-cluster-model",
+        action="store_true",
+        help="Réajuster le modèle de clustering partagé même s'il existe déjà.",
+    )
+    parser.add_argument(
+        "--check-clustering",
+        action="store_true",
+        help="Comparer les modes de clustering 'fast' et 'exhaustive' sur l'image détaillée.",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=PIPELINE_DEPTH,
+        help=(
+            "Batch séquentiel : images décodées d'avance et écritures en attente pendant le calcul "
+            f"(0 = décodage, calcul et écriture dans le même thread, défaut: {PIPELINE_DEPTH})."
+        ),
+    )
+    parser.add_argument(
+        "--zone-search",
+        choices=sorted(ZONE_SEARCH_METHODS),
+        default="integral",
+        help=(
+            "Recherche de la zone équilibrée : 'integral' (grille exhaustive au pas de "
+            f"{ZONE_STEP_SIZE} px, défaut), 'refine' (grille grossière puis affinage jusqu'au pixel), "
+            "'scan' (balayage de référence)."
+        ),
+    )
+    parser.add_argument(
+        "--check-zone-search",
+        action="store_true",
+        help="Comparer la recherche 'refine' à la grille exhaustive sur l'image détaillée.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Retraiter toutes les images sans réutiliser les résultats en cache.",
+    )
+    parser.add_argument(
+        "--invalidate-cache",
+        nargs="*",
+        metavar="IMAGE",
+        default=None,
+        help="Invalider le cache pour les images données (toutes si aucune n'est précisée).",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=None,
+        help=f"Traitement batch par tuiles de N px pour les grandes mosaïques (ex: {TILE_SIZE}, détection 'labels' uniquement, défaut: image entière).",
+    )
+    parser.add_argument(
+        "--export-format",
+        choices=sorted(EXPORT_SUFFIXES),
+        default="csv",
+        help="Format des tables exportées: 'csv' (défaut), 'parquet' ou 'arrow' (Arrow IPC, memory-map; nécessite pyarrow).",
+    )
+    parser.add_argument(
+        "--profile",
+        type=int,
+        nargs="?",
+        const=3,
+        default=0,
+        metavar="N",
+        help="Profiler (cProfile + tracemalloc) les N images les plus lentes du batch (défaut si activé: 3).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Nombre de processus pour le traitement batch (0 = tous les cœurs, défaut: 1).",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Mode démon: surveiller --raw-folder et analyser chaque image nouvelle ou modifiée (Ctrl+C pour arrêter).",
+    )
+    parser.add_argument(
+        "--watch-interval",
+        type=float,
+        default=WATCH_INTERVAL,
+        help=f"Intervalle entre deux scans du dossier surveillé, en secondes (défaut: {WATCH_INTERVAL:g}).",
+    )
+    parser.add_argument(
+        "--save-figures",
+        action="store_true",
+        help="Écrire les figures en PNG (heatmaps de chaque image batch, toutes les figures de l'analyse détaillée).",
+    )
+    parser.add_argument(
+        "--figure-quality",
+        choices=list(FIGURE_QUALITIES),
+        default="full",
+        help="Qualité des figures sauvegardées: 'full' (300 dpi, défaut) ou 'preview' (100 dpi, images ≤ 1024 px).",
+    )
+    parser.add_argument(
+        "--figure-dpi",
+        type=int,
+        default=None,
+        help="Résolution des PNG (remplace le dpi de --figure-quality).",
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=RENDER_WORKERS,
+        help=f"Processus de rendu des figures en arrière-plan (0 = rendu synchrone, défaut: {RENDER_WORKERS}).",
+    )
     return parser.parse_args()
 
 
@@ -1109,23 +4233,126 @@ def main():
     raw_folder = args.raw_folder if args.raw_folder is not None else base_dir / "results" / "focus_stacking"
     results_folder = args.results_folder if args.results_folder is not None else base_dir / "results" / "batch_processing"
 
-    image_files = get_image_files(raw_folder)
-    if not image_files:
+    image_files = get_image_files(raw_folder, include_npy=bool(args.tile_size))
+    # En mode surveillance, le dossier peut être vide au lancement
+    if not image_files and not args.watch:
         print("❌ Aucune image trouvée.")
         return
 
+    check_export_format(args.export_format)
+    if args.tile_size:
+        check_tiled_options(args.detection_method)
+    if args.particle_store:
+        # Le store est toujours en Parquet : pyarrow requis
+        check_export_format("parquet")
     ensure_results_folder(results_folder)
+    if args.no_plots:
+        use_headless_backend()
+
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+    cluster_model = None
+    if args.cluster_mode == "shared":
+        model_path = args.cluster_model if args.cluster_model is not None else results_folder / CLUSTER_MODEL_NAME
+        cluster_model = prepare_shared_cluster_model(
+            image_files,
+            model_path,
+            detection_method=args.detection_method,
+            tile_size=args.tile_size,
+            workers=workers,
+            refit=args.refit_cluster_model,
+        )
+        if cluster_model is None:
+            return
 
-    if not args.skip_batch:
-        batch_process_images(image_files, results_folder)
+    renderer = None
+    if args.save_figures:
+        renderer = start_figure_renderer(args.render_workers, args.figure_quality, args.figure_dpi)
+
+    if args.invalidate_cache is not None:
+        invalidate_cache(results_folder, args.invalidate_cache)
 
     if args.single_index < 0 or args.single_index >= len(image_files):
-        print(f"⚠️  Index invalide: {args.single_index}. Utilisation de l'image 0.")
+        if not args.watch:
+            print(f"⚠️  Index invalide: {args.single_index}. Utilisation de l'image 0.")
         single_index = 0
     else:
         single_index = args.single_index
 
-    analyze_single_image(image_files[single_index], results_folder, show_plots=not args.no_plots)
+    # Sorties d'étapes conservées par le batch : celles de l'image analysée en détail ensuite,
+    # ou de toutes les images avec --keep-artifacts
+    if args.no_artifacts:
+        artifact_images = frozenset()
+    elif args.keep_artifacts:
+        artifact_images = frozenset(path.name for path in image_files)
+    elif args.watch or not image_files:
+        artifact_images = frozenset()
+    else:
+        artifact_images = frozenset([image_files[single_index].name])
+
+    if not args.skip_batch and image_files:
+        batch_process_images(
+            image_files,
+            results_folder,
+            detection_method=args.detection_method,
+            cluster_mode=args.cluster_mode,
+            workers=workers,
+            use_cache=not args.no_cache,
+            tile_size=args.tile_size,
+            export_format=args.export_format,
+            profile=args.profile,
+            renderer=renderer,
+            cluster_model=cluster_model,
+            particle_store=args.particle_store,
+            artifact_images=artifact_images,
+            zone_method=args.zone_search,
+            pipeline_depth=args.pipeline_depth,
+        )
+
+    if args.watch:
+        # Les images déjà présentes sont couvertes par le batch ci-dessus (ou le cache)
+        watch_folder(
+            raw_folder,
+            results_folder,
+            detection_method=args.detection_method,
+            cluster_mode=args.cluster_mode,
+            workers=workers,
+            tile_size=args.tile_size,
+            export_format=args.export_format,
+            interval=args.watch_interval,
+            renderer=renderer,
+            cluster_model=cluster_model,
+            particle_store=args.particle_store,
+            zone_method=args.zone_search,
+        )
+        if renderer is not None:
+            close_figure_renderer(renderer)
+        return
+
+    if args.tile_size:
+        # L'analyse détaillée charge l'image entière (BGR, RGB, CLAHE, heatmaps pleine résolution) :
+        # une mosaïque qui n'est traitable que par tuiles n'y survivrait pas
+        print("\n⏭️  Mode tuilé (--tile-size) : analyse détaillée non lancée (relancer sans --tile-size sur une image .jpg)")
+        if renderer is not None:
+            close_figure_renderer(renderer)
+        return
+
+    analyze_single_image(
+        image_files[single_index],
+        results_folder,
+        show_plots=not args.no_plots,
+        detection_method=args.detection_method,
+        heatmap_scale=args.heatmap_scale,
+        cluster_mode=args.cluster_mode,
+        check_clustering=args.check_clustering,
+        export_format=args.export_format,
+        renderer=renderer,
+        cluster_model=cluster_model,
+        reuse_artifacts=not args.no_artifacts,
+        zone_method=args.zone_search,
+        check_zone_search=args.check_zone_search,
+    )
+    if renderer is not None:
+        close_figure_renderer(renderer)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,384 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import cv2
+import numpy as np
+
+import analyse_raman as ar
+
+# Rayon moyen (px) et dispersion log-normale des particules
+SIZE_DISTRIBUTIONS = {
+    "small": (3.0, 0.3),
+    "mixed": (6.0, 0.6),
+    "large": (15.0, 0.4),
+}
+# Proportions blanc / gris / noir
+INTENSITY_MIXES = {
+    "balanced": (1 / 3, 1 / 3, 1 / 3),
+    "dark": (0.2, 0.2, 0.6),
+    "bright": (0.6, 0.2, 0.2),
+}
+INTENSITY_RANGES = ((200, 250), (110, 160), (15, 60))
+
+PRESETS = {
+    "quick": {
+        "sizes": [(1024, 1024)],
+        "particles": [500, 2000],
+        "size_dists": ["mixed"],
+        "intensity_mixes": ["balanced"],
+        "repeat": 3,
+    },
+    "full": {
+        "sizes": [(1024, 1024), (2048, 2048), (4096, 4096)],
+        "particles": [500, 2000, 10000],
+        "size_dists": ["small", "mixed", "large"],
+        "intensity_mixes": ["balanced", "dark"],
+        "repeat": 3,
+    },
+}
+# Démarrage à froid d'un interpréteur, comme un worker batch :
+# "import_eager" recharge aussi ce que l'ancien import de module chargeait d'office
+STARTUP_COMMANDS = {
+    "interpreter": "pass",
+    "import": "import analyse_raman",
+    "import_eager": (
+        "import analyse_raman, matplotlib.pyplot, mpl_toolkits.mplot3d, sklearn.cluster, "
+        "sklearn.decomposition, sklearn.metrics, sklearn.preprocessing, scipy.stats, scipy.ndimage"
+    ),
+}
+STAGES = ("segmentation", "detection", "scoring", "clustering", "classification", "zone_search", "zone_refine", "spatial", "heatmaps", "batch")
+
+
+def synthetic_raman_image(
+    height=1024,
+    width=1024,
+    n_particles=1000,
+    size_dist="mixed",
+    intensity_mix="balanced",
+    seed=0,
+):
+    # Image BGR uint8 reproductible : fond gris irrégulier, ellipses blanches / grises / noires, bruit
+    rng = np.random.default_rng(seed)
+    mean_radius, sigma = SIZE_DISTRIBUTIONS[size_dist]
+    class_weights = INTENSITY_MIXES[intensity_mix]
+
+    background = rng.normal(128, 25, (max(height // 32, 2), max(width // 32, 2))).astype(np.float32)
+    image = cv2.resize(background, (width, height), interpolation=cv2.INTER_CUBIC)
+
+    radii = rng.lognormal(np.log(mean_radius), sigma, n_particles)
+    classes = rng.choice(3, size=n_particles, p=class_weights)
+    centers = np.column_stack((rng.integers(0, width, n_particles), rng.integers(0, height, n_particles)))
+    for (cx, cy), radius, cls in zip(centers, radii, classes):
+        axes = (max(int(radius), 1), max(int(radius * rng.uniform(0.5, 1.0)), 1))
+        low, high = INTENSITY_RANGES[cls]
+        cv2.ellipse(image, (int(cx), int(cy)), axes, float(rng.uniform(0, 180)), 0, 360, float(rng.uniform(low, high)), -1)
+
+    image = cv2.GaussianBlur(image, (0, 0), 1.0)
+    image += rng.normal(0, 4, image.shape).astype(np.float32)
+    gray = np.clip(image, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def measure(func, repeat=3):
+    # Temps : meilleur et médiane de `repeat` exécutions sans traçage ;
+    # mémoire : pic tracemalloc (allocations Python/NumPy, y compris les sorties OpenCV) sur une exécution dédiée
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        "time_s_min": min(times),
+        "time_s_median": float(np.median(times)),
+        "repeat": repeat,
+        "peak_mem_mb": peak / 1e6,
+    }
+
+
+def benchmark_case(case, stages, repeat=3, work_dir: Path | None = None):
+    height, width = case["height"], case["width"]
+    img = synthetic_raman_image(
+        height, width, case["n_particles"], case["size_dist"], case["intensity_mix"], seed=case["seed"]
+    )
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    records = []
+
+    def record(stage, func, n_items=None):
+        result, stats = measure(func, repeat)
+        records.append({"stage": stage, **case, **stats, "n_items": n_items(result) if n_items else None})
+        return result
+
+    # Les étapes en aval réutilisent la sortie de l'étape précédente (hors chronométrage)
+    gray_eq, class_map, _, _ = ar.preprocess_and_segment(gray)
+    if "segmentation" in stages:
+        record("segmentation", lambda: ar.preprocess_and_segment(gray), lambda r: int(gray.size))
+
+    df_particles, _, _, _ = ar.extract_particles(gray_eq, class_map)
+    if "detection" in stages:
+        record("detection", lambda: ar.extract_particles(gray_eq, class_map), lambda r: len(r[0]))
+
+    if len(df_particles) < 12:
+        print(f"   ⚠️  {len(df_particles)} particules détectées : étapes aval ignorées")
+        return records
+
+    df_scored = ar.add_scores(df_particles.copy())
+    if "scoring" in stages:
+        record("scoring", lambda: ar.add_scores(df_particles.copy()), len)
+
+    df_clustered, n_clusters = ar.cluster_weighted(df_scored.copy())
+    if "clustering" in stages:
+        record("clustering", lambda: ar.cluster_weighted(df_scored.copy()), lambda r: r[1])
+
+    if "classification" in stages:
+        record(
+            "classification",
+            lambda: ar.classify_particles(ar.interpret_clusters(df_clustered.copy(), n_clusters)[0]),
+            lambda r: int(r["Particle_Type_Combined"].nunique()),
+        )
+
+    if "zone_search" in stages:
+        record("zone_search", lambda: ar.find_balanced_zone(df_clustered, gray, keep_candidates=False), lambda r: r[0]["size"])
+
+    if "zone_refine" in stages:
+        record(
+            "zone_refine",
+            lambda: ar.find_balanced_zone(df_clustered, gray, method="refine", keep_candidates=False),
+            lambda r: r[0]["size"],
+        )
+
+    if "spatial" in stages:
+        record("spatial", lambda: ar.spatial_statistics(df_clustered, gray.shape[:2]), lambda r: len(r[0]))
+
+    if "heatmaps" in stages:
+        record("heatmaps", lambda: ar.generate_parametric_heatmaps(df_clustered, gray_eq, show_plots=False), lambda r: len(df_clustered))
+
+    if "batch" in stages and work_dir is not None:
+        image_path = work_dir / f"bench_{height}x{width}_{case['n_particles']}.jpg"
+        cv2.imwrite(str(image_path), img)
+        record(
+            "batch",
+            lambda: ar.process_batch_image(image_path, work_dir / "results"),
+            lambda r: r.get("particles"),
+        )
+
+    return records
+
+
+def iter_cases(sizes, particles, size_dists, intensity_mixes, seed=0):
+    for (height, width), n_particles, size_dist, intensity_mix in itertools.product(
+        sizes, particles, size_dists, intensity_mixes
+    ):
+        yield {
+            "height": height,
+            "width": width,
+            "n_particles": n_particles,
+            "size_dist": size_dist,
+            "intensity_mix": intensity_mix,
+            "seed": seed,
+        }
+
+
+def measure_startup(repeat=5):
+    env = dict(os.environ, MPLBACKEND="Agg")
+    records = {}
+    for name, code in STARTUP_COMMANDS.items():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).resolve().parent, env=env, check=True)
+            times.append(time.perf_counter() - start)
+        records[name] = {"time_s_min": min(times), "time_s_median": float(np.median(times)), "repeat": repeat}
+    return records
+
+
+def print_startup(startup):
+    interpreter = startup["interpreter"]["time_s_min"]
+    print("\n🚀 Démarrage à froid (meilleur temps, interpréteur déduit)")
+    for name in ("import", "import_eager"):
+        print(f"   {name:<15} {(startup[name]['time_s_min'] - interpreter) * 1000:9.1f} ms")
+    ratio = (startup["import"]["time_s_min"] - interpreter) / max(startup["import_eager"]["time_s_min"] - interpreter, 1e-9)
+    print(f"   import différé = {ratio:.0%} de l'import complet")
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "pipeline_version": ar.PIPELINE_VERSION,
+    }
+
+
+def run_benchmarks(cases, stages, repeat=3):
+    ar.setup_warnings()
+    records = []
+    cases = list(cases)
+    with tempfile.TemporaryDirectory(prefix="raman_bench_") as tmp:
+        for idx, case in enumerate(cases, 1):
+            print(
+                f"[{idx}/{len(cases)}] 🧪 {case['height']}x{case['width']} px, {case['n_particles']} particules, "
+                f"tailles {case['size_dist']}, intensités {case['intensity_mix']}"
+            )
+            case_records = benchmark_case(case, stages, repeat=repeat, work_dir=Path(tmp))
+            for r in case_records:
+                print(f"   {r['stage']:<15} {r['time_s_min'] * 1000:9.1f} ms  {r['peak_mem_mb']:8.1f} Mo")
+            records += case_records
+    return records
+
+
+def record_key(record):
+    return (
+        record["stage"],
+        record["height"],
+        record["width"],
+        record["n_particles"],
+        record["size_dist"],
+        record["intensity_mix"],
+    )
+
+
+def startup_records(data):
+    # Le démarrage est comparé comme une étape à part entière, sans cas d'image
+    case = {"height": 0, "width": 0, "n_particles": 0, "size_dist": "-", "intensity_mix": "-"}
+    return [{**record, **case, "stage": f"startup_{name}"} for name, record in (data.get("startup") or {}).items()]
+
+
+def compare_results(baseline_path: Path, current_path: Path, threshold=1.2):
+    # Ratio courant / référence sur le meilleur temps ; > threshold = régression
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+        baseline = {record_key(r): r for r in data["results"] + startup_records(data)}
+    with open(current_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+        current = data["results"] + startup_records(data)
+
+    regressions = 0
+    print(f"{'étape':<15} {'cas':<32} {'réf (ms)':>10} {'actuel (ms)':>12} {'ratio':>7}")
+    for record in current:
+        ref = baseline.get(record_key(record))
+        if ref is None:
+            continue
+        ratio = record["time_s_min"] / max(ref["time_s_min"], 1e-9)
+        flag = ""
+        if ratio > threshold:
+            flag = " ⚠️"
+            regressions += 1
+        case = f"{record['height']}x{record['width']}/{record['n_particles']}/{record['size_dist']}/{record['intensity_mix']}"
+        print(
+            f"{record['stage']:<15} {case:<32} {ref['time_s_min'] * 1000:10.1f} "
+            f"{record['time_s_min'] * 1000:12.1f} {ratio:7.2f}{flag}"
+        )
+    print(f"\n{regressions} régression(s) au-delà de x{threshold}")
+    return regressions
+
+
+def parse_size(text):
+    height, width = text.lower().split("x")
+    return int(height), int(width)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyse Raman - Benchmarks sur images synthétiques.")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick", help="Grille de paramètres (défaut: quick).")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=None, help="Tailles d'image HxW (ex: 1024x1024).")
+    parser.add_argument("--particles", nargs="+", type=int, default=None, help="Nombres de particules générées.")
+    parser.add_argument("--size-dist", nargs="+", choices=sorted(SIZE_DISTRIBUTIONS), default=None)
+    parser.add_argument("--intensity-mix", nargs="+", choices=sorted(INTENSITY_MIXES), default=None)
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Étapes mesurées.")
+    parser.add_argument("--repeat", type=int, default=None, help="Nombre d'exécutions chronométrées par mesure.")
+    parser.add_argument("--seed", type=int, default=0, help="Graine du générateur synthétique.")
+    parser.add_argument("--output", type=Path, default=None, help="Fichier JSON de résultats.")
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        type=Path,
+        metavar=("REFERENCE", "ACTUEL"),
+        default=None,
+        help="Comparer deux fichiers de résultats au lieu de lancer les mesures.",
+    )
+    parser.add_argument("--threshold", type=float, default=1.2, help="Ratio de temps signalé comme régression.")
+    parser.add_argument(
+        "--startup-repeat",
+        type=int,
+        default=5,
+        help="Lancements d'interpréteur pour mesurer le temps de démarrage (0 = ne pas mesurer, défaut: 5).",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.compare is not None:
+        compare_results(*args.compare, threshold=args.threshold)
+        return
+
+    preset = PRESETS[args.preset]
+    cases = iter_cases(
+        args.sizes or preset["sizes"],
+        args.particles or preset["particles"],
+        args.size_dist or preset["size_dists"],
+        args.intensity_mix or preset["intensity_mixes"],
+        seed=args.seed,
+    )
+    repeat = args.repeat or preset["repeat"]
+
+    info = environment_info()
+    startup = None
+    if args.startup_repeat > 0:
+        startup = measure_startup(args.startup_repeat)
+        print_startup(startup)
+    records = run_benchmarks(cases, args.stages, repeat=repeat)
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        output = Path(__file__).resolve().parent / "results" / "benchmarks" / f"benchmark_{stamp}_{info['commit'] or 'local'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"environment": info, "preset": args.preset, "startup": startup, "results": records}, f, indent=2)
+    print(f"\n💾 Résultats sauvegardés: {output}")
+
+
+if __name__ == "__main__":
+    main()
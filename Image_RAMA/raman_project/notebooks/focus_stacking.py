@@ -0,0 +1,259 @@
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import islice
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"}
+DECODE_WORKERS = 4
+
+
+def list_image_files(folder: Path):
+    if not folder.exists():
+        return []
+    # Extension insensible à la casse (.BMP / .bmp)
+    return [f for f in sorted(folder.iterdir()) if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS]
+
+
+def load_image(path: Path):
+    # BMP : PIL d'abord (plus robuste), sinon cv2 ; None si illisible
+    if path.suffix.lower() == ".bmp":
+        try:
+            pil_img = Image.open(str(path))
+            if pil_img.mode != "RGB":
+                pil_img = pil_img.convert("RGB")
+            return cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+        except Exception:
+            return None
+    return cv2.imread(str(path))
+
+
+def iter_images(files, decode_workers=DECODE_WORKERS, prefetch=None):
+    # Décodage en threads, dans l'ordre des fichiers, avec au plus `prefetch` images
+    # décodées d'avance : la mémoire reste bornée quelle que soit la profondeur de la pile.
+    if decode_workers <= 1:
+        for path in files:
+            img = load_image(path)
+            if img is not None:
+                yield img
+        return
+
+    prefetch = prefetch or decode_workers
+    files_iter = iter(files)
+    with ThreadPoolExecutor(max_workers=decode_workers) as executor:
+        pending = deque(executor.submit(load_image, path) for path in islice(files_iter, prefetch))
+        while pending:
+            img = pending.popleft().result()
+            next_path = next(files_iter, None)
+            if next_path is not None:
+                pending.append(executor.submit(load_image, next_path))
+            if img is not None:
+                yield img
+
+
+def focus_stack_streaming(images):
+    stacked = None
+    best_sharpness = None
+    n_images = 0
+
+    for img in images:
+        # Netteté : variance du Laplacien sur les canaux.
+        # La carte reste en float64 pour reproduire exactement les égalités de np.argmax.
+        sharpness = cv2.Laplacian(img, cv2.CV_64F).var(axis=2)
+
+        if stacked is None:
+            stacked = img.copy()
+            best_sharpness = sharpness
+        else:
+            if img.shape != stacked.shape:
+                raise ValueError(f"Taille d'image incohérente: {img.shape} (attendu: {stacked.shape})")
+            # Strictement plus net : en cas d'égalité la première image est gardée, comme np.argmax
+            sharper = sharpness > best_sharpness
+            best_sharpness[sharper] = sharpness[sharper]
+            stacked[sharper] = img[sharper]
+        n_images += 1
+
+    return stacked, n_images
+
+
+def focus_stack(images):
+    stacked, _ = focus_stack_streaming(images)
+    return stacked
+
+
+def load_images_from_folder(folder: Path):
+    images = []
+    image_files = []
+    for path in list_image_files(folder):
+        img = load_image(path)
+        if img is not None:
+            images.append(img)
+            image_files.append(path)
+    return images, image_files
+
+
+def find_poudre_jobs(input_root: Path):
+    # Poudre étalée : <input_root>/Poudre/X50/<zone>/images...
+    poudre_x50 = input_root / "Poudre" / "X50"
+    if not poudre_x50.exists():
+        print(f"⚠️  Dossier {poudre_x50} non trouvé")
+        return []
+    return [(zone, f"Poudre_Etalee_{zone.name}") for zone in sorted(poudre_x50.iterdir()) if zone.is_dir()]
+
+
+def find_poudre_compactee_jobs(input_root: Path):
+    # Poudre compactée : <input_root>/Poudre compactée/<test>/X50/images...
+    poudre_compactee = input_root / "Poudre compactée"
+    if not poudre_compactee.exists():
+        print(f"⚠️  Dossier {poudre_compactee} non trouvé")
+        return []
+
+    jobs = []
+    for test in sorted(poudre_compactee.iterdir()):
+        if not test.is_dir():
+            continue
+        x50_folder = test / "X50"
+        if not x50_folder.exists():
+            print(f"⚠️  {test.name}: dossier X50 non trouvé")
+            continue
+        jobs.append((x50_folder, f"Poudre_Compactee_{test.name.replace(' ', '_')}_X50"))
+    return jobs
+
+
+def stack_folder(folder: Path, prefix: str, output_dir: Path, decode_workers=DECODE_WORKERS):
+    start_time = time.time()
+
+    try:
+        files = list_image_files(folder)
+        if len(files) < 2:
+            return {"stack": prefix, "status": f"⚠️  Pas assez d'images ({len(files)})", "images": len(files)}
+
+        stacked, n_images = focus_stack_streaming(iter_images(files, decode_workers))
+        if n_images < 2:
+            return {"stack": prefix, "status": f"⚠️  Pas assez d'images lisibles ({n_images})", "images": n_images}
+
+        if stacked.dtype != np.uint8:
+            stacked = cv2.convertScaleAbs(stacked)
+
+        # Nom descriptif : <préfixe>_<N>img_<largeur>x<hauteur>px.jpg
+        h, w = stacked.shape[:2]
+        output_path = output_dir / f"{prefix}_{n_images}img_{w}x{h}px.jpg"
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if not cv2.imwrite(str(output_path), stacked):
+            # Fallback PIL si cv2.imwrite échoue
+            Image.fromarray(cv2.cvtColor(stacked, cv2.COLOR_BGR2RGB)).save(str(output_path))
+
+        return {
+            "stack": prefix,
+            "status": "✓ Succès",
+            "images": n_images,
+            "output": output_path.name,
+            "time_s": time.time() - start_time,
+        }
+
+    except Exception as e:
+        return {"stack": prefix, "status": f"❌ Erreur: {str(e)}"}
+
+
+def init_stack_worker():
+    # Un processus par pile : le parallélisme interne vient des threads de décodage
+    cv2.setNumThreads(1)
+
+
+def run_stack_jobs(jobs, output_dir: Path, workers=1, decode_workers=DECODE_WORKERS):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results = [None] * len(jobs)
+
+    if workers > 1 and len(jobs) > 1:
+        workers = min(workers, len(jobs))
+        print(f"⚙️  Mode parallèle: {workers} processus × {decode_workers} threads de décodage")
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_stack_worker) as executor:
+            futures = {
+                executor.submit(stack_folder, folder, prefix, output_dir, decode_workers): idx
+                for idx, (folder, prefix) in enumerate(jobs)
+            }
+            for n_done, future in enumerate(as_completed(futures), 1):
+                idx = futures[future]
+                try:
+                    results[idx] = future.result()
+                except Exception as e:
+                    # Crash du worker lui-même : isolé à cette pile
+                    results[idx] = {"stack": jobs[idx][1], "status": f"❌ Erreur: {str(e)}"}
+                print(f"[{n_done}/{len(jobs)}] {results[idx]['status']} {results[idx]['stack']}")
+    else:
+        for idx, (folder, prefix) in enumerate(jobs):
+            print(f"🔬 [{idx + 1}/{len(jobs)}] {prefix}...")
+            results[idx] = stack_folder(folder, prefix, output_dir, decode_workers)
+            print(f"   {results[idx]['status']} {results[idx].get('output', '')}")
+
+    success_count = sum(1 for r in results if "✓" in r["status"])
+    print(f"✅ {success_count}/{len(jobs)} image(s) générée(s) dans {output_dir}")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Focus stacking - Profondeur de champ étendue.")
+    parser.add_argument(
+        "--input-root",
+        type=Path,
+        default=None,
+        help="Dossier racine contenant Poudre / Poudre compactée (par défaut: ../data/images).",
+    )
+    parser.add_argument(
+        "--output-root",
+        type=Path,
+        default=None,
+        help="Dossier de sortie des images empilées (par défaut: ../results/focus_stacking).",
+    )
+    parser.add_argument(
+        "--only",
+        choices=["poudre", "compactee"],
+        default=None,
+        help="Ne traiter que la poudre étalée ou que la poudre compactée.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Nombre de processus (une pile par processus, 0 = tous les cœurs, défaut: 1).",
+    )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=DECODE_WORKERS,
+        help=f"Threads de décodage d'images par pile (défaut: {DECODE_WORKERS}).",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    base_dir = Path(__file__).resolve().parent
+    input_root = args.input_root if args.input_root is not None else base_dir.parent / "data" / "images"
+    output_root = args.output_root if args.output_root is not None else base_dir.parent / "results" / "focus_stacking"
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+
+    print(f"📁 Dossier d'entrée: {input_root}")
+    print(f"📁 Dossier de sortie: {output_root}")
+
+    jobs = []
+    if args.only in (None, "poudre"):
+        jobs += find_poudre_jobs(input_root)
+    if args.only in (None, "compactee"):
+        jobs += find_poudre_compactee_jobs(input_root)
+    if not jobs:
+        print("❌ Aucune pile d'images trouvée.")
+        return
+
+    run_stack_jobs(jobs, output_root, workers=workers, decode_workers=args.decode_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
+import analyse_raman as ar
+
+# Grille par défaut : celle du tableau de sensibilité de PIPELINE.md (seuils ±10)
+DEFAULT_GRID = {
+    "clip_limits": [ar.CLAHE_CLIP_LIMIT],
+    "thresh1": [75, 85, 95],
+    "thresh2": [160, 170, 180],
+    "kernel_sizes": [ar.MORPH_KERNEL_SIZE[0]],
+    "min_areas": [ar.MIN_PARTICLE_AREA],
+}
+SWEEP_COLUMNS = [
+    "image",
+    "clip_limit",
+    "thresh1",
+    "thresh2",
+    "kernel_size",
+    "min_area",
+    "status",
+    "particles",
+    "blanc",
+    "gris",
+    "noir",
+    "clusters",
+    "decode_s",
+    "clahe_s",
+    "segmentation_s",
+    "detection_s",
+    "clustering_s",
+]
+
+
+def sweep_downstream(image_name, gray_eq, clip_limit, thresh1, thresh2, kernel_size, min_areas, detection_method, cluster_mode):
+    # Une tâche par réglage amont (CLAHE, seuils, noyau) : segmentation + détection une seule fois,
+    # puis un scoring + clustering par min_area (la détection au plus petit min_area contient
+    # exactement les particules des min_area plus grands)
+    start = time.perf_counter()
+    class_map = ar.segment_class_map(gray_eq, thresh1, thresh2)
+    segmentation_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_all, _, _, _ = ar.extract_particles(
+        gray_eq, class_map, method=detection_method, min_area=min(min_areas), kernel_size=(kernel_size, kernel_size)
+    )
+    detection_s = time.perf_counter() - start
+
+    rows = []
+    for min_area in min_areas:
+        row = {
+            "image": image_name,
+            "clip_limit": clip_limit,
+            "thresh1": thresh1,
+            "thresh2": thresh2,
+            "kernel_size": kernel_size,
+            "min_area": min_area,
+            "segmentation_s": segmentation_s,
+            "detection_s": detection_s,
+        }
+        df_particles = df_all[df_all["Area_px2"] >= min_area].reset_index(drop=True) if len(df_all) else df_all
+        type_counts = df_particles["Type"].value_counts() if len(df_particles) else pd.Series(dtype=int)
+        row["particles"] = len(df_particles)
+        row["blanc"] = int(type_counts.get("Type_1_Blanc", 0))
+        row["gris"] = int(type_counts.get("Type_2_Gris", 0))
+        row["noir"] = int(type_counts.get("Type_3_Noir", 0))
+
+        if len(df_particles) < 5:
+            row["status"] = "⚠️  Trop peu de particules"
+            rows.append(row)
+            continue
+
+        start = time.perf_counter()
+        df_particles = ar.add_scores(df_particles)
+        _, row["clusters"] = ar.cluster_weighted(df_particles, mode=cluster_mode)
+        row["clustering_s"] = time.perf_counter() - start
+        row["status"] = "✓ Succès"
+        rows.append(row)
+    return rows
+
+
+def valid_threshold_pairs(thresh1_values, thresh2_values):
+    return [(t1, t2) for t1, t2 in itertools.product(thresh1_values, thresh2_values) if t1 < t2]
+
+
+def run_sweep(image_files, grid, detection_method="labels", cluster_mode="fast", workers=1):
+    # Graphe d'étapes : décodage par image → CLAHE par clip_limit → (segmentation + détection)
+    # par couple de seuils et noyau → scoring + clustering par min_area.
+    # Les étapes amont sont calculées une fois et partagées par tous les réglages en aval.
+    threshold_pairs = valid_threshold_pairs(grid["thresh1"], grid["thresh2"])
+    if not threshold_pairs:
+        raise ValueError("Aucun couple de seuils valide (thresh1 doit être < thresh2)")
+    min_areas = sorted(set(grid["min_areas"]))
+    downstream = list(itertools.product(threshold_pairs, grid["kernel_sizes"]))
+    n_settings = len(image_files) * len(grid["clip_limits"]) * len(downstream) * len(min_areas)
+
+    print(
+        f"🧮 {n_settings} réglage(s) : {len(image_files)} décodage(s), "
+        f"{len(image_files) * len(grid['clip_limits'])} CLAHE, "
+        f"{len(image_files) * len(grid['clip_limits']) * len(downstream)} segmentation(s) + détection(s), "
+        f"{n_settings} clustering(s)"
+    )
+
+    rows = []
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=ar.init_batch_worker) if workers > 1 else None
+    n_tasks = len(image_files) * len(grid["clip_limits"]) * len(downstream)
+    n_done = 0
+    try:
+        for image_path in image_files:
+            start = time.perf_counter()
+            # Même décodage que le batch (BGR → gris) pour retrouver ses résultats au réglage par défaut
+            _, _, gray = ar.process_single_image(image_path)
+            decode_s = time.perf_counter() - start
+            if gray is None:
+                continue
+
+            for clip_limit in grid["clip_limits"]:
+                start = time.perf_counter()
+                gray_eq = ar.apply_clahe(gray, clip_limit)
+                shared = {"decode_s": decode_s, "clahe_s": time.perf_counter() - start}
+
+                tasks = [
+                    (
+                        image_path.name,
+                        gray_eq,
+                        clip_limit,
+                        thresh1,
+                        thresh2,
+                        kernel_size,
+                        min_areas,
+                        detection_method,
+                        cluster_mode,
+                    )
+                    for (thresh1, thresh2), kernel_size in downstream
+                ]
+                if executor is None:
+                    for task in tasks:
+                        rows += [{**row, **shared} for row in sweep_downstream(*task)]
+                    continue
+
+                # Réglages aval collectés avant la CLAHE suivante : une seule image égalisée
+                # en vol, mémoire plate quel que soit le nombre d'images et de clip_limits
+                futures = [executor.submit(sweep_downstream, *task) for task in tasks]
+                for future in as_completed(futures):
+                    rows += [{**row, **shared} for row in future.result()]
+                    n_done += 1
+                    print(f"   [{n_done}/{n_tasks}] réglages amont terminés")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    sweep_df = pd.DataFrame(rows, columns=SWEEP_COLUMNS)
+    return sweep_df.sort_values(["image", "clip_limit", "thresh1", "thresh2", "kernel_size", "min_area"], ignore_index=True)
+
+
+def print_sweep(sweep_df: pd.DataFrame):
+    print("\n" + "=" * 80)
+    print("📊 SENSIBILITÉ DES PARAMÈTRES")
+    print("=" * 80)
+    columns = ["image", "clip_limit", "thresh1", "thresh2", "kernel_size", "min_area", "particles", "clusters"]
+    print(sweep_df[columns].to_string(index=False))
+    for column in ("particles", "clusters"):
+        values = sweep_df[column].dropna()
+        if len(values):
+            spread = values.std() / max(values.mean(), 1e-9)
+            print(f"  • {column}: min {values.min():.0f}, max {values.max():.0f}, écart relatif {spread:.1%}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyse Raman - Sensibilité des paramètres du pipeline.")
+    parser.add_argument(
+        "--raw-folder",
+        type=Path,
+        default=None,
+        help="Dossier des images (par défaut: results/focus_stacking).",
+    )
+    parser.add_argument(
+        "--images",
+        nargs="+",
+        type=Path,
+        default=None,
+        help="Images à balayer (par défaut: la première image de --raw-folder).",
+    )
+    parser.add_argument(
+        "--clip-limits", nargs="+", type=float, default=DEFAULT_GRID["clip_limits"], help="Valeurs de clipLimit CLAHE."
+    )
+    parser.add_argument("--thresh1", nargs="+", type=int, default=DEFAULT_GRID["thresh1"], help="Seuils Noir/Gris.")
+    parser.add_argument("--thresh2", nargs="+", type=int, default=DEFAULT_GRID["thresh2"], help="Seuils Gris/Blanc.")
+    parser.add_argument(
+        "--kernel-sizes", nargs="+", type=int, default=DEFAULT_GRID["kernel_sizes"], help="Côtés du noyau morphologique carré."
+    )
+    parser.add_argument("--min-areas", nargs="+", type=int, default=DEFAULT_GRID["min_areas"], help="Aires minimales (px²).")
+    parser.add_argument(
+        "--detection-method",
+        choices=sorted(ar.DETECTION_METHODS),
+        default="labels",
+        help="Moteur de détection (défaut: labels).",
+    )
+    parser.add_argument(
+        "--cluster-mode",
+        choices=["fast", "exhaustive"],
+        default="fast",
+        help="Sélection de k par réglage (défaut: fast).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Processus pour les réglages en aval (0 = tous les cœurs, défaut: 1).",
+    )
+    parser.add_argument("--output", type=Path, default=None, help="Fichier CSV de résultats.")
+    return parser.parse_args()
+
+
+def main():
+    ar.setup_warnings()
+    ar.use_headless_backend()
+    args = parse_args()
+
+    base_dir = Path(__file__).resolve().parent
+    if args.images:
+        image_files = args.images
+    else:
+        raw_folder = args.raw_folder if args.raw_folder is not None else base_dir / "results" / "focus_stacking"
+        image_files = ar.get_image_files(raw_folder)[:1]
+    if not image_files:
+        print("❌ Aucune image trouvée.")
+        return
+
+    grid = {
+        "clip_limits": args.clip_limits,
+        "thresh1": args.thresh1,
+        "thresh2": args.thresh2,
+        "kernel_sizes": args.kernel_sizes,
+        "min_areas": args.min_areas,
+    }
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+
+    start = time.time()
+    sweep_df = run_sweep(image_files, grid, args.detection_method, args.cluster_mode, workers)
+    print_sweep(sweep_df)
+    print(f"⏱️  Temps total: {time.time() - start:.2f}s")
+
+    output = args.output if args.output is not None else base_dir / "results" / "sensitivity" / "sensitivity.csv"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    sweep_df.to_csv(output, index=False)
+    print(f"\n💾 Résultats sauvegardés: {output}")
+
+
+if __name__ == "__main__":
+    main()